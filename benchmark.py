@@ -0,0 +1,396 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Loopback benchmarks of the UDP server and client.
+
+The load runs start ``server.py`` in a scratch directory and drive it over
+loopback across a matrix of message counts, payload sizes, client counts
+and upload sizes. Throughput and loss come from the senders and the
+server metrics endpoint, latency percentiles from the per-message delays
+of the reports the server writes. Load is generated with the headless
+client core. The microbenchmarks time the per-packet functions of the
+server in process.
+
+Results are written as JSON, and compared with a previous run when one
+is given with ``--baseline``.
+"""
+
+from __future__ import unicode_literals
+
+import os
+import sys
+import json
+import time
+import socket
+import shutil
+import timeit
+import argparse
+import platform
+import tempfile
+import subprocess
+import multiprocessing
+import numpy as np
+import os.path as osp
+
+import wire
+import latency
+import metrics
+import transfer
+
+HERE = osp.dirname(osp.abspath(__file__))
+
+parser = argparse.ArgumentParser(
+    description='Loopback benchmarks of the UDP server and client')
+parser.add_argument('--port',
+                    default=10500,
+                    help="UDP port of the benchmarked server, its metrics "
+                         "are served on the next one")
+parser.add_argument('--messages',
+                    default='1000,10000',
+                    help="Comma separated messages sent per client")
+parser.add_argument('--payloads',
+                    default='16,1024',
+                    help="Comma separated message sizes in bytes")
+parser.add_argument('--clients',
+                    default='1,4',
+                    help="Comma separated numbers of concurrent senders")
+parser.add_argument('--file-sizes',
+                    default='1048576,16777216',
+                    help="Comma separated upload sizes in bytes")
+parser.add_argument('--window',
+                    default=64,
+                    help="Chunks in flight during uploads")
+parser.add_argument('--repeat',
+                    default=3,
+                    help="Runs of every case, the median one is kept")
+parser.add_argument('--micro-rounds',
+                    default=20000,
+                    help="Calls timed per microbenchmark")
+parser.add_argument('--skip',
+                    default='',
+                    help="Comma separated parts to leave out among "
+                         "messages, uploads and micro")
+parser.add_argument('--server-args',
+                    default='',
+                    help="Extra options given to server.py, e.g. "
+                         "'--engine batch'")
+parser.add_argument('--output',
+                    default='benchmark.json',
+                    help="File the results are written to")
+parser.add_argument('--baseline',
+                    default=None,
+                    help="Results of a previous run to compare with")
+
+SERVER_START_TIMEOUT = 10.0
+REPORT_TIMEOUT = 10.0
+IDLE_TIMEOUT = 2.0
+SEED = 1234
+# Parameters identifying a load case in the results
+CASE_KEYS = ('messages', 'payload', 'clients', 'size', 'window')
+
+
+def parse_list(value):
+    return [int(item) for item in value.split(',') if item]
+
+
+class Server:
+    """``server.py`` running in a scratch directory."""
+
+    def __init__(self, port, extra_args=()):
+        self.port = port
+        self.metrics_port = port + 1
+        self.workdir = tempfile.mkdtemp(prefix='udplab-bench-')
+        cmd = [sys.executable, osp.join(HERE, 'server.py'),
+               '--port', str(port), '--metrics-port', str(port + 1),
+               '--idle-timeout', str(IDLE_TIMEOUT), '--silent']
+        self.process = subprocess.Popen(cmd + list(extra_args),
+                                        cwd=self.workdir)
+        deadline = time.time() + SERVER_START_TIMEOUT
+        while True:
+            try:
+                self.scrape()
+                break
+            except OSError:
+                if (time.time() > deadline or
+                        self.process.poll() is not None):
+                    self.close()
+                    raise RuntimeError('server.py did not start')
+                time.sleep(0.1)
+
+    def scrape(self):
+        return metrics.scrape('127.0.0.1', self.metrics_port)
+
+    def reports(self):
+        return set(osp.join(self.workdir, 'logs', name)
+                   for name in os.listdir(osp.join(self.workdir, 'logs')))
+
+    def wait_reports(self, count):
+        """Wait until ``count`` reports were written, runs that lost their
+        last message are only reported once the client is idle."""
+        deadline = time.time() + IDLE_TIMEOUT + REPORT_TIMEOUT
+        while len(self.reports()) < count and time.time() < deadline:
+            time.sleep(0.05)
+
+    def close(self):
+        if self.process.poll() is None:
+            self.process.terminate()
+            self.process.wait()
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+
+def send_messages(host, port, num_messages, message, results):
+    sender = transfer.MessageSender(host, port, num_messages, message)
+    start = time.perf_counter()
+    sender.run()
+    results.put(time.perf_counter() - start)
+
+
+def upload_file(host, port, path, window):
+    uploader = transfer.FileUploader(host, port, path, os.stat(path).st_size,
+                                     212992, window)
+    start = time.perf_counter()
+    result = uploader.run()
+    return time.perf_counter() - start, result
+
+
+def read_delays(paths):
+    """Per-message delays in seconds of the given full reports."""
+    delays = []
+    for path in paths:
+        with open(path) as fp:
+            fp.readline()
+            for line in fp:
+                fields = line.split(',')
+                if len(fields) != 2:
+                    break
+                delays.append(float(fields[1]))
+    return np.array(delays)
+
+
+def run_messages(server, num_messages, payload, clients):
+    ctx = multiprocessing.get_context('fork')
+    results = ctx.Queue()
+    message = 'x' * payload
+    before = server.scrape()
+    done = server.reports()
+    senders = [ctx.Process(target=send_messages,
+                           args=('127.0.0.1', server.port, num_messages,
+                                 message, results))
+               for _ in range(clients)]
+    start = time.perf_counter()
+    for sender in senders:
+        sender.start()
+    elapsed = [results.get() for _ in senders]
+    wall = time.perf_counter() - start
+    for sender in senders:
+        sender.join()
+    server.wait_reports(len(done) + clients)
+    after = server.scrape()
+
+    sent = num_messages * clients
+    received = int(after['udplab_messages_total'] -
+                   before['udplab_messages_total'])
+    drops = after.get('udplab_socket_drops_total', 0) - before.get(
+        'udplab_socket_drops_total', 0)
+    delays = read_delays(server.reports() - done)
+    result = {'messages': num_messages, 'payload': payload,
+              'clients': clients, 'sent': sent, 'received': received,
+              'loss': 1 - received / sent if sent else 0.0,
+              'kernel_drops': int(drops),
+              'send_rate': sent / wall,
+              'send_mbps': sent * payload * 8 / wall / 1e6,
+              'slowest_client': max(elapsed)}
+    if delays.size:
+        result['latency'] = dict(
+            ('p%g' % q, float(value)) for q, value in
+            zip(latency.PERCENTILES,
+                np.percentile(delays, latency.PERCENTILES)))
+        result['latency']['mean'] = float(np.mean(delays))
+    return result
+
+
+def run_upload(server, size, window):
+    path = osp.join(tempfile.mkdtemp(prefix='udplab-bench-'), 'blob.bin')
+    rng = np.random.RandomState(SEED)
+    with open(path, 'wb') as fp:
+        fp.write(rng.bytes(size))
+    before = server.scrape()
+    try:
+        elapsed, upload = upload_file('127.0.0.1', server.port, path,
+                                      window)
+        with open(path, 'rb') as fp, open(osp.join(
+                server.workdir, 'uploads', 'blob.bin'), 'rb') as uploaded:
+            intact = fp.read() == uploaded.read()
+    finally:
+        shutil.rmtree(osp.dirname(path), ignore_errors=True)
+    after = server.scrape()
+    chunks = after['udplab_chunks_total'] - before['udplab_chunks_total']
+    needed = -(-size // wire.CHUNK_SIZE)
+    return {'size': size, 'window': window, 'seconds': elapsed,
+            'mbps': size * 8 / elapsed / 1e6, 'intact': intact,
+            'digest': upload['digest'],
+            'chunks_received': int(chunks),
+            'retransmitted': upload['retransmits'],
+            'duplicates': int(max(chunks - needed, 0)),
+            'busy': int(after['udplab_busy_total'] -
+                        before['udplab_busy_total'])}
+
+
+def median_run(runs, key):
+    return sorted(runs, key=lambda run: run[key])[len(runs) // 2]
+
+
+def load_benchmarks(args):
+    results = {'messages': [], 'uploads': []}
+    skip = args.skip.split(',')
+    server = Server(int(args.port), args.server_args.split())
+    try:
+        if 'messages' not in skip:
+            for clients in parse_list(args.clients):
+                for payload in parse_list(args.payloads):
+                    for num_messages in parse_list(args.messages):
+                        runs = [run_messages(server, num_messages, payload,
+                                             clients)
+                                for _ in range(int(args.repeat))]
+                        run = median_run(runs, 'send_rate')
+                        print('messages', json.dumps(run))
+                        results['messages'].append(run)
+        if 'uploads' not in skip:
+            for size in parse_list(args.file_sizes):
+                runs = [run_upload(server, size, int(args.window))
+                        for _ in range(int(args.repeat))]
+                run = median_run(runs, 'mbps')
+                print('uploads', json.dumps(run))
+                results['uploads'].append(run)
+    finally:
+        server.close()
+    return results
+
+
+class NullTransport:
+    def sendto(self, data, addr):
+        pass
+
+    def get_extra_info(self, name, default=None):
+        return default
+
+
+def per_call(statement, rounds, setup=None):
+    timer = timeit.Timer(statement, setup or 'pass')
+    return min(timer.repeat(3, rounds)) / rounds * 1e9
+
+
+def micro_benchmarks(rounds):
+    """Nanoseconds per call of the per-packet server functions."""
+    import server
+    import timers
+    from writer import WriterPool
+
+    workdir = tempfile.mkdtemp(prefix='udplab-bench-')
+    server.LOGGING_PATH = workdir
+    server.writer_pool = WriterPool(1, server.DEFAULT_QUEUE_SIZE)
+    protocol = server.EchoServerProtocol()
+    protocol.transport = NullTransport()
+    protocol.idle = timers.TimerWheel(server.idle_timeout, protocol.expire)
+    addr = ('127.0.0.1', 40000)
+    results = {}
+
+    # The run never reaches its last message, so no report is written
+    total = 10 * rounds
+    message = wire.encode_message(wire.FORMAT_BINARY, 1, 1, total,
+                                  time.time_ns(), b'x' * 64)
+    json_message = wire.encode_message(wire.FORMAT_JSON, 1, 1, total,
+                                       time.time_ns(), b'x' * 64)
+    results['decode_binary'] = per_call(lambda: wire.decode(message),
+                                        rounds)
+    results['decode_json'] = per_call(lambda: wire.decode(json_message),
+                                      rounds)
+    for mode in ('full', 'summary'):
+        server.stats_mode = mode
+        server.events.clear()
+        results['datagram_received_msg_' + mode] = per_call(
+            lambda: protocol.datagram_received(message, addr), rounds)
+    server.events.clear()
+
+    chunk = os.urandom(wire.CHUNK_SIZE)
+    upload = server.new_upload(osp.join(workdir, 'upload'),
+                               rounds * wire.CHUNK_SIZE, wire.CHUNK_SIZE)
+    stream = server.add_stream(upload, 0, rounds + 1)
+    server.open_upload(upload)
+    seqs = iter(range(1, 4 * rounds))
+
+    def write_next():
+        seq = next(seqs) % rounds + 1
+        # Every chunk extends the in-order prefix by itself
+        stream['seg_write'] = seq - 1
+        stream['written'][(seq + 1) >> 3] &= ~(1 << ((seq + 1) & 7))
+        upload['hashed'] = (seq - 1) * wire.CHUNK_SIZE
+        server.write_to_file(upload, stream, seq, chunk)
+
+    results['write_to_file'] = per_call(write_next, rounds)
+    server.discard_upload(upload)
+
+    for size in (1000, 100000):
+        records = latency.MessageRecords(size)
+        now = time.time_ns()
+        for seq in range(1, size + 1):
+            records.append(seq, now + seq * 1000, now + seq * 1000 + 50000)
+        event = {'num_messages': size, 'initial_time': now,
+                 'records': records}
+        summary = latency.LatencyStats(size)
+        for seq in range(1, size + 1):
+            summary.add(seq, 50000 + seq % 977)
+        summary_event = {'num_messages': size, 'initial_time': now,
+                         'summary': summary}
+        calls = max(1, rounds // size)
+        results['generate_report_%d' % size] = per_call(
+            lambda: server.generate_report(addr, event), calls)
+        results['generate_summary_report_%d' % size] = per_call(
+            lambda: server.generate_report(addr, summary_event), calls)
+
+    server.writer_pool.close()
+    shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+
+def compare(results, baseline):
+    """Print the relative change of every number found in both runs."""
+    def flatten(value, prefix):
+        if isinstance(value, dict):
+            for key, item in value.items():
+                yield from flatten(item, prefix + (str(key),))
+        elif isinstance(value, list):
+            for item in value:
+                # Load cases are matched on their parameters
+                key = ','.join('%s=%s' % (name, item[name])
+                               for name in CASE_KEYS if name in item)
+                yield from flatten(item, prefix + (key,))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            yield prefix, value
+
+    old = dict(flatten(baseline, ()))
+    for key, value in flatten(results, ()):
+        if (key[0] != 'meta' and key[-1] not in CASE_KEYS and
+                key in old and old[key]):
+            print('%-70s %12.6g %+8.1f%%' % ('.'.join(key), value,
+                                             100.0 * (value / old[key] - 1)))
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    results = {'meta': {'python': platform.python_version(),
+                        'platform': platform.platform(),
+                        'cpus': os.cpu_count(),
+                        'host': socket.gethostname(),
+                        'time': time.time(),
+                        'server_args': args.server_args}}
+    if 'micro' not in args.skip.split(','):
+        results['micro'] = micro_benchmarks(int(args.micro_rounds))
+        for name, value in results['micro'].items():
+            print('%-40s %12.1f ns' % (name, value))
+    results.update(load_benchmarks(args))
+    with open(args.output, 'w') as fp:
+        json.dump(results, fp, indent=2)
+    if args.baseline is not None:
+        with open(args.baseline) as fp:
+            compare(results, json.load(fp))
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+
+"""Optional compression of upload chunks.
+
+Chunks are compressed one by one, with raw zlib or LZMA streams that carry
+no header, and flagged as such on the wire so that the server only inflates
+those. ``Compressor`` keeps sending the data as is while the chunks it
+samples do not shrink enough to pay for the CPU time.
+"""
+
+import time
+import zlib
+import lzma
+
+CODECS = ['zlib', 'lzma']
+DEFAULT_LEVELS = {'zlib': 6, 'lzma': 1}
+# LZMA dictionary, chunks are never larger than a datagram
+LZMA_DICT_SIZE = 1 << 16
+# Chunks sent as is when the sampled ratio is above this
+BYPASS_RATIO = 0.9
+# Chunks sent as is before sampling again once compression was bypassed
+BYPASS_CHUNKS = 64
+# Weight of the last sample in the running compression ratio
+SAMPLE_WEIGHT = 0.25
+
+
+def lzma_filters(level=None):
+    lzma2 = {'id': lzma.FILTER_LZMA2, 'dict_size': LZMA_DICT_SIZE}
+    if level is not None:
+        lzma2['preset'] = level
+    return [lzma2]
+
+
+def compress(codec, level, data):
+    if codec == 'lzma':
+        return lzma.compress(data, lzma.FORMAT_RAW,
+                             filters=lzma_filters(level))
+    packer = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return packer.compress(data) + packer.flush()
+
+
+def decompress(codec, data, limit):
+    """Inflate ``data``, refusing chunks of more than ``limit`` bytes."""
+    if codec == 'lzma':
+        unpacker = lzma.LZMADecompressor(lzma.FORMAT_RAW,
+                                         filters=lzma_filters())
+    else:
+        unpacker = zlib.decompressobj(-zlib.MAX_WBITS)
+    chunk = unpacker.decompress(data, limit)
+    if not (unpacker.eof if codec == 'lzma' else
+            unpacker.eof and not unpacker.unconsumed_tail):
+        raise ValueError('Compressed chunk larger than %d bytes' % limit)
+    return chunk
+
+
+class Compressor:
+    """Compress the chunks of one stream with ``codec`` at ``level``.
+
+    Every chunk is compressed while the running ratio of compressed to raw
+    sizes stays below ``BYPASS_RATIO``. Above it, the next
+    ``BYPASS_CHUNKS`` chunks are sent as is and the one after is sampled
+    again. Chunks that do not shrink are always sent as is. ``cpu_time``
+    adds up the thread CPU time spent compressing.
+    """
+
+    def __init__(self, codec, level=None):
+        self.codec = codec
+        self.level = DEFAULT_LEVELS[codec] if level is None else level
+        self.ratio = None
+        self.skip = 0
+        self.cpu_time = 0.0
+        self.compressed = 0
+        self.bypassed = 0
+
+    def pack(self, data):
+        """Return the payload to send for ``data`` and whether it is
+        compressed."""
+        if self.skip:
+            self.skip -= 1
+            self.bypassed += 1
+            return data, False
+        start = time.thread_time()
+        packed = compress(self.codec, self.level, data)
+        self.cpu_time += time.thread_time() - start
+        ratio = len(packed) / max(1, len(data))
+        if self.ratio is None:
+            self.ratio = ratio
+        else:
+            self.ratio += SAMPLE_WEIGHT * (ratio - self.ratio)
+        if self.ratio > BYPASS_RATIO:
+            self.skip = BYPASS_CHUNKS
+        if len(packed) >= len(data):
+            self.bypassed += 1
+            return data, False
+        self.compressed += 1
+        return packed, True
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+
+"""Retransmission timeout and congestion window of uploads."""
+
+INITIAL_RTO = 1.0
+MIN_RTO = 0.02
+MAX_RTO = 10.0
+# Timers are checked once per ACK poll, so finer deviations do not count
+CLOCK_GRANULARITY = 0.01
+INITIAL_WINDOW = 4
+MIN_THRESHOLD = 2
+
+
+class RttEstimator:
+    """Smoothed round-trip time and retransmission timeout of RFC 6298.
+
+    Callers follow Karn's rule: chunks that were sent more than once give
+    no sample, their ACK could answer any of the copies.
+    """
+
+    def __init__(self):
+        self.srtt = None
+        self.rttvar = None
+        self.rto = INITIAL_RTO
+
+    def sample(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        # A fresh sample also ends any backoff
+        self.rto = min(MAX_RTO, max(MIN_RTO, self.srtt + max(
+            CLOCK_GRANULARITY, 4 * self.rttvar)))
+
+    def backoff(self):
+        self.rto = min(MAX_RTO, 2 * self.rto)
+
+
+class AimdWindow:
+    """Congestion window in chunks, never above ``limit``.
+
+    It starts at ``INITIAL_WINDOW`` and doubles every round trip up to the
+    slow start threshold, then grows by one chunk per round trip. A loss
+    halves it, at most once per window of data: losses of chunks sent
+    before the previous decrease are part of the same event. A timeout
+    takes it back to one chunk.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.cwnd = float(min(INITIAL_WINDOW, limit))
+        self.ssthresh = float(limit)
+        # Chunks below this were in flight at the last decrease
+        self.recover = 0
+
+    @property
+    def window(self):
+        return max(1, int(self.cwnd))
+
+    def on_ack(self, count):
+        for _ in range(count):
+            if self.cwnd < self.ssthresh:
+                self.cwnd += 1
+            else:
+                self.cwnd += 1 / self.cwnd
+        self.cwnd = min(self.cwnd, self.limit)
+
+    def on_loss(self, seq, next_seq):
+        if seq < self.recover:
+            return
+        self.ssthresh = max(self.cwnd / 2, MIN_THRESHOLD)
+        self.cwnd = min(self.ssthresh, self.limit)
+        self.recover = next_seq
+
+    def on_timeout(self, next_seq):
+        self.ssthresh = max(self.cwnd / 2, MIN_THRESHOLD)
+        self.cwnd = 1.0
+        self.recover = next_seq
@@ -0,0 +1,555 @@
+# -*- coding: utf-8 -*-
+
+"""Qt interface of the UDP client.
+
+The threads only move the transfers of ``transfer`` off the GUI thread and
+turn their progress into signals. Transfers coalesce their progress into
+at most 20 reports per second, so the GUI thread keeps up however many
+datagrams they send.
+"""
+
+from __future__ import unicode_literals
+
+import os
+import math
+import humanize
+
+import log
+import merkle
+import pacing
+import transfer
+from utils import add_actions, create_toolbutton, create_action
+
+from qtpy.compat import getopenfilename
+from qtpy.QtCore import QThread, Signal, Slot
+from qtpy.QtWidgets import (QHBoxLayout, QLabel, QMainWindow,
+                            QVBoxLayout, QWidget,
+                            QProgressBar, QApplication,
+                            QSpinBox, QLineEdit, QActionGroup,
+                            QDoubleSpinBox, QComboBox)
+
+import qtawesome as qta
+
+
+class TransferThread(QThread):
+    sig_finished = Signal()
+
+    def __init__(self, parent):
+        QThread.__init__(self, parent)
+        self.transfer = None
+        self.result = None
+
+    def run(self):
+        self.result = self.transfer.run()
+        self.sig_finished.emit()
+
+    def stop(self):
+        self.transfer.cancel()
+
+
+class SendMessagesThread(TransferThread):
+    sig_progress = Signal(object)
+
+    def initialize(self, host, port, num_messages, message, rate=0,
+                   burst=1, unit='messages'):
+        self.transfer = transfer.MessageSender(
+            host, port, num_messages, message,
+            self.sig_progress.emit, rate, burst, unit)
+
+
+class FileUploadThread(TransferThread):
+    sig_progress = Signal(object)
+    sig_status = Signal(object)
+
+    def initialize(self, host, port, path, size, bufsize, window=1,
+                   streams=1, digest=merkle.DEFAULT_ALGORITHM,
+                   compression=None, level=None, chunk_size=None):
+        self.transfer = transfer.FileUploader(
+            host, port, path, size, bufsize, window,
+            self.sig_progress.emit, self.sig_status.emit, streams,
+            digest=digest, compression=compression, level=level,
+            chunk_size=chunk_size)
+
+
+class DownloadButtons(QWidget):
+    start_sig = Signal()
+    stop_sig = Signal()
+
+    def __init__(self, parent):
+        QWidget.__init__(self, parent)
+        upload_icon = qta.icon("fa.upload")
+        self.start = create_toolbutton(self, text="Start uploading",
+                                       triggered=lambda: self.start_sig.emit(),
+                                       tip="Send Messages",
+                                       icon=upload_icon,
+                                       text_beside_icon=True)
+        stop_icon = qta.icon("fa.stop", color="red")
+        self.stop = create_toolbutton(self, text="Stop",
+                                      triggered=lambda: self.stop_sig.emit(),
+                                      tip="Stop", icon=stop_icon,
+                                      text_beside_icon=True)
+        self.stop.setEnabled(False)
+        self.start.setEnabled(True)
+        layout = QHBoxLayout()
+        layout.addWidget(self.start)
+        layout.addWidget(self.stop)
+        self.setLayout(layout)
+
+
+class FileProgressBar(QWidget):
+    """Progress bar with the counts, rate and loss of a transfer"""
+    MAX_LABEL_LENGTH = 40
+    # Bar steps, byte counts of large files overflow a QProgressBar
+    STEPS = 1000
+
+    def __init__(self, parent, *args, **kwargs):
+        QWidget.__init__(self, parent)
+        self.pap = parent
+        self.title = "Transfer"
+        self.status_text = QLabel(self)
+        self.details = QLabel(self)
+        self.bar = QProgressBar(self)
+        self.bar.setRange(0, 0)
+        layout = QVBoxLayout()
+        layout.addWidget(self.status_text)
+        layout.addWidget(self.bar)
+        layout.addWidget(self.details)
+        self.setLayout(layout)
+
+    def __truncate(self, text):
+        ellipsis = '...'
+        part_len = (self.MAX_LABEL_LENGTH - len(ellipsis)) / 2.0
+        left_text = text[:int(math.ceil(part_len))]
+        right_text = text[-int(math.floor(part_len)):]
+        return left_text + ellipsis + right_text
+
+    def initial_state(self):
+        self.status_text.setText("  Waiting for a upload to begin")
+        self.bar.hide()
+        self.details.hide()
+
+    def reset_files(self, title="Transfer"):
+        self.title = title
+        self.status_text.setText("  Transfer in progress...")
+        self.details.setText("")
+        self.bar.setRange(0, self.STEPS)
+        self.bar.setValue(0)
+        self.bar.show()
+
+    def set_file(self, path):
+        if len(path) > self.MAX_LABEL_LENGTH:
+            path = self.__truncate(path)
+        self.reset_files("Uploading " + path)
+
+    def reset_status(self, detail=''):
+        self.status_text.setText("  Transfer Complete! " + detail)
+        self.bar.hide()
+
+    @Slot(object)
+    def update_progress(self, report):
+        if report['unit'] == 'bytes':
+            counts = "{0}/{1}  {2}/s".format(
+                humanize.naturalsize(report['done']),
+                humanize.naturalsize(report['total']),
+                humanize.naturalsize(report['throughput']))
+        else:
+            counts = "{0}/{1} {2}  {3:.0f}/s".format(
+                report['done'], report['total'], report['unit'],
+                report['throughput'])
+        text = "  {0} - {1}".format(self.title, counts)
+        if report['eta'] is not None:
+            text += "  ETA {0}".format(
+                humanize.naturaldelta(report['eta']))
+        if 'loss' in report:
+            text += "  Loss {0:.1%}".format(report['loss'])
+        self.status_text.setText(text)
+        if report['total']:
+            self.bar.setValue(self.STEPS * min(report['done'],
+                                               report['total']) //
+                              report['total'])
+
+    @Slot(object)
+    def update_transfer_status(self, status):
+        text = "  RTT {0}  RTO {1:.0f} ms  Window {2}  Retransmits {3}"
+        rtt = '-'
+        if status['srtt'] is not None:
+            rtt = '{0:.1f} ms'.format(status['srtt'] * 1e3)
+        self.details.setText(text.format(rtt, status['rto'] * 1e3,
+                                         status['cwnd'],
+                                         status['retransmits']))
+        self.details.show()
+
+
+class HostOptionsWidget(QWidget):
+    def __init__(self, parent, host, port):
+        QWidget.__init__(self, parent)
+
+        self.host_selector = QLineEdit(self)
+        self.host_selector.setText(host)
+
+        self.port_spinner = QSpinBox(self)
+        self.port_spinner.setMinimum(1)
+        self.port_spinner.setMaximum(60000)
+        self.port_spinner.setValue(port)
+        self.port_spinner.setToolTip("UDP Server Port")
+
+        vlayout1 = QVBoxLayout()
+        vlayout1.addWidget(QLabel("Server Host", self))
+        vlayout1.addWidget(self.host_selector)
+
+        vlayout2 = QVBoxLayout()
+        vlayout2.addWidget(QLabel("Port", self))
+        vlayout2.addWidget(self.port_spinner)
+        hlayout = QHBoxLayout()
+        hlayout.addLayout(vlayout1)
+        hlayout.addLayout(vlayout2)
+
+        self.setLayout(hlayout)
+
+    def get_host_info(self):
+        host = self.host_selector.text()
+        port = self.port_spinner.value()
+        return host, port
+
+
+class MessageInfoWidget(QWidget):
+    def __init__(self, parent, pace):
+        QWidget.__init__(self, parent)
+
+        self.message_input = QLineEdit(self)
+        self.num_messages = QSpinBox(self)
+        self.num_messages.setValue(1)
+        self.num_messages.setMinimum(1)
+        self.num_messages.setMaximum(200000)
+
+        vlayout_msg = QVBoxLayout()
+        vlayout_msg.addWidget(QLabel("Message", self))
+        vlayout_msg.addWidget(self.message_input)
+
+        hlayout = QHBoxLayout()
+        hlayout.addLayout(vlayout_msg)
+
+        vlayout_nmsg = QVBoxLayout()
+        vlayout_nmsg.addWidget(QLabel("Number of messages", self))
+        vlayout_nmsg.addWidget(self.num_messages)
+        hlayout.addLayout(vlayout_nmsg)
+
+        self.rate_spin = QDoubleSpinBox(self)
+        self.rate_spin.setDecimals(0)
+        self.rate_spin.setMaximum(1e12)
+        self.rate_spin.setValue(pace['rate'])
+        self.rate_spin.setToolTip("0 sends as fast as possible")
+        self.rate_unit = QComboBox(self)
+        self.rate_unit.addItems(pacing.RATE_UNITS)
+        self.rate_unit.setCurrentText(pace['unit'])
+        self.burst_spin = QSpinBox(self)
+        self.burst_spin.setMinimum(1)
+        self.burst_spin.setMaximum(200000)
+        self.burst_spin.setValue(pace['burst'])
+        self.burst_spin.setToolTip("Messages sent back to back when behind")
+
+        vlayout_rate = QVBoxLayout()
+        vlayout_rate.addWidget(QLabel("Rate (per second)", self))
+        rate_layout = QHBoxLayout()
+        rate_layout.addWidget(self.rate_spin)
+        rate_layout.addWidget(self.rate_unit)
+        vlayout_rate.addLayout(rate_layout)
+        hlayout.addLayout(vlayout_rate)
+
+        vlayout_burst = QVBoxLayout()
+        vlayout_burst.addWidget(QLabel("Burst", self))
+        vlayout_burst.addWidget(self.burst_spin)
+        hlayout.addLayout(vlayout_burst)
+
+        self.setLayout(hlayout)
+
+    def get_info(self):
+        message = self.message_input.text()
+        num_messages = self.num_messages.value()
+        return message, num_messages
+
+    def get_pace(self):
+        return {'rate': self.rate_spin.value(),
+                'burst': self.burst_spin.value(),
+                'unit': self.rate_unit.currentText()}
+
+
+class MessageUploaderWidget(QWidget):
+    def __init__(self, parent, host, port, pace):
+        QWidget.__init__(self, parent)
+        self.host = host
+        self.port = port
+        self.thread = None
+
+        self.host_selector = HostOptionsWidget(self, host, port)
+        self.msg_info = MessageInfoWidget(self, pace)
+        self.buttons = DownloadButtons(self)
+        self.progress_bar = FileProgressBar(self)
+        self.progress_bar.initial_state()
+
+        main_layout = QVBoxLayout()
+        main_layout.addWidget(self.host_selector)
+        main_layout.addWidget(self.msg_info)
+        main_layout.addWidget(self.progress_bar)
+        main_layout.addWidget(self.buttons)
+        self.setLayout(main_layout)
+
+        self.buttons.start_sig.connect(self.start_transfer)
+        self.buttons.stop_sig.connect(self.stop_and_reset_thread)
+
+    def start_transfer(self):
+        log.logger.debug("Transfer messages!")
+        self.stop_and_reset_thread()
+
+        message, num_messages = self.msg_info.get_info()
+        host, port = self.host_selector.get_host_info()
+        log.logger.debug("Sending to %s:%d", host, port)
+
+        self.thread = SendMessagesThread(self)
+        self.thread.initialize(host, port, num_messages, message,
+                               **self.msg_info.get_pace())
+        self.thread.sig_finished.connect(self.transfer_complete)
+        self.thread.sig_progress.connect(self.progress_bar.update_progress)
+        self.progress_bar.reset_files("Sending messages")
+        self.thread.start()
+        self.buttons.stop.setEnabled(True)
+        self.buttons.start.setEnabled(False)
+
+    def transfer_complete(self):
+        detail = ''
+        result = self.thread.result if self.thread is not None else None
+        if result is not None and result['requested_rate']:
+            detail = "{0:.0f} of {1:.0f} {2}/s requested".format(
+                result['achieved_rate'], result['requested_rate'],
+                result['rate_unit'])
+        self.progress_bar.reset_status(detail)
+        self.buttons.stop.setEnabled(False)
+        self.buttons.start.setEnabled(True)
+
+    def stop_and_reset_thread(self):
+        if self.thread is not None:
+            if self.thread.isRunning():
+                self.thread.sig_finished.disconnect(self.transfer_complete)
+                self.thread.stop()
+                self.thread.wait()
+            self.thread.setParent(None)
+            self.thread = None
+            self.transfer_complete()
+
+
+class FileChooserWidget(QWidget):
+    def __init__(self, parent, bufsize, window, streams):
+        QWidget.__init__(self, parent)
+
+        self.file_selector = QLineEdit(self)
+        dir_icon = qta.icon('fa.folder-open')
+        self.file_btn = create_toolbutton(self, text="Choose a file",
+                                          triggered=self.select_file,
+                                          tip="Choose a file", icon=dir_icon)
+        self.file_btn.setToolTip("Choose a file")
+
+        self.buf_size_spin = QSpinBox(self)
+        # print(bufsize)
+        self.buf_size_spin.setMinimum(1)
+        self.buf_size_spin.setMaximum(100000000)
+        self.buf_size_spin.setValue(bufsize)
+
+        self.window_spin = QSpinBox(self)
+        self.window_spin.setMinimum(1)
+        self.window_spin.setMaximum(4096)
+        self.window_spin.setValue(window)
+        self.window_spin.setToolTip("Chunks in flight, 1 for stop-and-wait")
+
+        self.streams_spin = QSpinBox(self)
+        self.streams_spin.setMinimum(1)
+        self.streams_spin.setMaximum(64)
+        self.streams_spin.setValue(streams)
+        self.streams_spin.setToolTip("Byte ranges uploaded at once")
+
+        vlayout = QVBoxLayout()
+        vlayout.addWidget(QLabel("File to upload", self))
+        hlayout = QHBoxLayout()
+        hlayout.addWidget(self.file_selector)
+        hlayout.addWidget(self.file_btn)
+        vlayout.addLayout(hlayout)
+
+        buf_layout = QVBoxLayout()
+        buf_layout.addWidget(QLabel("Buffer Size (Bytes)", self))
+        buf_layout.addWidget(self.buf_size_spin)
+
+        window_layout = QVBoxLayout()
+        window_layout.addWidget(QLabel("Window (Chunks)", self))
+        window_layout.addWidget(self.window_spin)
+
+        streams_layout = QVBoxLayout()
+        streams_layout.addWidget(QLabel("Streams", self))
+        streams_layout.addWidget(self.streams_spin)
+
+        wid_layout = QHBoxLayout()
+        wid_layout.addLayout(vlayout)
+        wid_layout.addLayout(buf_layout)
+        wid_layout.addLayout(window_layout)
+        wid_layout.addLayout(streams_layout)
+        self.setLayout(wid_layout)
+
+    def select_file(self):
+        filename, _ = getopenfilename(self, caption="Select a file")
+        log.logger.debug("Selected %s", filename)
+        self.file_selector.setText(filename)
+
+    def get_selected_file(self):
+        path = self.file_selector.text()
+        size = os.stat(path).st_size
+        return path, size
+
+    def get_bufsize(self):
+        return self.buf_size_spin.value()
+
+    def get_window(self):
+        return self.window_spin.value()
+
+    def get_streams(self):
+        return self.streams_spin.value()
+
+
+class FileUploaderWidget(QWidget):
+    def __init__(self, parent, host, port, bufsize, window, streams=1,
+                 digest=merkle.DEFAULT_ALGORITHM, compression=None,
+                 level=None, chunk_size=None):
+        QWidget.__init__(self, parent)
+        self.host = host
+        self.port = port
+        self.bufsize = bufsize
+        self.window = window
+        self.streams = streams
+        self.digest = digest
+        self.compression = compression
+        self.level = level
+        self.chunk_size = chunk_size
+        self.thread = None
+
+        self.host_selector = HostOptionsWidget(self, host, port)
+        self.file_selector = FileChooserWidget(self, bufsize, window,
+                                               streams)
+        self.buttons = DownloadButtons(self)
+        self.progress_bar = FileProgressBar(self)
+        self.progress_bar.initial_state()
+
+        main_layout = QVBoxLayout()
+        main_layout.addWidget(self.host_selector)
+        main_layout.addWidget(self.file_selector)
+        main_layout.addWidget(self.progress_bar)
+        main_layout.addWidget(self.buttons)
+        self.setLayout(main_layout)
+
+        self.buttons.start_sig.connect(self.start_upload)
+        self.buttons.stop_sig.connect(self.stop_and_reset_thread)
+
+    def start_upload(self):
+        log.logger.debug("Upload file!")
+        self.stop_and_reset_thread()
+        host, port = self.host_selector.get_host_info()
+        path, size = self.file_selector.get_selected_file()
+        bufsize = self.file_selector.get_bufsize()
+        window = self.file_selector.get_window()
+        streams = self.file_selector.get_streams()
+        self.thread = FileUploadThread(self)
+        self.thread.initialize(host, port, path, size, bufsize, window,
+                               streams, self.digest, self.compression,
+                               self.level, self.chunk_size)
+        self.thread.sig_finished.connect(self.transfer_complete)
+        self.thread.sig_progress.connect(self.progress_bar.update_progress)
+        self.thread.sig_status.connect(
+            self.progress_bar.update_transfer_status)
+        self.progress_bar.set_file(path)
+        self.thread.start()
+        self.buttons.stop.setEnabled(True)
+        self.buttons.start.setEnabled(False)
+
+    def transfer_complete(self):
+        self.progress_bar.reset_status()
+        self.buttons.stop.setEnabled(False)
+        self.buttons.start.setEnabled(True)
+
+    def stop_and_reset_thread(self):
+        if self.thread is not None:
+            if self.thread.isRunning():
+                self.thread.sig_finished.disconnect(self.transfer_complete)
+                self.thread.stop()
+                self.thread.wait()
+            self.thread.setParent(None)
+            self.thread = None
+            self.transfer_complete()
+
+
+class MainWindow(QMainWindow):
+    def __init__(self, parent, host, port, bufsize, window, pace,
+                 streams=1, digest=merkle.DEFAULT_ALGORITHM,
+                 compression=None, level=None, chunk_size=None):
+        QMainWindow.__init__(self, parent)
+        self.host = host
+        self.port = port
+        self.bufsize = bufsize
+        self.window = window
+        self.pace = pace
+        self.streams = streams
+        self.digest = digest
+        self.compression = compression
+        self.level = level
+        self.chunk_size = chunk_size
+
+        self.msg_uploader = MessageUploaderWidget(self, host, port, pace)
+        self.file_uploader = FileUploaderWidget(self, host, port, bufsize,
+                                                window, streams, digest,
+                                                compression, level,
+                                                chunk_size)
+
+        self.setCentralWidget(self.msg_uploader)
+
+        action_group = QActionGroup(self)
+        self.mode_menu = self.menuBar().addMenu("Mode")
+        self.msg_mode_action = create_action(action_group, "Send messages",
+                                             triggered=self.toggle_msg_view)
+        self.file_mode_action = create_action(action_group, "Upload files",
+                                              triggered=self.toggle_file_view)
+
+        self.view_state = 'msg'
+        self.msg_mode_action.setCheckable(True)
+        self.msg_mode_action.setChecked(True)
+        self.file_mode_action.setCheckable(True)
+        self.file_mode_action.setChecked(False)
+
+        add_actions(self.mode_menu, [self.msg_mode_action,
+                                     self.file_mode_action])
+        action_group.setExclusive(True)
+
+    def toggle_msg_view(self):
+        if self.view_state != 'msg':
+            self.msg_uploader = MessageUploaderWidget(self, host=self.host,
+                                                      port=self.port,
+                                                      pace=self.pace)
+            self.setCentralWidget(self.msg_uploader)
+            self.view_state = 'msg'
+
+    def toggle_file_view(self):
+        if self.view_state != 'files':
+            self.file_uploader = FileUploaderWidget(
+                self, host=self.host, port=self.port, bufsize=self.bufsize,
+                window=self.window, streams=self.streams, digest=self.digest,
+                compression=self.compression, level=self.level,
+                chunk_size=self.chunk_size)
+            self.setCentralWidget(self.file_uploader)
+            self.view_state = 'files'
+
+
+def run(host, port, bufsize, window, pace, streams=1,
+        digest=merkle.DEFAULT_ALGORITHM, compression=None, level=None,
+        chunk_size=None):
+    app = QApplication.instance()
+    if app is None:
+        app = QApplication(['UDP Client'])
+    widget = MainWindow(None, host, port, bufsize, window, pace, streams,
+                        digest, compression, level, chunk_size)
+    widget.resize(640, 60)
+    widget.show()
+    return app.exec_()
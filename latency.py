@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+
+"""Latency statistics for message runs."""
+
+import math
+import numpy as np
+
+# Sub-buckets per power of two are 2 ** (SUB_BITS - 1), about 3% precision
+SUB_BITS = 6
+# Sequence numbers this far below the highest one are still checked for
+# duplicates, older ones are assumed to be unique
+DEFAULT_WINDOW = 4096
+PERCENTILES = (50, 90, 99, 99.9)
+# Rows allocated up front at most, the count comes from the client
+MAX_INITIAL_RECORDS = 65536
+
+
+class LogHistogram:
+    """HDR-style histogram of non-negative integers.
+
+    Values below ``2 ** sub_bits`` get a bucket each, larger ones are
+    bucketed by their ``sub_bits`` most significant bits, so the relative
+    error is bounded whatever the magnitude. Only touched buckets are
+    stored, there are at most ``sub_bits * 2 ** (sub_bits - 1)`` per power
+    of two.
+    """
+
+    def __init__(self, sub_bits=SUB_BITS):
+        self.sub_bits = sub_bits
+        self.half = sub_bits - 1
+        self.counts = {}
+        self.count = 0
+        self.total = 0
+
+    def index(self, value):
+        shift = value.bit_length() - self.sub_bits
+        if shift <= 0:
+            return value
+        return (shift << self.half) + (value >> shift)
+
+    def value(self, index):
+        """Midpoint of the values falling in bucket ``index``."""
+        if index < 1 << self.sub_bits:
+            return index
+        shift = (index >> self.half) - 1
+        mantissa = index - (shift << self.half)
+        return (mantissa << shift) + (1 << (shift - 1))
+
+    def record(self, value):
+        index = self.index(max(value, 0))
+        self.counts[index] = self.counts.get(index, 0) + 1
+        self.count += 1
+        self.total += value
+
+    def percentile(self, q):
+        if not self.count:
+            return 0
+        rank = math.ceil(self.count * q / 100.0)
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= rank:
+                return self.value(index)
+
+
+class LatencyStats:
+    """Online summary of one message run, updated on every datagram.
+
+    Keeps count, mean and variance (Welford), min and max of the one-way
+    delay, a log-bucket histogram for percentiles, and the number of
+    duplicated and reordered messages. Delays are integer nanoseconds.
+    Memory use does not depend on the number of messages received.
+    """
+
+    def __init__(self, total, window=DEFAULT_WINDOW):
+        self.total = total
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+        self.histogram = LogHistogram()
+        self.highest = 0
+        self.duplicates = 0
+        self.reordered = 0
+        self.window = window
+        self.mask = (1 << window) - 1
+        # Bit i is set when sequence number ``highest - i`` was seen
+        self.seen = 0
+
+    def add(self, seq, delay):
+        """Account message ``seq`` received ``delay`` ns after it was
+        sent."""
+        if seq > self.highest:
+            gap = seq - self.highest
+            if gap >= self.window:
+                # Shifting by a client-chosen gap would build a huge int
+                self.seen = 1
+            else:
+                self.seen = ((self.seen << gap) | 1) & self.mask
+            self.highest = seq
+        else:
+            offset = self.highest - seq
+            if offset < self.window:
+                if self.seen >> offset & 1:
+                    self.duplicates += 1
+                    return
+                self.seen |= 1 << offset
+            self.reordered += 1
+
+        self.count += 1
+        diff = delay - self.mean
+        self.mean += diff / self.count
+        self.m2 += diff * (delay - self.mean)
+        self.min = min(self.min, delay)
+        self.max = max(self.max, delay)
+        self.histogram.record(delay)
+
+    @property
+    def variance(self):
+        return self.m2 / (self.count - 1) if self.count > 1 else 0.0
+
+    @property
+    def lost(self):
+        return max(self.total - self.count, 0)
+
+    def percentile(self, q):
+        """Delay in ns below which ``q`` percent of messages fall."""
+        value = self.histogram.percentile(q)
+        return min(max(value, self.min), self.max)
+
+
+class MessageRecords:
+    """Exact per-message records of a run, kept as NumPy columns.
+
+    Rows hold the sequence number, the send time and the arrival time, both
+    in epoch nanoseconds. Room for ``capacity`` rows, at most
+    ``MAX_INITIAL_RECORDS``, is allocated up front and doubled whenever it
+    runs out.
+    """
+
+    def __init__(self, capacity):
+        capacity = max(1, min(capacity, MAX_INITIAL_RECORDS))
+        self.columns = np.empty((3, capacity), dtype=np.int64)
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def append(self, seq, sent, arrival):
+        if self.size == self.columns.shape[1]:
+            columns = np.empty((3, 2 * self.size), dtype=np.int64)
+            columns[:, :self.size] = self.columns
+            self.columns = columns
+        self.columns[:, self.size] = (seq, sent, arrival)
+        self.size += 1
+
+    def arrays(self):
+        """Sequence, send and arrival columns, in arrival order."""
+        return self.columns[:, :self.size]
+
+
+def jitter(delay):
+    """Interarrival jitter of RFC 3550, section 6.4.1, after the last
+    message.
+
+    J(i) = J(i - 1) + (|D(i - 1, i)| - J(i - 1)) / 16 unrolls into a
+    weighted sum of the delay differences between consecutive arrivals.
+    """
+    diff = np.abs(np.diff(delay))
+    weights = (15 / 16) ** np.arange(diff.size - 1, -1, -1) / 16
+    return float(np.dot(diff, weights))
+
+
+def loss_runs(seq, total):
+    """Lengths of the runs of consecutive sequence numbers never
+    received.
+
+    Runs are the gaps between the distinct sequence numbers received, the
+    ``total`` announced by the client is only the end of the last one.
+    """
+    received = np.unique(seq[(seq >= 1) & (seq <= total)])
+    bounds = np.concatenate(([0], received, [total + 1]))
+    gaps = np.diff(bounds) - 1
+    return gaps[gaps > 0]
+
+
+def analyze(seq, sent, arrival, total):
+    """Vectorized statistics of a run given its columns in arrival order.
+
+    Delays are returned in seconds along with the summary values.
+    """
+    delay = (arrival - sent) / 1e9
+    unique = np.unique(seq).size
+    runs = loss_runs(seq, total)
+    highest = np.maximum.accumulate(seq)
+    result = {'delay': delay,
+              'mean': float(np.mean(delay)),
+              'std': float(np.std(delay, ddof=1)) if delay.size > 1 else 0.0,
+              'min': float(np.min(delay)),
+              'max': float(np.max(delay)),
+              'percentiles': dict(zip(PERCENTILES,
+                                      np.percentile(delay, PERCENTILES))),
+              'jitter': jitter(delay),
+              'lost': max(total - unique, 0),
+              'duplicates': seq.size - unique,
+              'reordered': int(np.count_nonzero(seq[1:] < highest[:-1])),
+              'loss_runs': runs.size,
+              'longest_loss_run': int(runs.max()) if runs.size else 0}
+    return result
@@ -0,0 +1,440 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Load generator simulating many UDP clients at once.
+
+Every virtual client has a socket, and so a source port, of its own,
+which the server sees as a distinct client. Clients run a message run or a
+file upload, and start following a constant, Poisson or bursty arrival
+schedule. Message runs are asyncio datagram endpoints, uploads run a
+``transfer.FileUploader`` each on a thread, so they send what the client
+does. The clients can be spread over several processes, their results are
+aggregated into one JSON document.
+"""
+
+from __future__ import unicode_literals
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import asyncio
+import argparse
+import tempfile
+import threading
+import multiprocessing
+import os.path as osp
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+import log
+import wire
+import merkle
+import metrics
+import transfer
+import compression
+from client import chunk_size
+
+parser = argparse.ArgumentParser(
+    description='Simulate many concurrent UDP clients')
+parser.add_argument('--host',
+                    default='127.0.0.1',
+                    help="Server hostname")
+parser.add_argument('--port',
+                    default=10000,
+                    help="Server UDP port")
+parser.add_argument('--clients',
+                    default=1000,
+                    help="Number of virtual clients")
+parser.add_argument('--mode',
+                    default='messages',
+                    choices=['messages', 'upload', 'mixed'],
+                    help="What every client does, mixed alternates")
+parser.add_argument('--messages',
+                    default=100,
+                    help="Messages sent by every message client")
+parser.add_argument('--message-size',
+                    default=64,
+                    help="Size of every message in bytes")
+parser.add_argument('--message-interval',
+                    default=0.001,
+                    help="Seconds between two messages of a client")
+parser.add_argument('--file-size',
+                    default=65536,
+                    help="Bytes uploaded by every upload client")
+parser.add_argument('--window',
+                    default=16,
+                    help="Chunks in flight per upload, 1 for stop-and-wait")
+parser.add_argument('--streams',
+                    default=1,
+                    help="Byte ranges of every upload sent at once, each "
+                         "over its own socket")
+parser.add_argument('--digest',
+                    default=merkle.DEFAULT_ALGORITHM,
+                    choices=merkle.ALGORITHMS,
+                    help="Hash of the blocks of uploads")
+parser.add_argument('--compress',
+                    default='none',
+                    choices=['none'] + compression.CODECS,
+                    help="Compress upload chunks when the server agrees")
+parser.add_argument('--chunk-size',
+                    default=wire.CHUNK_SIZE,
+                    type=chunk_size,
+                    help="Bytes per upload chunk: a number, auto or jumbo, "
+                         "as for the client. auto probes the path once per "
+                         "upload")
+parser.add_argument('--upload-threads',
+                    default=64,
+                    help="Uploads run at once by every process, the others "
+                         "wait for one to finish")
+parser.add_argument('--arrival',
+                    default='constant',
+                    choices=['constant', 'poisson', 'bursty'],
+                    help="How client start times are spread")
+parser.add_argument('--rate',
+                    default=500.0,
+                    help="Clients started per second on average")
+parser.add_argument('--burst',
+                    default=100,
+                    help="Clients started together in bursty arrivals")
+parser.add_argument('--processes',
+                    default=1,
+                    help="Processes the clients are spread over")
+parser.add_argument('--timeout',
+                    default=60.0,
+                    help="Seconds after which a client is given up")
+parser.add_argument('--seed',
+                    default=1234,
+                    help="Seed of the arrival schedule and upload contents")
+parser.add_argument('--metrics-port',
+                    default=0,
+                    help="Metrics port of the server, to add its counters "
+                         "to the results")
+parser.add_argument('--output',
+                    default=None,
+                    help="File the results are written to instead of "
+                         "stdout")
+parser.add_argument('--log-level',
+                    default='WARNING',
+                    choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
+                    help="Logs are written to stderr")
+
+PERCENTILES = (50, 90, 99)
+# Send buffer of every upload socket, the default of the client
+UPLOAD_BUFSIZE = 212992
+# Server counters reported as a difference over the run
+SERVER_COUNTERS = ('datagrams', 'messages', 'chunks', 'parse_errors',
+                   'busy', 'reports', 'uploads', 'expired',
+                   'socket_drops')
+
+
+def schedule(clients, arrival, rate, burst, seed):
+    """Start time in seconds of every client, from the start of the run."""
+    if arrival == 'poisson':
+        rng = np.random.RandomState(seed)
+        return np.cumsum(rng.exponential(1.0 / rate, clients)) - 1.0 / rate
+    if arrival == 'bursty':
+        return (np.arange(clients) // burst) * (burst / rate)
+    return np.arange(clients) / rate
+
+
+class ClientProtocol(asyncio.DatagramProtocol):
+    """Queue up the datagrams received by one virtual client."""
+
+    def __init__(self):
+        self.received = asyncio.Queue()
+
+    def datagram_received(self, data, addr):
+        self.received.put_nowait(data)
+
+    def error_received(self, exc):
+        log.logger.debug("Socket error: %s", exc)
+
+
+class VirtualClient:
+    def __init__(self, loop, addr, session):
+        self.loop = loop
+        self.addr = addr
+        self.session = session
+        self.transport = None
+        self.protocol = None
+
+    async def open(self):
+        endpoint = self.loop.create_datagram_endpoint(
+            ClientProtocol, remote_addr=self.addr)
+        self.transport, self.protocol = await endpoint
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+
+    def send(self, data):
+        self.transport.sendto(data)
+
+    async def recv(self, timeout):
+        """Next datagram received, ``None`` after ``timeout`` seconds."""
+        try:
+            return await asyncio.wait_for(self.protocol.received.get(),
+                                          timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    async def negotiate(self, **params):
+        self.send(wire.encode_hello(self.session, **params))
+        return wire.read_hello(await self.recv(wire.HELLO_TIMEOUT))
+
+    async def send_messages(self, num_messages, message, interval):
+        fmt = (await self.negotiate())['format']
+        for i in range(num_messages):
+            self.send(wire.encode_message(fmt, self.session, i + 1,
+                                          num_messages, time.time_ns(),
+                                          message))
+            await asyncio.sleep(interval)
+        return {'format': fmt, 'sent': num_messages,
+                'bytes': num_messages * len(message)}
+
+
+def client_kind(mode, index):
+    if mode == 'mixed':
+        return ('messages', 'upload')[index % 2]
+    return mode
+
+
+def new_uploader(args, index, payload, hash_pool):
+    """Uploader of client ``index``, whose file is a link to ``payload``
+    named after it: the server stores it apart and the upload ID derived
+    from its path is the client's own."""
+    path = osp.join(osp.dirname(payload), 'loadgen_%d.bin' % index)
+    os.symlink(payload, path)
+    return transfer.FileUploader(
+        args['host'], args['port'], path, args['file_size'], UPLOAD_BUFSIZE,
+        args['window'], streams=args['streams'], digest=args['digest'],
+        compression=args['compression'], chunk_size=args['chunk_size'],
+        hash_pool=hash_pool)
+
+
+def run_upload(uploader, timeout):
+    """Run ``uploader`` on this thread, canceled ``timeout`` seconds after
+    it starts rather than after it was queued."""
+    timer = threading.Timer(timeout, uploader.cancel)
+    timer.start()
+    try:
+        return uploader.run()
+    finally:
+        timer.cancel()
+
+
+def upload_result(result):
+    """Entries of a ``FileUploader`` result kept by the load generator."""
+    keys = ('format', 'chunk_size', 'streams', 'compression', 'digest',
+            'retransmits', 'repaired', 'srtt', 'wire_bytes', 'elapsed',
+            'error')
+    summary = dict((key, result[key]) for key in keys if key in result)
+    summary['sent'] = result['chunks']
+    summary['bytes'] = result['size']
+    if result['canceled']:
+        summary['error'] = 'timeout'
+    return summary
+
+
+async def run_client(loop, args, index, start, payload, pool, hash_pool):
+    await asyncio.sleep(max(0.0, start - loop.time()))
+    session = random.getrandbits(32)
+    client = VirtualClient(loop, (args['host'], args['port']), session)
+    kind = client_kind(args['mode'], index)
+    result = {'kind': kind, 'ok': False}
+    started = time.perf_counter()
+    try:
+        if kind == 'messages':
+            await client.open()
+            coroutine = client.send_messages(
+                args['messages'], b'x' * args['message_size'],
+                args['message_interval'])
+            result.update(await asyncio.wait_for(coroutine,
+                                                 args['timeout']))
+        else:
+            uploader = new_uploader(args, index, payload, hash_pool)
+            result.update(upload_result(await loop.run_in_executor(
+                pool, run_upload, uploader, args['timeout'])))
+        result['ok'] = ('error' not in result and
+                        result.get('digest', 'OK') == 'OK')
+        if kind == 'upload' and result['digest'] is None:
+            result.setdefault('error', 'no digest reply')
+    except asyncio.TimeoutError:
+        result['error'] = 'timeout'
+    except OSError as e:
+        result['error'] = str(e)
+    finally:
+        client.close()
+    # Uploads are timed from their start, not from their turn for a thread
+    result.setdefault('elapsed', time.perf_counter() - started)
+    return result
+
+
+def run_process(args, starts, indices, results):
+    """Run the clients ``indices`` of the schedule in this process."""
+    # Forked processes would otherwise draw the same session ids
+    random.seed()
+    folder = tempfile.mkdtemp(prefix='loadgen-')
+    payload = osp.join(folder, 'payload.bin')
+    with open(payload, 'wb') as fp:
+        fp.write(np.random.RandomState(args['seed']).bytes(
+            args['file_size']))
+    uploads = sum(client_kind(args['mode'], index) == 'upload'
+                  for index in indices)
+    # Uploaders block: a bounded number of them run on threads, and all
+    # hash their blocks on the same workers
+    pool = ThreadPoolExecutor(
+        max_workers=max(1, min(uploads, args['upload_threads'])),
+        thread_name_prefix='upload')
+    hash_pool = ThreadPoolExecutor(max_workers=os.cpu_count() or 1,
+                                   thread_name_prefix='hasher')
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    origin = loop.time()
+    tasks = [run_client(loop, args, index, origin + starts[index], payload,
+                        pool, hash_pool)
+             for index in indices]
+    try:
+        results.put(loop.run_until_complete(asyncio.gather(*tasks)))
+    finally:
+        pool.shutdown(wait=True)
+        hash_pool.shutdown(wait=True)
+        loop.close()
+        shutil.rmtree(folder)
+
+
+def raise_file_limit():
+    # Every virtual client holds a socket open
+    try:
+        import resource
+    except ImportError:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def percentiles(values):
+    if not len(values):
+        return {}
+    return dict(('p%g' % q, float(value)) for q, value in
+                zip(PERCENTILES, np.percentile(values, PERCENTILES)))
+
+
+def aggregate(sessions, wall):
+    """Totals and distributions over all virtual clients."""
+    summary = {'clients': len(sessions), 'wall': wall}
+    for kind in ('messages', 'upload'):
+        group = [s for s in sessions if s['kind'] == kind]
+        if not group:
+            continue
+        sent = sum(s.get('sent', 0) for s in group)
+        sent_bytes = sum(s.get('bytes', 0) for s in group)
+        errors = {}
+        for s in group:
+            if 'error' in s:
+                errors[s['error']] = errors.get(s['error'], 0) + 1
+        summary[kind] = {
+            'clients': len(group),
+            'ok': sum(s['ok'] for s in group),
+            'errors': errors,
+            'datagrams_sent': sent,
+            'bytes_sent': sent_bytes,
+            'datagrams_per_second': sent / wall,
+            'mbps': sent_bytes * 8 / wall / 1e6,
+            'duration': percentiles([s['elapsed'] for s in group])}
+        if kind == 'upload':
+            summary[kind]['retransmits'] = sum(s.get('retransmits', 0)
+                                               for s in group)
+            summary[kind]['repaired'] = sum(s.get('repaired', 0)
+                                            for s in group)
+            summary[kind]['wire_bytes'] = sum(s.get('wire_bytes', 0)
+                                              for s in group)
+            summary[kind]['digest_failed'] = sum(
+                s.get('digest') == 'FAILED' for s in group)
+            summary[kind]['srtt'] = percentiles(
+                [s['srtt'] for s in group if s.get('srtt') is not None])
+    return summary
+
+
+def server_counters(host, port):
+    samples = metrics.scrape(host, port)
+    return dict((key, samples.get('udplab_%s_total' % key, 0))
+                for key in SERVER_COUNTERS)
+
+
+def generate(args):
+    starts = schedule(args['clients'], args['arrival'], args['rate'],
+                      args['burst'], args['seed'])
+    processes = max(1, min(args['processes'], args['clients']))
+    ctx = multiprocessing.get_context('fork')
+    results = ctx.Queue()
+    # Clients are dealt round-robin, so every process follows the schedule
+    workers = [ctx.Process(target=run_process, name='loadgen-%d' % i,
+                           args=(args, starts, range(i, args['clients'],
+                                                     processes),
+                                 results))
+               for i in range(processes)]
+    before = None
+    if args['metrics_port']:
+        before = server_counters(args['host'], args['metrics_port'])
+    started = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    sessions = []
+    for _ in workers:
+        sessions.extend(results.get())
+    wall = time.perf_counter() - started
+    for worker in workers:
+        worker.join()
+
+    summary = aggregate(sessions, wall)
+    summary['arrival'] = args['arrival']
+    summary['processes'] = processes
+    if before is not None:
+        # Reports of runs whose tail was lost only come at idle expiry
+        after = server_counters(args['host'], args['metrics_port'])
+        summary['server'] = dict((key, after[key] - before[key])
+                                 for key in SERVER_COUNTERS)
+        if 'messages' in summary:
+            sent = summary['messages']['datagrams_sent']
+            summary['messages']['loss'] = (
+                1 - summary['server']['messages'] / sent if sent else 0.0)
+    return summary
+
+
+if __name__ == '__main__':
+    options = parser.parse_args()
+    log.setup(options.log_level, stream=sys.stderr)
+    raise_file_limit()
+    args = {'host': options.host,
+            'port': int(options.port),
+            'clients': int(options.clients),
+            'mode': options.mode,
+            'messages': int(options.messages),
+            'message_size': int(options.message_size),
+            'message_interval': float(options.message_interval),
+            'file_size': int(options.file_size),
+            'window': int(options.window),
+            'streams': int(options.streams),
+            'digest': options.digest,
+            'compression': (None if options.compress == 'none'
+                            else options.compress),
+            'chunk_size': options.chunk_size,
+            'arrival': options.arrival,
+            'rate': float(options.rate),
+            'burst': int(options.burst),
+            'processes': int(options.processes),
+            'upload_threads': int(options.upload_threads),
+            'timeout': float(options.timeout),
+            'seed': int(options.seed),
+            'metrics_port': int(options.metrics_port)}
+    summary = generate(args)
+    if options.output is None:
+        print(json.dumps(summary, indent=2))
+    else:
+        with open(options.output, 'w') as fp:
+            json.dump(summary, fp, indent=2)
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+
+"""Logging shared by the UDP client and server.
+
+Records are put on a queue and written by a background thread, so a slow
+terminal or journal does not stall the sockets. Per-datagram events go
+through ``packets``, which samples and rate limits them before a record is
+even built.
+"""
+
+import os
+import sys
+import time
+import queue
+import atexit
+import logging
+import logging.handlers
+
+FORMAT = '%(asctime)s [%(processName)s] %(levelname)s: %(message)s'
+DEFAULT_SAMPLE = 100
+DEFAULT_RATE = 20
+
+logger = logging.getLogger('udplab')
+logger.propagate = False
+
+
+class PacketLog:
+    """Log at most one in ``sample`` calls, and at most ``rate`` per
+    second."""
+
+    def __init__(self, logger, sample=DEFAULT_SAMPLE, rate=DEFAULT_RATE):
+        self.logger = logger
+        self.enabled = False
+        self.configure(sample, rate)
+
+    def configure(self, sample, rate):
+        self.sample = max(1, sample)
+        self.rate = rate
+        self.tokens = rate
+        self.last = time.monotonic()
+        self.calls = 0
+
+    def __call__(self, msg, *args):
+        if not self.enabled:
+            return
+        self.calls += 1
+        if self.calls % self.sample:
+            return
+        now = time.monotonic()
+        self.tokens = min(self.rate, self.tokens +
+                          (now - self.last) * self.rate)
+        self.last = now
+        if self.tokens < 1:
+            return
+        self.tokens -= 1
+        self.logger.debug(msg, *args)
+
+
+packets = PacketLog(logging.getLogger('udplab.packet'))
+listener = None
+destination = sys.stdout
+
+
+def start():
+    global listener
+    records = queue.SimpleQueue()
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    logger.addHandler(logging.handlers.QueueHandler(records))
+    output = logging.StreamHandler(destination)
+    output.setFormatter(logging.Formatter(FORMAT))
+    listener = logging.handlers.QueueListener(records, output)
+    listener.start()
+
+
+def stop():
+    """Write out the records still queued."""
+    global listener
+    if listener is not None:
+        listener.stop()
+        listener = None
+
+
+def setup(level='INFO', silent=False, sample=DEFAULT_SAMPLE,
+          rate=DEFAULT_RATE, stream=sys.stdout):
+    """Configure logging for this process and its forked children.
+
+    Per-datagram events are only written at the DEBUG level. ``silent``
+    turns every record off, for benchmark runs. Records are written to
+    ``stream``.
+    """
+    global destination
+    packet_logger = packets.logger
+    destination = stream
+    if silent:
+        logger.disabled = packet_logger.disabled = True
+        packets.enabled = False
+        return
+    logger.setLevel(level)
+    packets.configure(sample, rate)
+    packets.enabled = logger.isEnabledFor(logging.DEBUG)
+    start()
+    atexit.register(stop)
+    if hasattr(os, 'register_at_fork'):
+        # The listener thread does not survive a fork
+        os.register_at_fork(after_in_child=start)
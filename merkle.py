@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+
+"""Per-block digests of uploads and their Merkle root.
+
+Files are cut into blocks of ``block_size`` bytes, each one hashed on its
+own so that a corrupted block can be told apart and sent again alone. The
+root hashes the block digests pairwise, level by level, up to a single
+digest standing for the whole file.
+"""
+
+import os
+import hashlib
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+ALGORITHMS = ['sha3_256', 'blake2b']
+DEFAULT_ALGORITHM = 'sha3_256'
+DEFAULT_BLOCK_SIZE = 1 << 20
+DIGEST_SIZE = 32
+
+
+def new(algorithm):
+    if algorithm == 'blake2b':
+        return hashlib.blake2b(digest_size=DIGEST_SIZE)
+    return hashlib.sha3_256()
+
+
+def digest(algorithm, data):
+    hasher = new(algorithm)
+    hasher.update(data)
+    return hasher.digest()
+
+
+def root(algorithm, leaves):
+    """Merkle root of the block digests ``leaves``, an odd digest out at
+    some level moves up as is."""
+    level = list(leaves) or [digest(algorithm, b'')]
+    while len(level) > 1:
+        parents = [digest(algorithm, level[i] + level[i + 1])
+                   for i in range(0, len(level) - 1, 2)]
+        if len(level) % 2:
+            parents.append(level[-1])
+        level = parents
+    return level[0]
+
+
+def whole_chunks(block_size, chunk):
+    """Block size of uploads cut into ``chunk`` byte chunks, blocks hold
+    whole chunks."""
+    return max(chunk, block_size // chunk * chunk)
+
+
+def num_blocks(size, block_size):
+    return max(1, -(-size // block_size))
+
+
+def chunk_range(offset, length, chunk, start, end):
+    """Sequence numbers of the chunks of a range of ``length`` bytes from
+    ``offset`` on that hold bytes ``start`` to ``end`` of the file."""
+    first = max(start, offset)
+    last = min(end, offset + length)
+    if first >= last:
+        return range(1, 1)
+    return range((first - offset) // chunk + 1,
+                 (last - offset - 1) // chunk + 2)
+
+
+def iter_blocks(fp, block_size, algorithm, workers=None, canceled=None,
+                pool=None):
+    """Digests of the consecutive blocks read from ``fp``, each one
+    yielded as soon as it and those before it are hashed.
+
+    Blocks are read here and hashed on ``workers`` threads, hashlib
+    releases the GIL on large buffers. At most two blocks per worker are
+    held in memory. Stops early once the ``canceled`` event is set.
+    The threads are those of ``pool`` when given, which callers hashing
+    at once may share, or else of a pool of their own. An empty file is
+    a single empty block.
+    """
+    workers = workers or os.cpu_count() or 1
+    if pool is None:
+        with ThreadPoolExecutor(max_workers=workers,
+                                thread_name_prefix='hasher') as pool:
+            yield from iter_blocks(fp, block_size, algorithm, workers,
+                                   canceled, pool)
+        return
+    futures = collections.deque()
+    block = fp.read(block_size)
+    if not block:
+        yield digest(algorithm, b'')
+    while block and not (canceled is not None and canceled.is_set()):
+        if len(futures) >= 2 * workers:
+            yield futures.popleft().result()
+        futures.append(pool.submit(digest, algorithm, block))
+        block = fp.read(block_size)
+    while futures:
+        yield futures.popleft().result()
+
+
+def hash_blocks(fp, block_size, algorithm, workers=None, canceled=None,
+                pool=None):
+    """Digests of the consecutive blocks read from ``fp``, hashed as by
+    ``iter_blocks``."""
+    return list(iter_blocks(fp, block_size, algorithm, workers, canceled,
+                            pool))
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+
+"""Prometheus text exposition of the server metrics over HTTP."""
+
+import os
+import asyncio
+import urllib.request
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+PROC_FILES = ('/proc/net/udp', '/proc/net/udp6')
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (key, value)
+                             for key, value in labels.items())
+
+
+def render(metrics):
+    """Render ``(name, type, help, samples)`` tuples, where each sample is
+    a ``(suffix, labels, value)`` tuple."""
+    lines = []
+    for name, kind, text, samples in metrics:
+        lines.append('# HELP %s %s' % (name, text))
+        lines.append('# TYPE %s %s' % (name, kind))
+        for suffix, labels, value in samples:
+            lines.append('%s%s%s %s' % (name, suffix, format_labels(labels),
+                                        repr(float(value))))
+    return '\n'.join(lines) + '\n'
+
+
+def parse(text):
+    """Samples of an exposition, keyed by name and labels as written."""
+    samples = {}
+    for line in text.splitlines():
+        if line and not line.startswith('#'):
+            name, value = line.rsplit(' ', 1)
+            samples[name] = float(value)
+    return samples
+
+
+def scrape(host, port, timeout=5.0):
+    url = 'http://%s:%d/metrics' % (host, port)
+    with urllib.request.urlopen(url, timeout=timeout) as response:
+        return parse(response.read().decode('utf-8'))
+
+
+def histogram_samples(histogram, total, bounds, scale=1.0):
+    """Cumulative Prometheus buckets of a ``latency.LogHistogram``.
+
+    Each log bucket is counted at its midpoint, values are divided by
+    ``scale`` to get them in the unit of ``bounds``.
+    """
+    counts = sorted((histogram.value(index) / scale, count)
+                    for index, count in histogram.counts.items())
+    samples = []
+    seen = 0
+    position = 0
+    for bound in bounds:
+        while position < len(counts) and counts[position][0] <= bound:
+            seen += counts[position][1]
+            position += 1
+        samples.append(('_bucket', {'le': repr(bound)}, seen))
+    samples.append(('_bucket', {'le': '+Inf'}, histogram.count))
+    samples.append(('_sum', {}, total / scale))
+    samples.append(('_count', {}, histogram.count))
+    return samples
+
+
+def socket_queue_stats(sock):
+    """Kernel receive queue bytes and overflow drops of a UDP socket.
+
+    They are read from the line of ``/proc/net/udp`` holding the inode of
+    the socket, so they are only available on Linux.
+    """
+    inode = str(os.fstat(sock.fileno()).st_ino)
+    for path in PROC_FILES:
+        try:
+            with open(path) as fp:
+                lines = fp.readlines()[1:]
+        except OSError:
+            continue
+        for line in lines:
+            fields = line.split()
+            if len(fields) > 12 and fields[9] == inode:
+                rx_queue = int(fields[4].split(':')[1], 16)
+                return {'rx_queue': rx_queue, 'drops': int(fields[12])}
+    return None
+
+
+class MetricsServer:
+    """Answer every HTTP request with the output of ``collect``."""
+
+    def __init__(self, collect):
+        self.collect = collect
+
+    async def handle(self, reader, writer):
+        try:
+            await reader.readuntil(b'\r\n\r\n')
+            body = render(self.collect()).encode('utf-8')
+            writer.write(b'HTTP/1.0 200 OK\r\n'
+                         b'Content-Type: ' + CONTENT_TYPE.encode() +
+                         b'\r\nContent-Length: ' + str(len(body)).encode() +
+                         b'\r\n\r\n' + body)
+            await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError,
+                ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+def listen(loop, collect, host, port):
+    server = MetricsServer(collect)
+    return loop.run_until_complete(
+        asyncio.start_server(server.handle, host, port))
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+
+"""Send pacing for message runs."""
+
+import time
+
+RATE_UNITS = ['messages', 'bits']
+# Waits shorter than this are spun, time.sleep overshoots them
+SPIN_THRESHOLD = 0.0005
+
+
+class TokenBucket:
+    """Token bucket refilled at ``rate`` tokens per second, holding at most
+    ``burst`` of them.
+
+    ``wait`` blocks until the tokens asked for are available. It sleeps for
+    most of the wait and spins for the last ``SPIN_THRESHOLD`` seconds, so
+    sends are released on time even at rates where one wait is shorter
+    than the scheduler granularity. A rate of 0 never waits.
+    """
+
+    def __init__(self, rate, burst=1):
+        # Waits for more tokens than it holds would never end
+        assert burst >= 1
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.perf_counter()
+
+    def refill(self, now):
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def wait(self, cost=1):
+        if not self.rate:
+            return
+        now = time.perf_counter()
+        self.refill(now)
+        if self.tokens < cost:
+            deadline = now + (cost - self.tokens) / self.rate
+            if deadline - now > SPIN_THRESHOLD:
+                time.sleep(deadline - now - SPIN_THRESHOLD)
+            while time.perf_counter() < deadline:
+                pass
+            self.refill(time.perf_counter())
+        self.tokens -= cost
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+
+"""Path MTU discovery for upload chunk sizes.
+
+On Linux the probe socket sets the don't-fragment bit, so the kernel
+refuses datagrams larger than the MTU it knows for the route and lowers it
+when a router answers with ICMP fragmentation needed. Candidate sizes are
+then tried from the largest down, each with a HELLO padded to that size:
+the first one the server answers went through whole. Other systems cannot
+forbid fragmentation and get ``SAFE_MTU``.
+"""
+
+import sys
+import errno
+import socket
+import random
+
+import wire
+
+# Linux values, the socket module only exposes them on some versions
+IP_MTU_DISCOVER = getattr(socket, 'IP_MTU_DISCOVER', 10)
+IP_PMTUDISC_DO = getattr(socket, 'IP_PMTUDISC_DO', 2)
+IP_MTU = getattr(socket, 'IP_MTU', 14)
+
+# IPv4 and UDP headers
+IP_UDP_OVERHEAD = 28
+# Largest IPv4 packet, loopback routes allow them whole
+MAX_MTU = 65535
+# Jumbo, Ethernet, PPPoE and the IPv6 minimum
+COMMON_MTUS = (9000, 1500, 1492, 1280)
+# Small enough for about any path
+SAFE_MTU = 1280
+PROBE_TIMEOUT = 0.3
+# Probes of one size before it is taken as too large
+PROBE_ATTEMPTS = 2
+
+
+def route_mtu(sock):
+    """MTU the kernel knows for the route of a connected ``sock``."""
+    return min(MAX_MTU, sock.getsockopt(socket.IPPROTO_IP, IP_MTU))
+
+
+def padded_hello(session, size):
+    """HELLO datagram of exactly ``size`` bytes."""
+    data = wire.encode_hello(session, pad='')
+    return wire.encode_hello(session, pad='x' * max(0, size - len(data)))
+
+
+def echo(sock, session, size):
+    """Whether the server answers a HELLO of ``size`` bytes sent whole."""
+    try:
+        sock.send(padded_hello(session, size))
+        sock.recv(wire.HELLO_BUFSIZE)
+    except socket.timeout:
+        return False
+    except OSError as e:
+        if e.errno in (errno.EMSGSIZE, errno.ECONNREFUSED):
+            return False
+        raise
+    return True
+
+
+def probe(addr, timeout=PROBE_TIMEOUT):
+    """Largest UDP payload that reaches the server at ``addr`` without IP
+    fragmentation, ``None`` when it answers none of the probes."""
+    if not sys.platform.startswith('linux'):
+        return SAFE_MTU - IP_UDP_OVERHEAD
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        sock.connect(addr)
+        sock.setsockopt(socket.IPPROTO_IP, IP_MTU_DISCOVER, IP_PMTUDISC_DO)
+        sock.settimeout(timeout)
+        session = random.getrandbits(32)
+        tried = set()
+        while True:
+            # ICMP answers to earlier probes may have lowered it
+            mtu = route_mtu(sock)
+            sizes = [size for size in (mtu,) + COMMON_MTUS
+                     if size <= mtu and size not in tried]
+            if not sizes:
+                return None
+            tried.add(sizes[0])
+            for _ in range(PROBE_ATTEMPTS):
+                if echo(sock, session, sizes[0] - IP_UDP_OVERHEAD):
+                    return sizes[0] - IP_UDP_OVERHEAD
+    finally:
+        sock.close()
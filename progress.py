@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+
+"""Coalesced progress reports of transfers.
+
+Transfers update their meter for every datagram or batch they send, which
+costs a clock read. Reports go out at most ``rate`` times per second, each
+with the cumulative counts, the throughput since the previous report and
+the time left at that pace, so a GUI gets a steady trickle of signals
+however fast the transfer runs.
+"""
+
+import time
+
+DEFAULT_RATE = 20.0
+# Weight of the last interval in the throughput, against jitter
+SMOOTHING = 0.5
+
+
+class ProgressMeter:
+    """Publish the progress of ``total`` units of work to ``callback``.
+
+    ``details``, when given, returns extra entries for every report, such
+    as loss figures, and is only called when one is sent.
+    """
+
+    def __init__(self, total, callback, unit='bytes', rate=DEFAULT_RATE,
+                 details=None):
+        self.total = total
+        self.callback = callback
+        self.unit = unit
+        self.interval = 1.0 / rate
+        self.details = details
+        self.done = 0
+        self.start = self.last = time.perf_counter()
+        self.last_done = 0
+        self.throughput = None
+
+    def update(self, done):
+        """Set the units done so far, reporting them when one is due."""
+        self.done = done
+        if self.callback is None:
+            return
+        now = time.perf_counter()
+        if now - self.last >= self.interval:
+            self.publish(now)
+
+    def finish(self):
+        """Report the final counts whatever the time since the last one."""
+        if self.callback is not None:
+            self.publish(time.perf_counter())
+
+    def publish(self, now):
+        elapsed = now - self.last
+        if elapsed > 0:
+            throughput = (self.done - self.last_done) / elapsed
+            if self.throughput is None:
+                self.throughput = throughput
+            else:
+                self.throughput += SMOOTHING * (throughput - self.throughput)
+        self.last = now
+        self.last_done = self.done
+        eta = None
+        if self.throughput:
+            eta = max(0, self.total - self.done) / self.throughput
+        report = {'done': self.done, 'total': self.total, 'unit': self.unit,
+                  'throughput': self.throughput or 0.0, 'eta': eta,
+                  'elapsed': now - self.start}
+        if self.details is not None:
+            report.update(self.details())
+        self.callback(report)
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+
+"""Batched datagram receive engine for the server.
+
+Instead of one asyncio callback and one new ``bytes`` object per datagram,
+the socket is drained in batches into a preallocated buffer ring whenever
+it becomes readable. Each datagram is handed to the protocol as a
+memoryview slice of its slot, and a whole batch shares one timestamp. On
+Linux a batch is read with a single ``recvmmsg`` call, elsewhere with
+``recvfrom_into`` calls until the socket would block.
+
+Slots are reused by the next batch, so handlers must copy whatever they
+keep past ``datagram_received``.
+"""
+
+import os
+import sys
+import time
+import errno
+import socket
+import ctypes
+import ctypes.util
+
+import log
+
+DEFAULT_BATCH = 64
+SLOT_SIZE = 65536
+SOCKADDR_SIZE = 128
+# Decoded client addresses kept, the cache starts over past this many
+MAX_ADDRS = 4096
+
+
+class iovec(ctypes.Structure):
+    _fields_ = [('iov_base', ctypes.c_void_p),
+                ('iov_len', ctypes.c_size_t)]
+
+
+class msghdr(ctypes.Structure):
+    _fields_ = [('msg_name', ctypes.c_void_p),
+                ('msg_namelen', ctypes.c_uint32),
+                ('msg_iov', ctypes.POINTER(iovec)),
+                ('msg_iovlen', ctypes.c_size_t),
+                ('msg_control', ctypes.c_void_p),
+                ('msg_controllen', ctypes.c_size_t),
+                ('msg_flags', ctypes.c_int)]
+
+
+class mmsghdr(ctypes.Structure):
+    _fields_ = [('msg_hdr', msghdr),
+                ('msg_len', ctypes.c_uint)]
+
+
+def load_libc():
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        libc.recvmmsg
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+
+libc = load_libc()
+
+
+def parse_sockaddr(raw):
+    family = int.from_bytes(raw[:2], sys.byteorder)
+    port = int.from_bytes(raw[2:4], 'big')
+    if family == socket.AF_INET6:
+        return (socket.inet_ntop(socket.AF_INET6, raw[8:24]), port,
+                int.from_bytes(raw[4:8], 'big'),
+                int.from_bytes(raw[24:28], sys.byteorder))
+    return socket.inet_ntoa(raw[4:8]), port
+
+
+class BatchTransport:
+    """The subset of an asyncio datagram transport the server uses."""
+
+    def __init__(self, loop, sock):
+        self.loop = loop
+        self.sock = sock
+
+    def get_extra_info(self, name, default=None):
+        if name == 'socket':
+            return self.sock
+        return default
+
+    def sendto(self, data, addr):
+        try:
+            self.sock.sendto(data, addr)
+        except (BlockingIOError, InterruptedError):
+            # Same outcome as a full send buffer on an unreliable socket
+            pass
+
+    def close(self):
+        self.loop.remove_reader(self.sock.fileno())
+        self.sock.close()
+
+
+class BatchReceiver:
+    def __init__(self, sock, protocol, batch=DEFAULT_BATCH):
+        self.sock = sock
+        self.protocol = protocol
+        self.batch = batch
+        self.buffer = bytearray(batch * SLOT_SIZE)
+        self.view = memoryview(self.buffer)
+        self.addrs = {}
+        if libc is not None:
+            self.setup_mmsg()
+
+    def setup_mmsg(self):
+        base = ctypes.addressof(
+            (ctypes.c_char * len(self.buffer)).from_buffer(self.buffer))
+        self.names = ctypes.create_string_buffer(self.batch * SOCKADDR_SIZE)
+        names = ctypes.addressof(self.names)
+        self.iovecs = (iovec * self.batch)()
+        self.msgs = (mmsghdr * self.batch)()
+        for i in range(self.batch):
+            self.iovecs[i].iov_base = base + i * SLOT_SIZE
+            self.iovecs[i].iov_len = SLOT_SIZE
+            hdr = self.msgs[i].msg_hdr
+            hdr.msg_name = names + i * SOCKADDR_SIZE
+            hdr.msg_namelen = SOCKADDR_SIZE
+            hdr.msg_iov = ctypes.pointer(self.iovecs[i])
+            hdr.msg_iovlen = 1
+
+    def address(self, raw):
+        # Clients send many datagrams, so decoded addresses are cached
+        addr = self.addrs.get(raw)
+        if addr is None:
+            if len(self.addrs) >= MAX_ADDRS:
+                self.addrs.clear()
+            addr = self.addrs[raw] = parse_sockaddr(raw)
+        return addr
+
+    def dispatch(self, data, addr, now):
+        # A handler failing on one datagram must not drop the rest of the
+        # batch, asyncio logs such errors and reads on as well
+        try:
+            self.protocol.datagram_received(data, addr, now)
+        except Exception:
+            log.logger.exception("Error handling a datagram from %s", addr)
+
+    def read_ready(self):
+        # One batch per wakeup: the reader fires again while datagrams are
+        # queued, which leaves room for the other callbacks of the loop.
+        if libc is not None:
+            self.read_mmsg()
+        else:
+            self.read_each()
+
+    def read_mmsg(self):
+        count = libc.recvmmsg(self.sock.fileno(), self.msgs, self.batch,
+                              socket.MSG_DONTWAIT, None)
+        if count < 0:
+            err = ctypes.get_errno()
+            if err in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            raise OSError(err, os.strerror(err))
+        now = time.time_ns()
+        for i in range(count):
+            hdr = self.msgs[i].msg_hdr
+            offset = i * SOCKADDR_SIZE
+            addr = self.address(
+                self.names[offset:offset + hdr.msg_namelen])
+            hdr.msg_namelen = SOCKADDR_SIZE
+            start = i * SLOT_SIZE
+            self.dispatch(self.view[start:start + self.msgs[i].msg_len],
+                          addr, now)
+
+    def read_each(self):
+        received = []
+        for i in range(self.batch):
+            slot = self.view[i * SLOT_SIZE:(i + 1) * SLOT_SIZE]
+            try:
+                length, addr = self.sock.recvfrom_into(slot)
+            except (BlockingIOError, InterruptedError):
+                break
+            received.append((slot[:length], addr))
+        now = time.time_ns()
+        for data, addr in received:
+            self.dispatch(data, addr, now)
+
+
+def listen(loop, protocol, local_addr, reuse_port=False,
+           batch=DEFAULT_BATCH):
+    """Bind a UDP socket and feed ``protocol`` through a BatchReceiver."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind(local_addr)
+    sock.setblocking(False)
+    transport = BatchTransport(loop, sock)
+    protocol.connection_made(transport)
+    receiver = BatchReceiver(sock, protocol, batch)
+    loop.add_reader(sock.fileno(), receiver.read_ready)
+    return transport, protocol
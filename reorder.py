@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+
+"""Per-upload reordering of file chunks received over UDP."""
+
+# Bytes past the first missing chunk accepted per upload
+DEFAULT_BUDGET = 8 * 1024 * 1024
+
+
+class ReorderBuffer:
+    """Track which chunks of an upload arrived and where the in-order
+    prefix ends.
+
+    Chunks are written straight at their file offset, so only a bitmap of
+    every sequence number seen so far is kept. It is used to drop
+    retransmitted duplicates, to build selective ACKs and to tell when the
+    gap before out-of-order chunks is filled. Chunks more than ``limit``
+    sequence numbers past the first missing one are refused and must be
+    sent again by the client.
+    """
+
+    def __init__(self, total, limit=None):
+        self.total = total
+        self.limit = limit
+        self.next_seq = 1
+        self.ahead = 0
+        self.duplicates = 0
+        self.refused = 0
+        self.received = bytearray(total // 8 + 1)
+
+    def __contains__(self, seq):
+        return bool(self.received[seq >> 3] & (1 << (seq & 7)))
+
+    @property
+    def depth(self):
+        """Number of chunks received past the first missing one."""
+        return self.ahead
+
+    @property
+    def complete(self):
+        return self.next_seq > self.total
+
+    def insert(self, seq):
+        """Mark ``seq`` as received, return False if it was a duplicate or
+        refused."""
+        if seq < 1 or seq > self.total or seq in self:
+            self.duplicates += 1
+            return False
+        if self.limit is not None and seq - self.next_seq > self.limit:
+            self.refused += 1
+            return False
+        self.received[seq >> 3] |= 1 << (seq & 7)
+        if seq != self.next_seq:
+            self.ahead += 1
+        return True
+
+    def restore(self, received):
+        """Take the chunks set in a ``received`` bitmap of the same layout,
+        kept by an earlier run, as arrived."""
+        self.received[:len(received)] = received
+        self.next_seq = 1
+        self.ahead = 0
+        self.advance()
+        arrived = bin(int.from_bytes(self.received, 'little')).count('1')
+        self.ahead = arrived - (self.next_seq - 1)
+
+    def forget(self, seqs):
+        """Take chunks back as missing, for them to be sent again."""
+        for seq in seqs:
+            self.received[seq >> 3] &= ~(1 << (seq & 7))
+        self.next_seq = min([self.next_seq] + list(seqs))
+        arrived = bin(int.from_bytes(self.received, 'little')).count('1')
+        self.ahead = arrived - (self.next_seq - 1)
+
+    def advance(self):
+        """Move past every chunk that is now in order.
+
+        Returns the ``range`` of sequence numbers that joined the in-order
+        prefix, which is empty while the first missing chunk is absent.
+        """
+        start = self.next_seq
+        if start > self.total or start not in self:
+            return range(start, start)
+        seq = start + 1
+        while seq <= self.total and seq in self:
+            seq += 1
+        self.ahead -= seq - start - 1
+        self.next_seq = seq
+        return range(start, seq)
+
+    def sack(self, window):
+        """Bitmap of the ``window`` sequence numbers after the in-order
+        prefix, in the layout of ``wire.sack_bitmap``."""
+        first = self.next_seq
+        lo, shift = first >> 3, first & 7
+        hi = ((first + window) >> 3) + 1
+        bits = int.from_bytes(self.received[lo:hi], 'little') >> shift
+        bits &= (1 << window) - 1
+        return bits.to_bytes((window + 7) // 8, 'little')
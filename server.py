@@ -4,15 +4,33 @@
 import os
 import sys
 import json
+import math
+import time
+import lzma
+import zlib
+import queue
 import base64
+import signal
 import socket
+import struct
 import hashlib
 import asyncio
 import argparse
 import datetime
-import numpy as np
 import os.path as osp
-import dateutil.parser as dateparser
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+
+import log
+import wire
+import reorder
+import timers
+import latency
+import merkle
+import compression
+import metrics
+import receiver
+from writer import WriterPool, DEFAULT_WORKERS, DEFAULT_QUEUE_SIZE
 
 if sys.version_info < (3, 6):
     import sha3
@@ -25,58 +43,691 @@ parser.add_argument('--port',
 parser.add_argument('--bufsize',
                     default=212992,
                     help="Size of input buffer")
+parser.add_argument('--reorder-budget',
+                    default=reorder.DEFAULT_BUDGET,
+                    help="Bytes past the first missing chunk accepted "
+                         "per upload")
+parser.add_argument('--max-upload-chunks',
+                    default=1 << 24,
+                    help="Most chunks of an upload, its bitmaps take a "
+                         "bit per chunk")
+parser.add_argument('--writers',
+                    default=DEFAULT_WORKERS,
+                    help="Threads doing file writes, hashing and reports")
+parser.add_argument('--write-queue',
+                    default=DEFAULT_QUEUE_SIZE,
+                    help="Pending disk jobs before uploads are told to "
+                         "back off")
+parser.add_argument('--engine',
+                    default='asyncio',
+                    choices=['asyncio', 'batch'],
+                    help="Receive datagrams through asyncio callbacks or in "
+                         "batches into a preallocated buffer ring")
+parser.add_argument('--batch',
+                    default=receiver.DEFAULT_BATCH,
+                    help="Datagrams read per call by the batch engine")
+parser.add_argument('--stats',
+                    default='full',
+                    choices=['full', 'summary'],
+                    help="Keep every message of a run for the report, or "
+                         "only constant-memory summary statistics")
+parser.add_argument('--idle-timeout',
+                    default=30.0,
+                    help="Seconds without datagrams after which a client's "
+                         "sessions are closed")
+parser.add_argument('--metrics-port',
+                    default=0,
+                    help="Serve Prometheus metrics over HTTP on this port, "
+                         "worker i of --workers uses port + i")
+parser.add_argument('--metrics-host',
+                    default='127.0.0.1',
+                    help="Address the metrics endpoint is bound to")
+parser.add_argument('--log-level',
+                    default='INFO',
+                    choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
+                    help="Per-datagram events are logged at DEBUG")
+parser.add_argument('--log-sample',
+                    default=log.DEFAULT_SAMPLE,
+                    help="Log one in this many per-datagram events")
+parser.add_argument('--log-rate',
+                    default=log.DEFAULT_RATE,
+                    help="Most per-datagram events logged per second")
+parser.add_argument('--silent',
+                    action="store_true",
+                    default=False,
+                    help="Do not log anything, for benchmark runs")
+parser.add_argument('--workers',
+                    default=1,
+                    help="Server processes sharing the port through "
+                         "SO_REUSEPORT")
 
 LOGGING_PATH = 'logs'
 UPLOADS_FOLDER = 'uploads'
+# Checkpoints of unfinished uploads, by upload ID
+RESUME_FOLDER = osp.join(UPLOADS_FOLDER, '.resume')
+CHECKPOINT_INTERVAL = 1.0
+# Chunks past the in-order prefix a resuming client is told about
+RESUME_WINDOW = 4096
+# Blocks asked for again per repair round
+MAX_REPAIR_BLOCKS = 256
+MAX_WINDOW = 4096
+# Largest receive buffer asked for to hold the windows of big chunks
+MAX_RCVBUF = 64 * 1024 * 1024
+reorder_budget = reorder.DEFAULT_BUDGET
+max_upload_chunks = 1 << 24
+writers = DEFAULT_WORKERS
+write_queue = DEFAULT_QUEUE_SIZE
+engine = 'asyncio'
+batch = receiver.DEFAULT_BATCH
+stats_mode = 'full'
+idle_timeout = 30.0
+# Whether other worker processes share the port
+sharded = False
+IDLE_TICK = 1.0
+# Bytes read back at once when the digest catches up with written chunks
+HASH_READ_SIZE = 1 << 20
+metrics_host = '127.0.0.1'
+metrics_port = 0
+DELAY_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0,
+                 5.0)
+writer_pool = None
+# Hashes the blocks of uploads as they are completed
+hash_pool = None
 # events = []
 
 events = {}
 file_uploads = {}
+peers = {}
+stats = {'datagrams': 0, 'bytes': 0, 'messages': 0, 'chunks': 0,
+         'busy': 0, 'reports': 0, 'uploads': 0, 'expired': 0,
+         'resumed': 0, 'repairs': 0, 'parse_errors': 0,
+         'chunk_bytes': 0, 'compressed': 0, 'decompress_seconds': 0.0}
+rates = {'datagrams': 0.0, 'bytes': 0.0}
+delays = latency.LogHistogram()
 
 
-def generate_report(addr):
-    event = events.pop(addr)
+def generate_report(addr, event):
+    if 'summary' in event:
+        return generate_summary_report(addr, event)
     now = datetime.datetime.now()
-    diff = now - event['initial_time']
-    seqs = sorted(event['seqs'], key=lambda x: x[-1])
-    # print(seqs)
-    print("Time elapsed: %gs" % (diff.microseconds / 1e6))
+    log.logger.info("Run from %s finished, time elapsed: %gs", addr,
+                    (time.time_ns() - event['initial_time']) / 1e9)
     filename = '_'.join([str(i) for i in addr] + [now.isoformat()]) + '.log'
-    lines = ['seq_num,elapsed_time']
-    values = []
-    for seq in seqs:
-        num_seq, send_time, arrival_time = seq
-        time_delta = arrival_time - send_time
-        values.append([int(num_seq), time_delta.microseconds / 1e6])
-        lines.append(','.join([str(num_seq),
-                               str(time_delta.microseconds / 1e6)]))
-    values = np.array(values)
-    mean = np.mean(values[:, 1])
-    lines.append('Mean Reception Time: %g' % (mean))
-    lines.append('Lost Objects: %d' % (event['num_messages'] -
-                                       values.shape[0]))
-    lines.append('Total Objects: %d' % (event['num_messages']))
-    lines = '\n'.join(lines)
+    seq, sent, arrival = event['records'].arrays()
+    result = latency.analyze(seq, sent, arrival, event['num_messages'])
+    footer = ['Mean Reception Time: %g' % result['mean'],
+              'Std Reception Time: %g' % result['std'],
+              'Min Reception Time: %g' % result['min'],
+              'Max Reception Time: %g' % result['max']]
+    for q, value in result['percentiles'].items():
+        footer.append('P%g Reception Time: %g' % (q, value))
+    footer += ['Jitter: %g' % result['jitter'],
+               'Lost Objects: %d' % result['lost'],
+               'Loss Runs: %d' % result['loss_runs'],
+               'Longest Loss Run: %d' % result['longest_loss_run'],
+               'Duplicate Objects: %d' % result['duplicates'],
+               'Reordered Objects: %d' % result['reordered'],
+               'Total Objects: %d' % event['num_messages']]
+    if event.get('expired'):
+        footer.append('Partial Report: client idle, missing tail lost')
+    # One format call per row over Python lists, np.savetxt formats each
+    # value through its own call and is several times slower
+    rows = map('%d,%.9g'.__mod__, zip(seq.tolist(), result['delay'].tolist()))
     with open(osp.join(LOGGING_PATH, filename), 'w') as fp:
-        fp.write(lines)
+        fp.write('\n'.join(['seq_num,elapsed_time', '\n'.join(rows)] +
+                           footer) + '\n')
+
+
+def generate_summary_report(addr, event):
+    now = datetime.datetime.now()
+    summary = event['summary']
+    log.logger.info("Run from %s finished, time elapsed: %gs", addr,
+                    (time.time_ns() - event['initial_time']) / 1e9)
+    filename = '_'.join([str(i) for i in addr] + [now.isoformat()]) + '.log'
+    lines = ['Mean Reception Time: %g' % (summary.mean / 1e9),
+             'Std Reception Time: %g' % (math.sqrt(summary.variance) / 1e9)]
+    if summary.count:
+        lines.append('Min Reception Time: %g' % (summary.min / 1e9))
+        lines.append('Max Reception Time: %g' % (summary.max / 1e9))
+    for q in latency.PERCENTILES:
+        lines.append('P%g Reception Time: %g' % (q,
+                                                 summary.percentile(q) / 1e9))
+    lines.append('Lost Objects: %d' % summary.lost)
+    lines.append('Duplicate Objects: %d' % summary.duplicates)
+    lines.append('Reordered Objects: %d' % summary.reordered)
+    lines.append('Total Objects: %d' % summary.total)
+    if event.get('expired'):
+        lines.append('Partial Report: client idle, missing tail lost')
+    with open(osp.join(LOGGING_PATH, filename), 'w') as fp:
+        fp.write('\n'.join(lines))
+
+
+def new_upload(filename, size, chunk_size, resume=None, algorithm=None,
+               block_size=merkle.DEFAULT_BLOCK_SIZE):
+    """State of an upload written to ``filename``, without streams yet.
+
+    Uploads with a ``resume`` path are checkpointed there. With an
+    ``algorithm`` the upload is checked block by block against a manifest
+    from the client, otherwise by a SHA3 digest of the whole file.
+    """
+    return {'filename': filename,
+            'fd': None,
+            'size': size,
+            'chunk_size': chunk_size,
+            'streams': {},
+            'addrs': set(),
+            'hashing': 0,
+            'hashed': 0,
+            'md5sum': hashlib.sha3_256() if algorithm is None else None,
+            'algorithm': algorithm,
+            'block_size': merkle.whole_chunks(block_size, chunk_size),
+            # Block index -> digest, or its future while being hashed
+            'blocks': {},
+            # Block index -> chunks of it not written yet
+            'remaining': {},
+            'manifest': {},
+            # Block index -> whether it matches the manifest, as soon as
+            # both its digest and its manifest entry are in
+            'checked': {},
+            'round': 0,
+            'repair': None,
+            'verifying': False,
+            'resume': resume,
+            'resumed': False,
+            'checkpointed': time.monotonic(),
+            # Thread CPU time spent decompressing its chunks
+            'cpu_time': 0.0}
+
+
+def add_stream(upload, offset, num_seqs):
+    """Add the stream carrying ``num_seqs`` chunks from byte ``offset`` on.
+
+    Streams of an upload cover consecutive ranges of the file, each one
+    numbers its chunks from 1 and has its own reorder buffer.
+    """
+    chunk_size = upload['chunk_size']
+    stream = {'offset': offset,
+              'num_seqs': num_seqs,
+              'chunks': reorder.ReorderBuffer(num_seqs,
+                                              reorder_budget // chunk_size),
+              'last': offset + num_seqs * chunk_size >= upload['size'],
+              # Chunks on disk, in the layout of the reorder buffer
+              'written': bytearray(num_seqs // 8 + 1),
+              'seg_write': 0}
+    upload['streams'][offset] = stream
+    return stream
+
+
+def stream_fits(upload, offset, num_seqs):
+    """Whether ``num_seqs`` chunks from byte ``offset`` on lie within the
+    upload, clear of its other streams."""
+    chunk_size = upload['chunk_size']
+    end = offset + num_seqs * chunk_size
+    if (offset % chunk_size or not 0 <= offset <= upload['size'] or
+            not 0 <= num_seqs <= -(-(upload['size'] - offset) //
+                                   chunk_size)):
+        return False
+    return all(end <= stream['offset'] or
+               offset >= stream['offset'] + stream['num_seqs'] * chunk_size
+               for stream in upload['streams'].values())
+
+
+def stream_length(upload, stream):
+    return min(upload['size'] - stream['offset'],
+               stream['num_seqs'] * upload['chunk_size'])
+
+
+def block_bounds(upload, index):
+    start = index * upload['block_size']
+    return start, min(upload['size'], start + upload['block_size'])
+
+
+def block_seqs(upload, index):
+    """Chunks of block ``index``, as ``(stream, seqs)`` pairs."""
+    start, end = block_bounds(upload, index)
+    for stream in list(upload['streams'].values()):
+        seqs = merkle.chunk_range(stream['offset'],
+                                  stream_length(upload, stream),
+                                  upload['chunk_size'], start, end)
+        if seqs:
+            yield stream, seqs
+
+
+def count_missing(upload, index):
+    """Chunks of block ``index`` not written yet."""
+    start, end = block_bounds(upload, index)
+    missing = -(-(end - start) // upload['chunk_size'])
+    for stream, seqs in block_seqs(upload, index):
+        written = stream['written']
+        missing -= sum(1 for seq in seqs
+                       if written[seq >> 3] & (1 << (seq & 7)))
+    return missing
+
+
+def hash_block(upload, index):
+    start, end = block_bounds(upload, index)
+    return merkle.digest(upload['algorithm'],
+                         os.pread(upload['fd'], end - start, start))
+
+
+def complete_chunk(upload, offset):
+    """Count a chunk written at ``offset`` for the first time, and hash its
+    block on the hash pool once it is the last one missing there."""
+    index = offset // upload['block_size']
+    remaining = upload['remaining'].pop(index, None)
+    if remaining is None:
+        remaining = count_missing(upload, index)
+    else:
+        remaining -= 1
+    if remaining > 0:
+        upload['remaining'][index] = remaining
+    else:
+        submit_block(upload, index)
+
+
+def submit_block(upload, index):
+    """Hash block ``index`` on the hash pool, then check it."""
+    future = hash_pool.submit(hash_block, upload, index)
+    upload['blocks'][index] = future
+    future.add_done_callback(lambda _: check_block(upload, index))
+
+
+def check_block(upload, index):
+    """Compare block ``index`` with the manifest once both its digest and
+    its manifest entry are in.
+
+    Runs on the thread that brings in the last of them. Both may check it,
+    with the same outcome.
+    """
+    value = upload['blocks'].get(index)
+    expected = upload['manifest'].get(index)
+    if value is None or expected is None:
+        return
+    if not isinstance(value, bytes):
+        if not value.done():
+            return
+        value = value.result()
+    upload['checked'][index] = value == expected
+    if value != expected:
+        log.logger.debug("Block %d of %s differs from its manifest", index,
+                         upload['filename'])
+
+
+def block_digests(upload, wait=True):
+    """Digests of the blocks hashed so far by index, including those still
+    being hashed unless ``wait`` is False."""
+    digests = {}
+    for index, value in list(upload['blocks'].items()):
+        if isinstance(value, bytes):
+            digests[index] = value
+        elif wait or value.done():
+            digests[index] = value.result()
+    return digests
+
+
+def failed_blocks(upload):
+    """Blocks missing or differing from the manifest, the first
+    ``MAX_REPAIR_BLOCKS`` of them.
+
+    Blocks were checked as they came in. Those that did not match then
+    are checked again, that check may predate their repair.
+    """
+    block_digests(upload)
+    failed = []
+    for index in range(merkle.num_blocks(upload['size'],
+                                         upload['block_size'])):
+        if not upload['checked'].get(index):
+            check_block(upload, index)
+        if not upload['checked'].get(index):
+            failed.append(index)
+            if len(failed) == MAX_REPAIR_BLOCKS:
+                break
+    return failed
+
+
+def forget_blocks(upload, failed):
+    """Take the chunks of ``failed`` blocks as never written, and return
+    their sequence numbers by stream offset."""
+    lost = {}
+    for index in failed:
+        upload['blocks'].pop(index, None)
+        upload['remaining'].pop(index, None)
+        upload['checked'].pop(index, None)
+        for stream, seqs in block_seqs(upload, index):
+            for seq in seqs:
+                stream['written'][seq >> 3] &= ~(1 << (seq & 7))
+            lost.setdefault(stream['offset'], []).extend(seqs)
+    return lost
+
+
+def resume_path(key):
+    return osp.join(RESUME_FOLDER, osp.basename(key) + '.json')
+
+
+def load_upload(key, filename, size):
+    """Upload ``key`` as checkpointed by an earlier run, ``None`` unless
+    there is one for the same file.
+
+    Its chunk size and block digests are kept, clients are told to use
+    them.
+    """
+    path = resume_path(key)
+    try:
+        with open(path) as fp:
+            state = json.load(fp)
+    except (OSError, ValueError):
+        return None
+    if ((state['filename'], state['size']) != (filename, size) or
+            not osp.exists(filename)):
+        return None
+    upload = new_upload(filename, size, state['chunk_size'], path,
+                        state.get('algorithm'),
+                        state.get('block_size', merkle.DEFAULT_BLOCK_SIZE))
+    upload['resumed'] = True
+    for index, value in state.get('blocks', {}).items():
+        upload['blocks'][int(index)] = bytes.fromhex(value)
+    for offset, num_seqs, written in state['streams']:
+        stream = add_stream(upload, offset, num_seqs)
+        stream['written'][:] = base64.b64decode(written)
+        stream['chunks'].restore(stream['written'])
+        stream['seg_write'] = stream['chunks'].next_seq - 1
+    return upload
+
+
+def checkpoint(upload):
+    """Save which chunks of an upload are on disk, to resume it later.
+
+    hashlib objects cannot be saved, so only how far the digest got is
+    kept: resuming hashes the chunks on disk again.
+    """
+    streams = [[stream['offset'], stream['num_seqs'],
+                str(base64.b64encode(stream['written']), 'ascii')]
+               for stream in list(upload['streams'].values())]
+    blocks = {index: value.hex()
+              for index, value in block_digests(upload, False).items()}
+    state = {'filename': upload['filename'], 'size': upload['size'],
+             'chunk_size': upload['chunk_size'], 'hashed': upload['hashed'],
+             'algorithm': upload['algorithm'],
+             'block_size': upload['block_size'], 'blocks': blocks,
+             'streams': streams}
+    with open(upload['resume'] + '.tmp', 'w') as fp:
+        json.dump(state, fp)
+    os.replace(upload['resume'] + '.tmp', upload['resume'])
+    upload['checkpointed'] = time.monotonic()
+
+
+def open_upload(upload):
+    """Create the destination of an upload with its size reserved, or
+    reopen the one of a resumed upload and hash what it holds."""
+    flags = os.O_RDWR | os.O_CREAT
+    if not upload['resumed']:
+        flags |= os.O_TRUNC
+    fd = os.open(upload['filename'], flags, 0o644)
+    try:
+        os.posix_fallocate(fd, 0, upload['size'])
+    except (AttributeError, OSError):
+        os.ftruncate(fd, upload['size'])
+    upload['fd'] = fd
+    if upload['algorithm'] is not None and not upload['size']:
+        # No chunk completes the single empty block of an empty file
+        submit_block(upload, 0)
+    if not upload['resumed']:
+        return
+    if upload['algorithm'] is None:
+        extend_digest(upload, None, None)
+        return
+    for index in range(merkle.num_blocks(upload['size'],
+                                         upload['block_size'])):
+        if index not in upload['blocks'] and not count_missing(upload,
+                                                               index):
+            submit_block(upload, index)
+
+
+def write_to_file(upload, stream, seq, chunk, codec=None):
+    """Write ``chunk`` at its offset, then hash its block once complete or
+    extend the streamed digest over the chunks of its stream now written
+    in order.
+
+    Chunks compressed with ``codec`` are inflated first. Those that do not
+    inflate to at most a chunk are left unwritten, the digest check asks
+    for their blocks again.
+    """
+    if codec is not None:
+        start = time.thread_time()
+        try:
+            chunk = compression.decompress(codec, chunk,
+                                           upload['chunk_size'])
+        except (ValueError, zlib.error, lzma.LZMAError) as e:
+            log.logger.warning("Chunk %d of %s not decompressed: %s", seq,
+                               upload['filename'], e)
+            return
+        finally:
+            upload['cpu_time'] += time.thread_time() - start
+    offset = stream['offset'] + (seq - 1) * upload['chunk_size']
+    os.pwrite(upload['fd'], chunk, offset)
+    fresh = not stream['written'][seq >> 3] & (1 << (seq & 7))
+    stream['written'][seq >> 3] |= 1 << (seq & 7)
+    if stream['last'] and seq == stream['num_seqs']:
+        size = offset + len(chunk)
+        if size != upload['size']:
+            os.ftruncate(upload['fd'], size)
+            upload['size'] = size
+    if upload['algorithm'] is not None:
+        if fresh:
+            complete_chunk(upload, offset)
+    elif extend_written(stream):
+        extend_digest(upload, offset, chunk)
+    if (upload['resume'] is not None and time.monotonic() -
+            upload['checkpointed'] >= CHECKPOINT_INTERVAL):
+        checkpoint(upload)
+
+
+def extend_written(stream):
+    """Move ``seg_write`` past the chunks of ``stream`` written in order,
+    and return whether it moved."""
+    written = stream['written']
+    seq = stream['seg_write']
+    while (seq < stream['num_seqs'] and
+           written[(seq + 1) >> 3] & (1 << ((seq + 1) & 7))):
+        seq += 1
+    if seq == stream['seg_write']:
+        return False
+    stream['seg_write'] = seq
+    return True
+
+
+def unwritten_blocks(upload):
+    """Blocks with chunks acknowledged but never written, such as those
+    that did not decompress, the first ``MAX_REPAIR_BLOCKS`` of them.
+
+    Only for uploads checked by a streamed digest, their chunks are all
+    written up to ``seg_write``.
+    """
+    failed = set()
+    for stream in list(upload['streams'].values()):
+        written = stream['written']
+        for seq in range(stream['seg_write'] + 1, stream['num_seqs'] + 1):
+            if not written[seq >> 3] & (1 << (seq & 7)):
+                offset = stream['offset'] + (seq - 1) * upload['chunk_size']
+                failed.add(offset // upload['block_size'])
+    return sorted(failed)[:MAX_REPAIR_BLOCKS]
+
+
+def extend_digest(upload, offset, chunk):
+    """Hash the file from where the digest stopped up to the first chunk
+    not written yet, ``chunk`` being the one just written at ``offset``.
+
+    The digest moves into the range of a stream once the previous ranges
+    are complete. The chunk that extends the prefix is hashed from memory,
+    chunks that arrived ahead of it were already written and are read
+    back.
+    """
+    chunk_size = upload['chunk_size']
+    position = upload['hashed']
+    while upload['hashing'] in upload['streams']:
+        stream = upload['streams'][upload['hashing']]
+        end = min(stream['offset'] + stream['seg_write'] * chunk_size,
+                  upload['size'])
+        if position == offset and end > position:
+            upload['md5sum'].update(chunk)
+            position += len(chunk)
+        while position < end:
+            data = os.pread(upload['fd'], min(HASH_READ_SIZE,
+                                              end - position), position)
+            upload['md5sum'].update(data)
+            position += len(data)
+        upload['hashed'] = position
+        if stream['seg_write'] < stream['num_seqs']:
+            break
+        upload['hashing'] = stream['offset'] + stream['num_seqs'] * chunk_size
+
+
+def close_upload(upload):
+    os.close(upload['fd'])
+    # Its number may go to another upload, which a late suspend or discard
+    # of this one would close
+    upload['fd'] = None
+    if upload['resume'] is not None and osp.exists(upload['resume']):
+        os.remove(upload['resume'])
+
+
+def suspend_upload(upload):
+    """Checkpoint an upload left unfinished and close its file."""
+    if upload['fd'] is not None:
+        block_digests(upload)
+        checkpoint(upload)
+        os.close(upload['fd'])
+
+
+def discard_upload(upload):
+    """Drop an upload that will not be completed."""
+    if upload['fd'] is None:
+        # Closed once complete, the peer expired while it was verified
+        return
+    os.close(upload['fd'])
+    os.remove(upload['filename'])
 
 
 class EchoServerProtocol:
     def connection_made(self, transport):
         self.transport = transport
-        # print(self.transport.get_extra_info('socket'))
-        print(bufsize)
+        self.loop = asyncio.get_event_loop()
         sock = self.transport.get_extra_info('socket')
-        sock.settimeout(5.0)
-        # snd_bufsize = sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
-        # print(snd_bufsize)
         sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, bufsize)
+        self.rcvbuf = bufsize
+        log.logger.info("Receive buffer: %d bytes",
+                        sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF))
+        self.idle = timers.TimerWheel(idle_timeout, self.expire, IDLE_TICK)
+        self.last_tick = time.monotonic()
+        self.last_counts = {key: stats[key] for key in rates}
+        self.loop.call_later(IDLE_TICK, self.tick)
+
+    def tick(self):
+        now = time.monotonic()
+        elapsed = now - self.last_tick
+        for key in rates:
+            rates[key] = (stats[key] - self.last_counts[key]) / elapsed
+            self.last_counts[key] = stats[key]
+        self.last_tick = now
+        self.idle.advance()
+        self.loop.call_later(IDLE_TICK, self.tick)
+
+    def expire(self, addr):
+        """Close the sessions of a client that went quiet, the last
+        datagrams of a run or an upload may never come."""
+        stats['expired'] += 1
+        peer = peers.pop(addr, {})
+        if addr in events:
+            event = events.pop(addr)
+            event['expired'] = True
+            stats['reports'] += 1
+            writer_pool.submit(addr, generate_report, addr, event)
+        key = peer.get('upload', addr)
+        if key in file_uploads:
+            # A multi-stream upload goes once all of its clients are gone,
+            # uploads with an ID are kept on disk to be resumed
+            upload = file_uploads[key]
+            upload['addrs'].discard(addr)
+            if not upload['addrs']:
+                file_uploads.pop(key)
+                if upload['resume'] is not None:
+                    writer_pool.submit(key, suspend_upload, upload)
+                else:
+                    writer_pool.submit(key, discard_upload, upload)
+
+    def collect_metrics(self):
+        sock = self.transport.get_extra_info('socket')
+        depths = [stream['chunks'].depth
+                  for upload in file_uploads.values()
+                  for stream in upload['streams'].values()]
+        counters = [('datagrams', "Datagrams received"),
+                    ('bytes', "Bytes received"),
+                    ('parse_errors', "Datagrams that could not be parsed"),
+                    ('messages', "Messages received"),
+                    ('chunks', "File chunks received"),
+                    ('busy', "Chunks refused because of a full write queue"),
+                    ('reports', "Message run reports written"),
+                    ('uploads', "Uploads finished"),
+                    ('expired', "Clients whose sessions expired"),
+                    ('resumed', "Uploads resumed from a checkpoint"),
+                    ('repairs', "Upload blocks asked for again"),
+                    ('chunk_bytes', "File chunk bytes received, "
+                                    "as sent on the wire"),
+                    ('compressed', "File chunks received compressed"),
+                    ('decompress_seconds', "CPU seconds spent "
+                                           "decompressing file chunks")]
+        samples = [('udplab_%s_total' % key, 'counter', text,
+                    [('', {}, stats[key])]) for key, text in counters]
+        samples += [
+            ('udplab_datagrams_per_second', 'gauge',
+             "Datagrams received during the last second",
+             [('', {}, rates['datagrams'])]),
+            ('udplab_bytes_per_second', 'gauge',
+             "Bytes received during the last second",
+             [('', {}, rates['bytes'])]),
+            ('udplab_active_sessions', 'gauge', "Sessions in progress",
+             [('', {'kind': 'messages'}, len(events)),
+              ('', {'kind': 'uploads'}, len(file_uploads))]),
+            ('udplab_reorder_depth', 'gauge',
+             "Chunks received past the first missing one, all uploads",
+             [('', {}, sum(depths))]),
+            ('udplab_reorder_depth_max', 'gauge',
+             "Chunks received past the first missing one, worst upload",
+             [('', {}, max(depths, default=0))]),
+            ('udplab_write_queue_depth', 'gauge',
+             "Disk jobs waiting for the writer pool",
+             [('', {}, writer_pool.depth)]),
+            ('udplab_delay_seconds', 'histogram',
+             "One-way delay of received messages",
+             metrics.histogram_samples(delays, delays.total, DELAY_BUCKETS,
+                                       1e9)),
+            ('udplab_socket_receive_buffer_bytes', 'gauge',
+             "Effective SO_RCVBUF of the server socket",
+             [('', {}, sock.getsockopt(socket.SOL_SOCKET,
+                                       socket.SO_RCVBUF))])]
+        kernel = metrics.socket_queue_stats(sock)
+        if kernel is not None:
+            samples += [
+                ('udplab_socket_queue_bytes', 'gauge',
+                 "Bytes waiting in the kernel receive queue",
+                 [('', {}, kernel['rx_queue'])]),
+                ('udplab_socket_drops_total', 'counter',
+                 "Datagrams dropped by the kernel, receive queue overflow",
+                 [('', {}, kernel['drops'])])]
+        return samples
 
-    def datagram_received(self, data, addr):
-        now = datetime.datetime.now()
-        message = data.decode()
-        # print(message)
-        data = json.loads(message)
+    def datagram_received(self, data, addr, now=None):
+        if now is None:
+            now = time.time_ns()
+        stats['datagrams'] += 1
+        stats['bytes'] += len(data)
+        self.idle.touch(addr)
+        try:
+            data = wire.decode(data)
+        except (ValueError, KeyError, struct.error):
+            stats['parse_errors'] += 1
+            log.packets("Malformed datagram from %s", addr)
+            return
 
         if data['type'] == 'MSG':
             self.handle_msg(data, addr, now)
@@ -84,74 +735,412 @@ class EchoServerProtocol:
             self.handle_upload(data, addr)
         elif data['type'] == 'MD5':
             self.handle_digest(data, addr)
+        elif data['type'] == 'BLOCKS':
+            self.handle_blocks(data, addr)
+        elif data['type'] == 'HELLO':
+            self.handle_hello(data, addr)
+
+    def handle_hello(self, data, addr):
+        params = {}
+        # Padding of path MTU probes
+        data.pop('pad', None)
+        if 'chunk_size' in data:
+            params['chunk_size'] = max(wire.MIN_CHUNK_SIZE, min(
+                int(data['chunk_size']),
+                wire.max_chunk_size(wire.pick_format(data))))
+            data['chunk_size'] = params['chunk_size']
+        if data.get('compression') in compression.CODECS:
+            params['compression'] = data['compression']
+        else:
+            data.pop('compression', None)
+        reply = None
+        if 'upload' in data and not sharded:
+            reply = self.join_upload(data, addr)
+        if reply is not None:
+            # Resumed uploads keep the chunk size they were started with
+            params.update(reply)
+            data['chunk_size'] = params['chunk_size']
+        elif 'upload' in data:
+            # The kernel spreads the sockets of an upload over sharded
+            # workers by address, none of them would get all of its chunks.
+            # Other uploads are refused for ranges out of bounds. Without
+            # an ID clients upload over a single socket.
+            data.pop('upload')
+            data.pop('offset', None)
+        if 'window' in data:
+            # Chunks past the reorder budget would be refused
+            chunk_size = params.get('chunk_size', wire.CHUNK_SIZE)
+            params['window'] = max(1, min(int(data['window']), MAX_WINDOW,
+                                          reorder_budget // chunk_size))
+            data['window'] = params['window']
+            self.fit_receive_buffer(params['window'] *
+                                    (chunk_size + wire.HEADER_SIZE))
+        peers[addr] = data
+        self.transport.sendto(wire.answer_hello(data, **params), addr)
+
+    def fit_receive_buffer(self, size):
+        """Grow the receive buffer of the socket to hold ``size`` bytes of
+        datagrams, up to ``MAX_RCVBUF``. The kernel caps it further."""
+        size = min(size, MAX_RCVBUF)
+        if size <= self.rcvbuf:
+            return
+        sock = self.transport.get_extra_info('socket')
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, size)
+        self.rcvbuf = size
+        log.logger.info("Receive buffer: %d bytes",
+                        sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF))
+
+    def join_upload(self, data, addr):
+        """Add the peer of a HELLO naming an upload ID to that upload, and
+        return what the server holds of it, ``None`` when it is refused.
+
+        Several peers upload byte ranges of the same file, each one from
+        the ``offset`` it announces, and any of them sends the digest.
+        Uploads left unfinished by an earlier run or client are picked up
+        from their checkpoint: peers without an offset get the ranges
+        and chunk size in use, those of a range the chunks held past its
+        in-order prefix.
+        """
+        if ('size' not in data or 'chunk_size' not in data or
+                'offset' in data and 'total_seq' not in data):
+            return None
+        key = data['upload']
+        upload = file_uploads.get(key)
+        fresh = upload is None
+        if fresh:
+            filename = osp.join(UPLOADS_FOLDER,
+                                osp.basename(data.get('file', key)))
+            size = int(data['size'])
+            chunk_size = int(data['chunk_size'])
+            if not 0 <= size <= max_upload_chunks * chunk_size:
+                return None
+            upload = load_upload(key, filename, size)
+            if upload is None:
+                algorithm = data.get('digest')
+                if algorithm not in merkle.ALGORITHMS:
+                    algorithm = None
+                upload = new_upload(filename, size, chunk_size,
+                                    resume_path(key), algorithm,
+                                    int(data.get('block_size',
+                                                 merkle.DEFAULT_BLOCK_SIZE)))
+        if ('offset' in data and
+                int(data['offset']) not in upload['streams'] and
+                not stream_fits(upload, int(data['offset']),
+                                int(data['total_seq']))):
+            return None
+        if fresh:
+            if upload['resumed']:
+                stats['resumed'] += 1
+                log.logger.info("Resuming upload %s", upload['filename'])
+            file_uploads[key] = upload
+            writer_pool.submit(key, open_upload, upload)
+        upload['addrs'].add(addr)
+        reply = {'upload': key, 'chunk_size': upload['chunk_size'],
+                 'block_size': upload['block_size']}
+        if upload['algorithm'] is not None:
+            reply['digest'] = upload['algorithm']
+        if 'offset' not in data:
+            reply['ranges'] = sorted([stream['offset'], stream['num_seqs']]
+                                     for stream in upload['streams'].values())
+            return reply
+        offset = int(data['offset'])
+        if offset not in upload['streams']:
+            add_stream(upload, offset, int(data['total_seq']))
+        chunks = upload['streams'][offset]['chunks']
+        window = min(chunks.total, RESUME_WINDOW)
+        reply['ack'] = chunks.next_seq - 1
+        reply['held'] = str(base64.b64encode(chunks.sack(window)), 'ascii')
+        return reply
 
     def handle_msg(self, data, addr, now):
         total_seq = data['total_messages']
         timestamp = data['timestamp']
         seq = data['sequence_num']
-        message = data['message']
         if addr not in events:
-            events[addr] = {'num_messages': int(total_seq), 'seqs': [],
+            events[addr] = {'num_messages': int(total_seq),
                             'initial_time': now}
-        timestamp = dateparser.parse(timestamp)
-        diff = now - timestamp
-        print(diff.microseconds / 1000)
-        events[addr]['seqs'].append([seq, timestamp, now])
-        print('Received %r from %s - %s' % (message, addr,
-                                            datetime.datetime.now()))
+            if stats_mode == 'summary':
+                events[addr]['summary'] = latency.LatencyStats(
+                    int(total_seq))
+            else:
+                events[addr]['records'] = latency.MessageRecords(
+                    int(total_seq))
+        sent = wire.timestamp_ns(timestamp)
+        delay = now - sent
+        if stats_mode == 'summary':
+            events[addr]['summary'].add(int(seq), delay)
+        else:
+            events[addr]['records'].append(int(seq), sent, now)
+        delays.record(delay)
+        log.packets('Received message %s/%s from %s, %.3f ms', seq,
+                    total_seq, addr, delay / 1e6)
+        stats['messages'] += 1
         if events[addr]['num_messages'] == int(seq):
-            generate_report(addr)
+            stats['reports'] += 1
+            writer_pool.submit(addr, generate_report, addr, events.pop(addr))
 
     def handle_upload(self, data, addr):
-        print(data['seq_num'])
-        if addr not in file_uploads:
-            file_uploads[addr] = {'num_seqs': data['total_seq'], 'chunks': [],
-                                  'filename': osp.join(UPLOADS_FOLDER,
-                                                       data['file']),
-                                  'seg_write': 0,
-                                  'md5sum': hashlib.sha3_256()}
-        chunk = base64.b64decode(bytes(data['payload'], 'utf-8'))
-        file_uploads[addr]['chunks'].append([data['seq_num'], chunk])
-        file_uploads[addr]['chunks'] = sorted(file_uploads[addr]['chunks'],
-                                              key=lambda x: x[0])
-        self.write_to_file(addr)
-        self.transport.sendto(b'ACK', addr)
-
-    def write_to_file(self, addr):
-        data = file_uploads[addr]
-        last_seg = data['seg_write']
-        i = 0
-        cur_seg = data['chunks'][i][0]
-        with open(data['filename'], 'ab') as fp:
-            while cur_seg == last_seg + 1:
-                data['md5sum'].update(data['chunks'][i][1])
-                fp.write(data['chunks'][i][1])
-                i += 1
-                last_seg = cur_seg
-                try:
-                    cur_seg = data['chunks'][i][0]
-                except IndexError:
-                    break
-                # last_seg, cur_seg = cur_seg, cur_seg + 1
-        data['chunks'] = data['chunks'][cur_seg + 1:]
-        data['seg_write'] = last_seg
+        log.packets('Received chunk %s/%s from %s', data['seq_num'],
+                    data['total_seq'], addr)
+        peer = peers.get(addr, {})
+        key = peer.get('upload', addr)
+        if key not in file_uploads:
+            if ('upload' in peer or
+                    data.get('session', -1) == peer.get('finished')):
+                # Late retransmission of an upload that already completed
+                return
+            filename = data.get('file', peer.get('file'))
+            if filename is None:
+                filename = 'upload_%d' % data.get('session', 0)
+            filename = osp.join(UPLOADS_FOLDER, osp.basename(filename))
+            total_seq = int(data['total_seq'])
+            chunk_size = int(peer.get('chunk_size', wire.CHUNK_SIZE))
+            size = int(peer.get('size', total_seq * chunk_size))
+            if (not 1 <= total_seq <= max_upload_chunks or
+                    total_seq != -(-size // chunk_size)):
+                # The bitmaps of the upload are sized from it
+                log.packets("Chunk from %s with a wrong total %d", addr,
+                            total_seq)
+                return
+            upload = new_upload(filename, size, chunk_size)
+            upload['addrs'].add(addr)
+            add_stream(upload, 0, total_seq)
+            file_uploads[key] = upload
+            writer_pool.submit(key, open_upload, upload)
+        upload = file_uploads[key]
+        stream = upload['streams'].get(int(peer.get('offset', 0)))
+        if stream is None:
+            # Chunks of a range no HELLO announced
+            return
+        seq = int(data['seq_num'])
+        windowed = peer.get('window', 1) > 1
+        # Stop-and-wait peers have a single chunk in flight, so only
+        # windowed ones can fill the write queue and are asked to back off.
+        busy = windowed and writer_pool.full
+        codec = None
+        if data.get('flags', 0) & wire.FLAG_COMPRESSED:
+            codec = peer.get('compression')
+            if codec is None:
+                # Compressed with a codec this session did not agree on
+                return
+            stats['compressed'] += 1
+        stats['chunks'] += 1
+        stats['chunk_bytes'] += len(data['payload'])
+        stats['busy'] += busy
+        if not busy and stream['chunks'].insert(seq):
+            stream['chunks'].advance()
+            chunk = data['payload']
+            if isinstance(chunk, memoryview) and not chunk.readonly:
+                # A slot of the batch engine ring, reused after this call
+                chunk = bytes(chunk)
+            writer_pool.submit(key, write_to_file, upload, stream, seq,
+                               chunk, codec)
+        self.acknowledge(data, addr, stream['chunks'], busy)
+
+    def acknowledge(self, data, addr, chunks, busy=False):
+        peer = peers.get(addr, {})
+        if 'window' not in peer:
+            # Legacy stop-and-wait peers expect a bare ACK
+            self.transport.sendto(b'ACK', addr)
+            return
+        window = peer['window']
+        flags = wire.FLAG_BUSY if busy else 0
+        self.transport.sendto(wire.encode_sack(data.get('session', 0),
+                                               chunks.next_seq - 1,
+                                               chunks.total,
+                                               chunks.sack(window), flags),
+                              addr)
+
+    def handle_blocks(self, data, addr):
+        """Store a piece of the block manifest of an upload."""
+        upload = file_uploads.get(peers.get(addr, {}).get('upload'))
+        if upload is None or upload['algorithm'] is None:
+            return
+        payload = bytes(data['payload'])
+        count = len(payload) // merkle.DIGEST_SIZE
+        for i in range(count):
+            upload['manifest'][data['first'] + i] = payload[
+                i * merkle.DIGEST_SIZE:(i + 1) * merkle.DIGEST_SIZE]
+            check_block(upload, data['first'] + i)
+        self.transport.sendto(wire.encode_sack(data['session'],
+                                               data['first'] + count,
+                                               data['total_blocks'], b''),
+                              addr)
 
     def handle_digest(self, data, addr):
-        print(data)
-        print(file_uploads[addr]['seg_write'])
-        md5sum = self.flush_chunks(addr)
-        print(md5sum)
-        self.transport.sendto(bytes(md5sum == data['payload']), addr)
-
-    def flush_chunks(self, addr):
-        data = file_uploads[addr]
-        with open(data['filename'], 'ab') as fp:
-            for chunk in data['chunks']:
-                data['md5sum'].update(chunk[1])
-                fp.write(chunk[1])
-        md5sum = data['md5sum'].hexdigest()
-        file_uploads.pop(addr)
-        return md5sum
+        log.logger.debug("Digest from %s: %s", addr, data['payload'])
+        peer = peers.get(addr, {})
+        key = peer.get('upload', addr)
+        upload = file_uploads.get(key)
+        if upload is None:
+            if (data.get('session') == peer.get('finished') and
+                    'verified' in peer):
+                # The reply was lost and the client asks again
+                self.transport.sendto(bytes(peer['verified']), addr)
+            return
+        if upload['verifying']:
+            # Asked again while the check runs, its reply is on the way
+            return
+        if data.get('round', 0) < upload['round']:
+            # The repair request was lost
+            self.transport.sendto(upload['repair'], addr)
+            return
+        upload['verifying'] = True
+        writer_pool.submit(key, self.verify_digest, key, upload,
+                           data['payload'], addr, data.get('session', 0),
+                           peer)
+
+    def verify_digest(self, key, upload, digest, addr, session, peer):
+        """Check an upload against the digest of the client, or ask for
+        the blocks that do not match its manifest or were not all written
+        again.
+
+        Only clients uploading by ID or with a window know how to repair,
+        legacy stop-and-wait ones are told the upload failed instead.
+        """
+        if upload['algorithm'] is not None:
+            failed = failed_blocks(upload)
+        else:
+            failed = unwritten_blocks(upload)
+        if failed and ('upload' in peer or 'window' in peer):
+            log.logger.warning("Upload %s has %d blocks to repair",
+                               upload['filename'], len(failed))
+            self.loop.call_soon_threadsafe(
+                self.request_repair, upload, forget_blocks(upload, failed),
+                failed, addr, session)
+            return
+        if upload['algorithm'] is not None:
+            leaves = [upload['manifest'][index] for index in range(
+                merkle.num_blocks(upload['size'], upload['block_size']))]
+            expected = merkle.root(upload['algorithm'], leaves).hex()
+        else:
+            expected = upload['md5sum'].hexdigest()
+        close_upload(upload)
+        log.logger.info("Upload %s finished, digest %s", upload['filename'],
+                        'matches' if expected == digest else 'differs')
+        self.loop.call_soon_threadsafe(self.finish_upload, key, upload,
+                                       addr, peer, expected == digest)
+
+    def request_repair(self, upload, lost, failed, addr, session):
+        for offset, seqs in lost.items():
+            upload['streams'][offset]['chunks'].forget(seqs)
+        upload['round'] += 1
+        upload['repair'] = wire.encode_repair(session, upload['round'],
+                                              failed)
+        upload['verifying'] = False
+        stats['repairs'] += len(failed)
+        self.transport.sendto(upload['repair'], addr)
+
+    def finish_upload(self, key, upload, addr, peer, verified):
+        file_uploads.pop(key, None)
+        stats['uploads'] += 1
+        stats['decompress_seconds'] += upload['cpu_time']
+        for other in upload['addrs']:
+            if other in peers:
+                peers[other]['finished'] = peers[other].get('session')
+        peer['finished'] = peer.get('session')
+        peer['verified'] = verified
+        self.transport.sendto(bytes(verified), addr)
+
+
+def serve(host, port, stats_queue=None, reuse_port=False, index=0):
+    """Run one server process until it is interrupted or terminated.
+
+    Sessions still open at that point get their report flushed, and the
+    process counters are put on ``stats_queue`` when one is given.
+    """
+    global writer_pool, hash_pool, sharded
+    sharded = reuse_port
+    writer_pool = WriterPool(writers, write_queue)
+    hash_pool = ThreadPoolExecutor(max_workers=writers,
+                                   thread_name_prefix='hasher')
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    # One protocol instance will be created to serve all client requests
+    if engine == 'batch':
+        transport, protocol = receiver.listen(loop, EchoServerProtocol(),
+                                              (host, port), reuse_port,
+                                              batch)
+    else:
+        listen = loop.create_datagram_endpoint(
+            EchoServerProtocol, local_addr=(host, port),
+            reuse_port=reuse_port)
+        transport, protocol = loop.run_until_complete(listen)
+    if metrics_port:
+        endpoint = metrics.listen(loop, protocol.collect_metrics,
+                                  metrics_host, metrics_port + index)
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(signum, loop.stop)
+        except NotImplementedError:
+            pass
+
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    for addr in list(events):
+        stats['reports'] += 1
+        writer_pool.submit(addr, generate_report, addr, events.pop(addr))
+    for key, upload in file_uploads.items():
+        if upload['resume'] is not None:
+            writer_pool.submit(key, suspend_upload, upload)
+    writer_pool.close()
+    hash_pool.shutdown(wait=True)
+    if metrics_port:
+        endpoint.close()
+    transport.close()
+    loop.close()
+    if stats_queue is not None:
+        stats_queue.put(stats)
+    log.stop()
+
+
+def supervise(host, port, num_workers):
+    """Fork ``num_workers`` servers sharing the port through SO_REUSEPORT.
+
+    The kernel hashes every client address to one worker, so each of them
+    keeps the state of its own clients. An upload by ID spans several
+    client sockets, the workers refuse them: clients then upload over a
+    single socket, which cannot be resumed. Interrupting or terminating the
+    supervisor shuts the workers down, then their counters are merged.
+    """
+    ctx = multiprocessing.get_context('fork')
+    stats_queue = ctx.Queue()
+    workers = [ctx.Process(target=serve, name='worker-%d' % i,
+                           args=(host, port, stats_queue, True, i))
+               for i in range(num_workers)]
+    for worker in workers:
+        worker.start()
+    log.logger.info("Uploads by ID refused, uploads cannot be resumed")
+
+    def shutdown(signum, frame):
+        for worker in workers:
+            if worker.is_alive():
+                os.kill(worker.pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGINT, shutdown)
+    signal.signal(signal.SIGTERM, shutdown)
+
+    results = []
+    while (len(results) < num_workers and
+           any(worker.is_alive() for worker in workers)):
+        try:
+            results.append(stats_queue.get(timeout=0.5))
+        except queue.Empty:
+            pass
+    while not stats_queue.empty():
+        results.append(stats_queue.get())
+    for worker in workers:
+        worker.join()
+
+    merged = dict.fromkeys(stats, 0)
+    for result in results:
+        for key, value in result.items():
+            merged[key] += value
+    log.logger.info("Workers finished: %d/%d", len(results), num_workers)
+    for key, value in merged.items():
+        log.logger.info("  %s: %s", key, value)
 
 
 if __name__ == '__main__':
@@ -165,25 +1154,31 @@ if __name__ == '__main__':
     except Exception:
         pass
 
+    try:
+        os.mkdir(RESUME_FOLDER)
+    except Exception:
+        pass
+
     args = parser.parse_args()
     HOST, PORT = '0.0.0.0', int(args.port)
     bufsize = int(args.bufsize)
-    loop = asyncio.get_event_loop()
-    print("Starting UDP server")
-    # One protocol instance will be created to serve all client requests
-    listen = loop.create_datagram_endpoint(
-        EchoServerProtocol, local_addr=(HOST, PORT))
-    # tasks = [loop.create_task(generate_report())]
-    print("Now listening on %s:%d" % (HOST, PORT))
-    print("Press Ctrl+C to Stop")
-    transport, protocol = loop.run_until_complete(listen)
-
-    try:
-        loop.run_forever()
-    except KeyboardInterrupt:
-        pass
-    # print(events)
-    for addr in events:
-        generate_report(addr)
-    transport.close()
-    loop.close()
+    reorder_budget = int(args.reorder_budget)
+    max_upload_chunks = int(args.max_upload_chunks)
+    writers = int(args.writers)
+    write_queue = int(args.write_queue)
+    num_workers = int(args.workers)
+    engine = args.engine
+    batch = int(args.batch)
+    stats_mode = args.stats
+    idle_timeout = float(args.idle_timeout)
+    metrics_host = args.metrics_host
+    metrics_port = int(args.metrics_port)
+    log.setup(args.log_level, args.silent, int(args.log_sample),
+              int(args.log_rate))
+    log.logger.info("Starting UDP server")
+    log.logger.info("Now listening on %s:%d", HOST, PORT)
+    log.logger.info("Press Ctrl+C to Stop")
+    if num_workers > 1:
+        supervise(HOST, PORT, num_workers)
+    else:
+        serve(HOST, PORT)
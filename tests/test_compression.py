@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+
+"""Compression of upload chunks and its fallback to raw chunks."""
+
+import os
+import sys
+import zlib
+import lzma
+import os.path as osp
+
+import pytest
+
+ROOT = osp.dirname(osp.dirname(osp.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import compression
+
+CHUNK = 2048
+LEVELS = compression.DEFAULT_LEVELS
+# What the server catches when a chunk does not inflate
+INFLATE_ERRORS = (ValueError, zlib.error, lzma.LZMAError)
+TEXT = b'time,value\n' + b''.join(b'%d,%d\n' % (i, i * 7 % 13)
+                                   for i in range(400))
+
+
+@pytest.mark.parametrize('codec', compression.CODECS)
+def test_round_trip(codec):
+    data = TEXT[:CHUNK]
+    packed = compression.compress(codec, LEVELS[codec], data)
+    assert len(packed) < len(data)
+    assert compression.decompress(codec, packed, CHUNK) == data
+
+
+@pytest.mark.parametrize('codec', compression.CODECS)
+def test_decompress_refuses_large_chunks(codec):
+    packed = compression.compress(codec, LEVELS[codec], bytes(4 * CHUNK))
+    with pytest.raises(ValueError):
+        compression.decompress(codec, packed, CHUNK)
+
+
+@pytest.mark.parametrize('codec', compression.CODECS)
+def test_decompress_refuses_truncated_chunks(codec):
+    packed = compression.compress(codec, LEVELS[codec], TEXT[:CHUNK])
+    with pytest.raises(INFLATE_ERRORS):
+        compression.decompress(codec, packed[:len(packed) // 2], CHUNK)
+
+
+@pytest.mark.parametrize('codec', compression.CODECS)
+def test_compressible_chunks(codec):
+    packer = compression.Compressor(codec)
+    payload, packed = packer.pack(TEXT[:CHUNK])
+    assert packed and len(payload) < CHUNK
+    assert packer.compressed == 1
+
+
+def test_incompressible_chunks_are_bypassed():
+    packer = compression.Compressor('zlib')
+    chunks = [os.urandom(CHUNK) for _ in range(compression.BYPASS_CHUNKS + 2)]
+    results = [packer.pack(chunk) for chunk in chunks]
+    assert all(payload == chunk and not packed
+               for (payload, packed), chunk in zip(results, chunks))
+    # One sample, the bypassed chunks, then a sample again that starts
+    # another bypass
+    assert packer.bypassed == len(chunks)
+    assert packer.skip == compression.BYPASS_CHUNKS
+
+
+def test_compression_resumes_after_bypass():
+    packer = compression.Compressor('zlib')
+    for _ in range(compression.BYPASS_CHUNKS + 1):
+        packer.pack(os.urandom(CHUNK))
+    # The running ratio has to come back below the threshold first
+    for _ in range(compression.BYPASS_CHUNKS * 20):
+        payload, packed = packer.pack(TEXT[:CHUNK])
+        if packed:
+            break
+    assert packed
+    assert compression.decompress('zlib', payload, CHUNK) == TEXT[:CHUNK]
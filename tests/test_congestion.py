@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+
+"""Retransmission timeout and congestion window of uploads."""
+
+import sys
+import os.path as osp
+
+import pytest
+
+ROOT = osp.dirname(osp.dirname(osp.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import congestion
+
+
+def test_rto_follows_rfc6298():
+    rtt = congestion.RttEstimator()
+    assert rtt.rto == congestion.INITIAL_RTO
+    rtt.sample(0.1)
+    assert (rtt.srtt, rtt.rttvar) == (0.1, 0.05)
+    assert rtt.rto == pytest.approx(0.3)
+    rtt.sample(0.2)
+    assert rtt.rttvar == pytest.approx(0.75 * 0.05 + 0.25 * 0.1)
+    assert rtt.srtt == pytest.approx(0.875 * 0.1 + 0.125 * 0.2)
+    assert rtt.rto == pytest.approx(rtt.srtt + 4 * rtt.rttvar)
+
+
+def test_rto_bounds():
+    rtt = congestion.RttEstimator()
+    for _ in range(50):
+        rtt.sample(0.0001)
+    assert rtt.rto == congestion.MIN_RTO
+    for _ in range(10):
+        rtt.backoff()
+    assert rtt.rto == congestion.MAX_RTO
+    # A fresh sample ends the backoff
+    rtt.sample(0.0001)
+    assert rtt.rto == congestion.MIN_RTO
+
+
+def test_slow_start_then_avoidance():
+    window = congestion.AimdWindow(64)
+    assert window.window == congestion.INITIAL_WINDOW
+    window.on_ack(4)
+    assert window.window == 8
+    window.on_loss(5, 20)
+    assert window.window == 4
+    assert window.ssthresh == 4
+    # One chunk per window of ACKs from now on
+    window.on_ack(4)
+    assert window.window == 4
+    window.on_ack(1)
+    assert window.window == 5
+
+
+def test_one_decrease_per_window():
+    window = congestion.AimdWindow(64)
+    window.on_ack(12)
+    window.on_loss(3, 20)
+    assert window.window == 8
+    # Sent before the decrease: the same loss event
+    window.on_loss(10, 25)
+    assert window.window == 8
+    window.on_loss(20, 30)
+    assert window.window == 4
+
+
+def test_timeout_and_limit():
+    window = congestion.AimdWindow(6)
+    window.on_ack(100)
+    assert window.window == 6
+    window.on_timeout(10)
+    assert window.window == 1
+    assert window.ssthresh == 3
+    window = congestion.AimdWindow(1)
+    window.on_loss(1, 2)
+    assert window.window == 1
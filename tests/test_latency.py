@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+
+"""Online and vectorized latency statistics of message runs."""
+
+import sys
+import os.path as osp
+
+import numpy as np
+import pytest
+
+ROOT = osp.dirname(osp.dirname(osp.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import latency
+
+
+def test_histogram_small_values_are_exact():
+    histogram = latency.LogHistogram()
+    for value in range(64):
+        assert histogram.value(histogram.index(value)) == value
+
+
+@pytest.mark.parametrize('value', [64, 1000, 123456, 10 ** 9, 2 ** 40 + 7])
+def test_histogram_relative_error(value):
+    histogram = latency.LogHistogram()
+    bucket = histogram.value(histogram.index(value))
+    assert abs(bucket - value) / value <= 1.0 / 32
+
+
+def test_histogram_percentiles():
+    histogram = latency.LogHistogram()
+    assert histogram.percentile(50) == 0
+    for value in range(1, 1001):
+        histogram.record(value * 1000)
+    assert histogram.count == 1000
+    for q in (50, 90, 99):
+        expected = q * 10 * 1000
+        assert abs(histogram.percentile(q) - expected) / expected < 0.04
+
+
+def test_stats_moments():
+    stats = latency.LatencyStats(5)
+    delays = [10, 20, 30, 40]
+    for seq, delay in enumerate(delays, 1):
+        stats.add(seq, delay)
+    assert stats.count == 4
+    assert stats.mean == pytest.approx(np.mean(delays))
+    assert stats.variance == pytest.approx(np.var(delays, ddof=1))
+    assert (stats.min, stats.max) == (10, 40)
+    assert stats.lost == 1
+    assert stats.min <= stats.percentile(50) <= stats.max
+
+
+def test_stats_duplicates_and_reordering():
+    stats = latency.LatencyStats(10, window=8)
+    for seq in [1, 3, 2, 3, 5, 4, 4]:
+        stats.add(seq, 100)
+    assert stats.count == 5
+    assert stats.duplicates == 2
+    assert stats.reordered == 2
+
+
+def test_stats_window_bounds_memory():
+    stats = latency.LatencyStats(1 << 32, window=64)
+    stats.add(1, 100)
+    # A gap the client chose must not grow the bitmap
+    stats.add(4000000000, 100)
+    assert stats.seen.bit_length() <= 64
+    stats.add(4000000000 - 10, 100)
+    stats.add(4000000000 - 10, 100)
+    assert stats.duplicates == 1
+    # Older than the window: counted as reordered, never as duplicates
+    stats.add(1, 100)
+    assert stats.duplicates == 1
+    assert stats.reordered == 2
+
+
+def test_records_initial_rows_are_capped():
+    records = latency.MessageRecords(4000000000)
+    assert records.columns.shape[1] == latency.MAX_INITIAL_RECORDS
+
+
+def test_records_grow():
+    records = latency.MessageRecords(2)
+    for seq in range(1, 6):
+        records.append(seq, seq * 10, seq * 10 + 5)
+    assert len(records) == 5
+    seq, sent, arrival = records.arrays()
+    assert list(seq) == [1, 2, 3, 4, 5]
+    assert list(arrival - sent) == [5] * 5
+
+
+def test_jitter_matches_recursion():
+    delay = np.random.RandomState(1).rand(200)
+    expected = 0.0
+    for previous, current in zip(delay[:-1], delay[1:]):
+        expected += (abs(current - previous) - expected) / 16
+    assert latency.jitter(delay) == pytest.approx(expected)
+
+
+def test_loss_runs():
+    seq = np.array([2, 3, 3, 7, 6, 10])
+    assert list(latency.loss_runs(seq, 12)) == [1, 2, 2, 2]
+    assert list(latency.loss_runs(np.array([1, 2, 3]), 3)) == []
+    # Out of range sequence numbers are not gaps
+    assert list(latency.loss_runs(np.array([0, 1, 2, 9]), 2)) == []
+
+
+def test_analyze_huge_total():
+    # The total comes from the client, it must not size any allocation
+    seq = np.array([1, 2, 4, 3, 4])
+    sent = np.zeros(5, dtype=np.int64)
+    arrival = np.full(5, 2000000, dtype=np.int64)
+    result = latency.analyze(seq, sent, arrival, 4000000000)
+    assert result['lost'] == 4000000000 - 4
+    assert result['duplicates'] == 1
+    assert result['reordered'] == 1
+    assert result['loss_runs'] == 1
+    assert result['longest_loss_run'] == 4000000000 - 4
+    assert result['mean'] == pytest.approx(0.002)
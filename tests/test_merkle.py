@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+
+"""Block digests, Merkle roots and the repair of corrupted blocks."""
+
+import io
+import sys
+import random
+import os.path as osp
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+ROOT = osp.dirname(osp.dirname(osp.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import merkle
+import server
+
+CHUNK = 256
+BLOCK = 1024
+SIZE = 3000
+
+
+@pytest.mark.parametrize('algorithm', merkle.ALGORITHMS)
+def test_blocks_and_root(algorithm):
+    data = random.Random(1).randbytes(SIZE)
+    leaves = merkle.hash_blocks(io.BytesIO(data), BLOCK, algorithm,
+                                workers=2)
+    assert leaves == [merkle.digest(algorithm, data[i:i + BLOCK])
+                      for i in range(0, SIZE, BLOCK)]
+    assert len(leaves) == merkle.num_blocks(SIZE, BLOCK)
+    assert all(len(leaf) == merkle.DIGEST_SIZE for leaf in leaves)
+    left = merkle.digest(algorithm, leaves[0] + leaves[1])
+    # The odd leaf out moves up as is
+    assert merkle.root(algorithm, leaves) == merkle.digest(
+        algorithm, left + leaves[2])
+
+
+def test_root_tells_blocks_apart():
+    leaves = [merkle.digest('sha3_256', bytes([i])) for i in range(5)]
+    swapped = [leaves[1], leaves[0]] + leaves[2:]
+    assert merkle.root('sha3_256', leaves) != merkle.root('sha3_256',
+                                                          swapped)
+    assert merkle.root('sha3_256', leaves[:1]) == leaves[0]
+
+
+def test_empty_file_is_one_empty_block():
+    assert merkle.num_blocks(0, BLOCK) == 1
+    assert merkle.hash_blocks(io.BytesIO(b''), BLOCK, 'blake2b') == [
+        merkle.digest('blake2b', b'')]
+
+
+def test_iter_blocks_shares_a_pool():
+    data = bytes(range(256)) * 40
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        leaves = list(merkle.iter_blocks(io.BytesIO(data), BLOCK,
+                                         'sha3_256', workers=2, pool=pool))
+    assert leaves == merkle.hash_blocks(io.BytesIO(data), BLOCK, 'sha3_256')
+
+
+def test_chunk_range():
+    # Chunks of a stream from byte 512 on holding bytes 1000 to 2000
+    assert list(merkle.chunk_range(512, 2048, CHUNK, 1000, 2000)) == [
+        2, 3, 4, 5, 6]
+    assert not merkle.chunk_range(512, 2048, CHUNK, 0, 512)
+    assert merkle.whole_chunks(1000, CHUNK) == 768
+    assert merkle.whole_chunks(100, CHUNK) == CHUNK
+
+
+@pytest.fixture
+def upload(tmp_path, monkeypatch):
+    """An upload of ``SIZE`` bytes over two streams, with its manifest."""
+    monkeypatch.setattr(server, 'hash_pool', ThreadPoolExecutor(2))
+    data = random.Random(2).randbytes(SIZE)
+    upload = server.new_upload(str(tmp_path / 'upload.bin'), SIZE, CHUNK,
+                               algorithm='sha3_256', block_size=BLOCK)
+    half = -(-SIZE // CHUNK) // 2
+    server.add_stream(upload, 0, half)
+    server.add_stream(upload, half * CHUNK, -(-SIZE // CHUNK) - half)
+    server.open_upload(upload)
+    upload['data'] = data
+    for index, leaf in enumerate(merkle.hash_blocks(io.BytesIO(data), BLOCK,
+                                                    'sha3_256')):
+        upload['manifest'][index] = leaf
+    yield upload
+    server.hash_pool.shutdown(wait=True)
+    server.close_upload(upload)
+
+
+def write(upload, seqs=None, corrupt=()):
+    for stream in upload['streams'].values():
+        for seq in seqs or range(1, stream['num_seqs'] + 1):
+            offset = stream['offset'] + (seq - 1) * CHUNK
+            chunk = upload['data'][offset:offset + CHUNK]
+            if offset in corrupt:
+                chunk = bytes([chunk[0] ^ 1]) + chunk[1:]
+            server.write_to_file(upload, stream, seq, chunk)
+
+
+def test_blocks_checked_on_arrival(upload):
+    write(upload)
+    server.block_digests(upload)
+    assert server.failed_blocks(upload) == []
+    assert all(upload['checked'][index] for index in range(3))
+
+
+def test_only_corrupted_blocks_are_repaired(upload):
+    write(upload, corrupt=[5 * CHUNK])
+    server.block_digests(upload)
+    assert server.failed_blocks(upload) == [1]
+    lost = server.forget_blocks(upload, [1])
+    # Block 1 holds chunks 5 to 8, across the two streams
+    assert sorted((offset, sorted(seqs)) for offset, seqs in lost.items()) \
+        == [(0, [5, 6]), (6 * CHUNK, [1, 2])]
+    assert 1 not in upload['checked']
+    for offset, seqs in lost.items():
+        stream = upload['streams'][offset]
+        for seq in seqs:
+            start = offset + (seq - 1) * CHUNK
+            server.write_to_file(upload, stream, seq,
+                                 upload['data'][start:start + CHUNK])
+    assert server.failed_blocks(upload) == []
+
+
+def test_missing_blocks_fail(upload):
+    write(upload, seqs=[1, 2, 3, 4])
+    assert server.failed_blocks(upload) == [1, 2]
+
+
+def test_manifest_after_the_data(upload):
+    manifest = dict(upload['manifest'])
+    upload['manifest'].clear()
+    write(upload, corrupt=[0])
+    server.block_digests(upload)
+    assert upload['checked'] == {}
+    for index, leaf in manifest.items():
+        upload['manifest'][index] = leaf
+        server.check_block(upload, index)
+    assert upload['checked'] == {0: False, 1: True, 2: True}
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+
+"""Token bucket pacing of message runs."""
+
+import sys
+import time
+import os.path as osp
+
+import pytest
+
+ROOT = osp.dirname(osp.dirname(osp.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import pacing
+
+
+def test_refill_is_capped_by_burst():
+    bucket = pacing.TokenBucket(100, 5)
+    bucket.tokens, bucket.last = 0, 0.0
+    bucket.refill(0.02)
+    assert bucket.tokens == pytest.approx(2)
+    bucket.refill(10.0)
+    assert bucket.tokens == 5
+
+
+def test_unpaced_never_waits():
+    bucket = pacing.TokenBucket(0)
+    start = time.perf_counter()
+    for _ in range(10000):
+        bucket.wait()
+    assert time.perf_counter() - start < 0.5
+
+
+def test_burst_then_rate():
+    bucket = pacing.TokenBucket(1000, 10)
+    start = time.perf_counter()
+    for _ in range(10):
+        bucket.wait()
+    # The burst went out without waiting for tokens
+    assert bucket.tokens < 1
+    for _ in range(50):
+        bucket.wait()
+    elapsed = time.perf_counter() - start
+    assert 0.049 <= elapsed < 0.5
+
+
+def test_cost():
+    # Bits: a 100 bit message at 10 kbit/s leaves every 10 ms
+    bucket = pacing.TokenBucket(10000, 100)
+    start = time.perf_counter()
+    for _ in range(6):
+        bucket.wait(100)
+    assert 0.049 <= time.perf_counter() - start < 0.5
+
+
+def test_empty_burst_is_refused():
+    with pytest.raises(AssertionError):
+        pacing.TokenBucket(1000, 0)
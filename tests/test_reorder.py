@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+
+"""Reordering of upload chunks and selective ACK bitmaps."""
+
+import sys
+import os.path as osp
+
+ROOT = osp.dirname(osp.dirname(osp.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import wire
+import reorder
+
+
+def test_in_order():
+    chunks = reorder.ReorderBuffer(3)
+    for seq in (1, 2, 3):
+        assert chunks.insert(seq)
+        assert list(chunks.advance()) == [seq]
+    assert chunks.complete
+    assert chunks.depth == 0
+
+
+def test_out_of_order():
+    chunks = reorder.ReorderBuffer(10)
+    for seq in (2, 3, 5):
+        assert chunks.insert(seq)
+        assert not chunks.advance()
+    assert chunks.depth == 3
+    assert chunks.insert(1)
+    assert list(chunks.advance()) == [1, 2, 3]
+    assert chunks.next_seq == 4
+    assert chunks.depth == 1
+    assert not chunks.complete
+
+
+def test_duplicates_and_bounds():
+    chunks = reorder.ReorderBuffer(8)
+    assert chunks.insert(8)
+    assert not chunks.insert(8)
+    assert not chunks.insert(0)
+    assert not chunks.insert(9)
+    assert not chunks.insert(1 << 32)
+    assert chunks.duplicates == 4
+    assert len(chunks.received) == 2
+
+
+def test_limit_refuses_far_chunks():
+    chunks = reorder.ReorderBuffer(100, limit=4)
+    assert chunks.insert(5)
+    assert not chunks.insert(6)
+    assert chunks.refused == 1
+    assert 6 not in chunks
+    chunks.insert(1)
+    chunks.advance()
+    # The window moves with the first missing chunk
+    assert chunks.insert(6)
+
+
+def test_sack_matches_wire_bitmap():
+    chunks = reorder.ReorderBuffer(40)
+    received = [1, 2, 4, 9, 10, 17, 30]
+    for seq in received:
+        chunks.insert(seq)
+    chunks.advance()
+    ack = chunks.next_seq - 1
+    assert ack == 2
+    bitmap = chunks.sack(16)
+    assert bitmap == wire.sack_bitmap(ack, received, 16)
+    assert list(wire.sacked(ack, bitmap)) == [4, 9, 10, 17]
+
+
+def test_sack_at_the_end():
+    chunks = reorder.ReorderBuffer(9)
+    for seq in range(1, 10):
+        chunks.insert(seq)
+    chunks.advance()
+    assert chunks.sack(64) == bytes(8)
+
+
+def test_forget_and_restore():
+    chunks = reorder.ReorderBuffer(10)
+    for seq in range(1, 8):
+        chunks.insert(seq)
+    chunks.advance()
+    chunks.forget([3, 6])
+    assert chunks.next_seq == 3
+    assert 3 not in chunks and 6 not in chunks
+    assert chunks.depth == 3
+    again = reorder.ReorderBuffer(10)
+    again.restore(chunks.received)
+    assert again.next_seq == 3
+    assert again.depth == 3
+    assert again.insert(3)
+    assert list(again.advance()) == [3, 4, 5]
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+
+"""Idle expiry of client sessions on the timer wheel."""
+
+import sys
+import os.path as osp
+
+ROOT = osp.dirname(osp.dirname(osp.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import timers
+
+
+def wheel(timeout, tick=1.0):
+    expired = []
+    return timers.TimerWheel(timeout, expired.append, tick), expired
+
+
+def test_expires_after_timeout():
+    timer, expired = wheel(3)
+    timer.touch('a')
+    for _ in range(2):
+        timer.advance()
+    assert expired == []
+    timer.advance()
+    assert expired == ['a']
+    assert len(timer) == 0
+
+
+def test_touch_postpones():
+    timer, expired = wheel(3)
+    timer.touch('a')
+    timer.touch('b')
+    for _ in range(2):
+        timer.advance()
+    timer.touch('a')
+    timer.advance()
+    assert expired == ['b']
+    timer.advance()
+    assert expired == ['b']
+    # Three ticks after it was touched again
+    timer.advance()
+    assert expired == ['b', 'a']
+
+
+def test_discard():
+    timer, expired = wheel(2)
+    timer.touch('a')
+    timer.discard('a')
+    timer.discard('missing')
+    for _ in range(5):
+        timer.advance()
+    assert expired == []
+    # Touched again after a discard, it gets a fresh deadline
+    timer.touch('a')
+    for _ in range(2):
+        timer.advance()
+    assert expired == ['a']
+
+
+def test_timeout_in_ticks():
+    timer, expired = wheel(2.5, tick=1.0)
+    assert timer.ticks == 3
+    assert len(timer.slots) == 4
+    timer, expired = wheel(0.1, tick=1.0)
+    timer.touch('a')
+    timer.advance()
+    assert expired == ['a']
+
+
+def test_many_keys():
+    timer, expired = wheel(10)
+    for key in range(1000):
+        timer.touch(key)
+        if key % 100 == 0:
+            timer.advance()
+    for _ in range(20):
+        timer.advance()
+    assert sorted(expired) == list(range(1000))
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+
+"""Datagram framing, HELLO negotiation and malformed input."""
+
+import sys
+import json
+import struct
+import os.path as osp
+
+import pytest
+
+ROOT = osp.dirname(osp.dirname(osp.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import wire
+
+# What the server counts as a parse error
+MALFORMED = (ValueError, KeyError, struct.error)
+TIMESTAMP = 1700000000123456000
+
+
+@pytest.mark.parametrize('fmt', wire.FORMATS)
+def test_message_round_trip(fmt):
+    data = wire.decode(wire.encode_message(fmt, 7, 3, 10, TIMESTAMP,
+                                           b'hello'))
+    assert data['type'] == 'MSG'
+    assert data['format'] == fmt
+    assert data['sequence_num'] == 3
+    assert data['total_messages'] == 10
+    message = data['message']
+    if fmt == wire.FORMAT_JSON:
+        message = bytes(message, 'utf-8')
+    assert bytes(message) == b'hello'
+    # JSON timestamps are sent in local time to the microsecond
+    assert abs(data['timestamp'] - TIMESTAMP) < 1000
+
+
+@pytest.mark.parametrize('fmt', wire.FORMATS)
+def test_chunk_round_trip(fmt):
+    payload = bytes(range(256)) * 4
+    data = wire.decode(wire.encode_chunk(fmt, 7, 2, 5, 'f.bin', payload,
+                                         wire.FLAG_COMPRESSED))
+    assert data['type'] == 'FILE'
+    assert data['seq_num'] == 2
+    assert data['total_seq'] == 5
+    assert data['flags'] == wire.FLAG_COMPRESSED
+    assert bytes(data['payload']) == payload
+
+
+@pytest.mark.parametrize('fmt', wire.FORMATS)
+def test_digest_round_trip(fmt):
+    data = wire.decode(wire.encode_digest(fmt, 7, 'f.bin', 'ab' * 32, 2))
+    assert data['type'] == 'MD5'
+    assert data['payload'] == 'ab' * 32
+    assert data['round'] == 2
+
+
+def test_control_datagrams():
+    ack = wire.encode_sack(7, 4, 9, b'\x05', wire.FLAG_BUSY)
+    assert wire.is_ack(ack) and not wire.is_repair(ack)
+    data = wire.decode(ack)
+    assert (data['ack'], data['total_seq'], data['flags']) == (
+        4, 9, wire.FLAG_BUSY)
+    assert list(wire.sacked(data['ack'], data['bitmap'])) == [5, 7]
+    repair = wire.encode_repair(7, 3, [0, 4, 9])
+    assert wire.is_repair(repair)
+    assert wire.decode(repair)['blocks'] == [0, 4, 9]
+    data = wire.decode(wire.encode_blocks(7, 64, 100, b'x' * 64))
+    assert (data['first'], data['total_blocks']) == (64, 100)
+
+
+def test_sack_bitmap_round_trip():
+    received = [12, 13, 19, 40, 41]
+    bitmap = wire.sack_bitmap(10, received + [5, 10, 80], 32)
+    assert len(bitmap) == 4
+    assert list(wire.sacked(10, bitmap)) == received
+
+
+def test_hello_negotiation():
+    offer = json.loads(wire.encode_hello(9, window=16))
+    assert wire.pick_format(offer) == wire.FORMAT_BINARY
+    assert wire.pick_format(offer, [wire.FORMAT_JSON]) == wire.FORMAT_JSON
+    assert wire.pick_format(dict(offer, version=wire.VERSION + 1)) == \
+        wire.FORMAT_JSON
+    reply = wire.read_hello(wire.answer_hello(offer, window=8))
+    assert (reply['session'], reply['window']) == (9, 8)
+    assert reply['format'] == wire.FORMAT_BINARY
+    # Silent servers only speak JSON
+    assert wire.read_hello(None)['format'] == wire.FORMAT_JSON
+    assert 'session' not in wire.read_hello(None)
+
+
+def test_hello_fields():
+    data = wire.decode(wire.encode_hello(9, upload='u', file='f', size=10,
+                                         chunk_size=2048, digest=None))
+    assert data['type'] == 'HELLO'
+    assert data['digest'] is None
+
+
+@pytest.mark.parametrize('data', [
+    b'',
+    b'U',
+    b'UL\x01',
+    b'XY' + bytes(wire.HEADER_SIZE),
+    wire.HEADER.pack(wire.MAGIC, wire.VERSION + 1, wire.MSG, 0, 1, 1, 1, 0),
+    wire.HEADER.pack(wire.MAGIC, wire.VERSION, 99, 0, 1, 1, 1, 0),
+    wire.HEADER.pack(wire.MAGIC, wire.VERSION, wire.MSG, 0, 1, 1, 1,
+                     1 << 63),
+    wire.HEADER.pack(wire.MAGIC, wire.VERSION, wire.REPAIR, 0, 1, 1, 4, 0),
+    b'{',
+    b'{"type": "MSG"}',
+    b'{"type": "MSG", "sequence_num": 1, "timestamp": 0}',
+    b'{"type": "MSG", "sequence_num": "1", "total_messages": 1, '
+    b'"timestamp": 0}',
+    b'{"type": "MSG", "sequence_num": true, "total_messages": 1, '
+    b'"timestamp": 0}',
+    b'{"type": "MSG", "sequence_num": 1, "total_messages": 1, '
+    b'"timestamp": "not a date"}',
+    b'{"type": "FILE", "seq_num": 1, "total_seq": 99999999999999999999, '
+    b'"payload": ""}',
+    b'{"type": "HELLO", "window": "abc"}',
+    b'{"type": "HELLO", "digest": 5}',
+    b'{"type": ["MSG"]}',
+    b'{"type": "ACK"}',
+    b'{}',
+    b'[1, 2, 3]',
+])
+def test_malformed(data):
+    with pytest.raises(MALFORMED):
+        wire.decode(data)
+
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+
+"""Uploads against a server running several worker processes."""
+
+import os
+import sys
+import time
+import socket
+import random
+import subprocess
+import os.path as osp
+
+import pytest
+
+ROOT = osp.dirname(osp.dirname(osp.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import wire
+import transfer
+
+WORKERS = 3
+UPLOADS = 6
+
+
+def free_port():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def wait_ready(port, timeout=10.0):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    deadline = time.monotonic() + timeout
+    try:
+        while time.monotonic() < deadline:
+            reply = wire.negotiate(sock, ('127.0.0.1', port), 1,
+                                   timeout=0.2)
+            if 'session' in reply:
+                return
+        raise RuntimeError('Server did not start')
+    finally:
+        sock.close()
+
+
+@pytest.fixture
+def server(tmp_path):
+    port = free_port()
+    process = subprocess.Popen([sys.executable, osp.join(ROOT, 'server.py'),
+                                '--port', str(port),
+                                '--workers', str(WORKERS), '--silent'],
+                               cwd=str(tmp_path))
+    try:
+        wait_ready(port)
+        yield port, tmp_path
+    finally:
+        process.terminate()
+        process.wait(timeout=10)
+
+
+@pytest.mark.parametrize('streams', [1, 4])
+def test_uploads_reach_one_worker(server, tmp_path, streams):
+    port, folder = server
+    for i in range(UPLOADS):
+        path = tmp_path / ('upload_%d_%d.bin' % (streams, i))
+        data = os.urandom(random.randint(200000, 600000))
+        path.write_bytes(data)
+        uploader = transfer.FileUploader('127.0.0.1', port, str(path),
+                                         len(data), 212992, window=32,
+                                         streams=streams,
+                                         compression='zlib')
+        result = uploader.run()
+        assert result['digest'] == 'OK', result
+        assert (folder / 'uploads' / path.name).read_bytes() == data
+
+
+def test_resume_state_stays_out_of_workers(server, tmp_path):
+    port, folder = server
+    path = tmp_path / 'named.bin'
+    data = os.urandom(300000)
+    path.write_bytes(data)
+    for _ in range(2):
+        uploader = transfer.FileUploader('127.0.0.1', port, str(path),
+                                         len(data), 212992, window=32,
+                                         upload_id='named')
+        result = uploader.run()
+        assert result['digest'] == 'OK', result
+        assert result['upload'] is None
+    assert not os.listdir(str(folder / 'uploads' / '.resume'))
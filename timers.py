@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+
+"""Idle timeouts for client sessions."""
+
+import math
+
+
+class TimerWheel:
+    """Hashed timer wheel expiring keys that were not touched for a while.
+
+    Time is counted in ticks, advanced by calling ``advance`` every
+    ``tick`` seconds. Touching a key only records its new deadline, so it
+    is O(1) and needs no clock read. Keys are filed in the slot of the
+    deadline they had when first touched, and when that slot comes up
+    those touched since are moved to the slot of their current deadline
+    instead of expiring. The wheel has one slot more than the timeout in
+    ticks, so a deadline never lies a full turn ahead.
+    """
+
+    def __init__(self, timeout, on_expire, tick=1.0):
+        self.tick = tick
+        self.ticks = max(1, int(math.ceil(timeout / tick)))
+        self.slots = [set() for _ in range(self.ticks + 1)]
+        self.deadlines = {}
+        self.on_expire = on_expire
+        self.now = 0
+
+    def __len__(self):
+        return len(self.deadlines)
+
+    def touch(self, key):
+        deadline = self.now + self.ticks
+        if key not in self.deadlines:
+            self.slots[deadline % len(self.slots)].add(key)
+        self.deadlines[key] = deadline
+
+    def discard(self, key):
+        # The slot entry is left behind and skipped when it comes up
+        self.deadlines.pop(key, None)
+
+    def advance(self):
+        self.now += 1
+        index = self.now % len(self.slots)
+        slot = self.slots[index]
+        self.slots[index] = set()
+        for key in slot:
+            deadline = self.deadlines.get(key)
+            if deadline is None:
+                continue
+            if deadline <= self.now:
+                del self.deadlines[key]
+                self.on_expire(key)
+            else:
+                self.slots[deadline % len(self.slots)].add(key)
@@ -0,0 +1,844 @@
+# -*- coding: utf-8 -*-
+
+"""Message runs and file uploads of the UDP client, without any GUI.
+
+Both transfers are run by calling ``run`` in the thread of the caller,
+which returns a dict describing the outcome. ``cancel`` may be called
+from another thread to stop them early. Progress is reported through an
+optional ``on_progress(report)`` callback, at most 20 times per second,
+with the reports of ``progress.ProgressMeter``.
+"""
+
+from __future__ import unicode_literals
+
+import os
+import sys
+import time
+import base64
+import random
+import socket
+import hashlib
+import threading
+import os.path as osp
+from concurrent.futures import ThreadPoolExecutor
+
+import log
+import pmtu
+import wire
+import merkle
+import pacing
+import progress
+import compression
+import sender
+import congestion
+
+if sys.version_info < (3, 6):
+    import sha3
+
+ACK_BUFSIZE = 65535
+ACK_POLL_INTERVAL = 0.01
+BUSY_BACKOFF = 0.005
+# Sends of one datagram before the server is given up
+MAX_RETRIES = 8
+# HELLOs sent before taking a silent server for one that only speaks JSON,
+# unless the upload asked for an ID or several streams
+HELLO_ATTEMPTS = 3
+STATUS_INTERVAL = 0.25
+# Bytes of the file hashed at once by multi-stream uploads
+READ_SIZE = 1 << 20
+# Rounds of block repairs before an upload is given up
+MAX_REPAIRS = 3
+
+
+class Transfer:
+    def __init__(self, host, port, on_progress=None, total=0,
+                 unit='bytes'):
+        self.host = host
+        self.port = port
+        self.meter = progress.ProgressMeter(total, on_progress, unit)
+        self.canceled = threading.Event()
+        self.sock = None
+
+    @property
+    def addr(self):
+        return (self.host, self.port)
+
+    def cancel(self):
+        self.canceled.set()
+
+    def progress(self, done):
+        self.meter.update(done)
+
+    def run(self):
+        """Run the transfer to completion or cancellation."""
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        start = time.time()
+        cpu_start = time.process_time()
+        try:
+            result = self.transfer()
+        finally:
+            self.sock.close()
+        self.meter.finish()
+        result['elapsed'] = time.time() - start
+        # CPU time of the whole client process, every thread included
+        result['cpu_time'] = time.process_time() - cpu_start
+        result['canceled'] = self.canceled.is_set()
+        log.logger.info("Time elapsed: %gs", result['elapsed'])
+        return result
+
+
+class MessageSender(Transfer):
+    """Send ``num_messages`` copies of ``message``, timestamped.
+
+    Sends are paced at ``rate`` messages or bits per second, following
+    ``unit``, allowing bursts of ``burst`` messages. A rate of 0 sends as
+    fast as the socket takes them, ``batch`` messages per system call.
+    """
+
+    def __init__(self, host, port, num_messages, message, on_progress=None,
+                 rate=0, burst=1, unit='messages',
+                 batch=sender.DEFAULT_BATCH):
+        Transfer.__init__(self, host, port, on_progress, num_messages,
+                          'messages')
+        # Smaller steps would never send anything
+        assert batch >= 1 and burst >= 1
+        self.num_messages = num_messages
+        self.message = message
+        self.rate = rate
+        self.burst = burst
+        self.unit = unit
+        self.batch = batch
+
+    def transfer(self):
+        log.logger.debug("Send buffer: %d bytes", self.sock.getsockopt(
+            socket.SOL_SOCKET, socket.SO_SNDBUF))
+        addr = self.addr
+        session = random.getrandbits(32)
+        fmt = wire.negotiate(self.sock, addr, session)['format']
+        message = bytes(self.message, 'utf-8')
+        # Every message of a run has the same size
+        cost = 1
+        if self.unit == 'bits':
+            cost = 8 * len(wire.encode_message(fmt, session, 0, 0, 0,
+                                               message))
+        bucket = pacing.TokenBucket(self.rate, self.burst * cost)
+        # Paced runs do not send more at once than a burst
+        step = min(self.batch, self.burst) if self.rate else self.batch
+        batcher = sender.BatchSender(self.sock, addr, step)
+        template = None
+        if fmt == wire.FORMAT_BINARY:
+            template = sender.MessageTemplate(
+                wire.encode_message(fmt, session, 0, self.num_messages, 0,
+                                    message), step)
+            template.attach(batcher)
+        sent = 0
+        start = time.perf_counter()
+        while sent < self.num_messages and not self.canceled.is_set():
+            count = min(step, self.num_messages - sent)
+            bucket.wait(cost * count)
+            if template is not None:
+                template.fill(sent + 1, count, time.time_ns())
+                batcher.flush(count)
+            else:
+                batcher.send([wire.encode_message(fmt, session, seq,
+                                                  self.num_messages,
+                                                  time.time_ns(), message)
+                              for seq in range(sent + 1,
+                                               sent + count + 1)])
+            sent += count
+            self.progress(sent)
+        elapsed = time.perf_counter() - start
+        achieved = sent * cost / elapsed if elapsed > 0 else 0.0
+        return {'mode': 'messages', 'format': fmt, 'sent': sent,
+                'total': self.num_messages,
+                'bytes': sent * len(message), 'rate_unit': self.unit,
+                'requested_rate': self.rate, 'achieved_rate': achieved}
+
+
+def is_reply(data, acked=None):
+    if data[:1] == b'{':
+        # The server only sends JSON when answering a HELLO
+        return False
+    if data == b'ACK' or wire.is_ack(data):
+        return acked is not None and acked(data)
+    return acked is None
+
+
+def split_ranges(size, chunk, count):
+    """Split ``size`` bytes into at most ``count`` ranges of whole chunks,
+    as ``(offset, length)`` pairs."""
+    chunks = -(-size // chunk)
+    count = max(1, min(count, chunks))
+    ranges = []
+    for i in range(count):
+        start = chunks * i // count * chunk
+        end = min(size, chunks * (i + 1) // count * chunk)
+        ranges.append((start, end - start))
+    return ranges
+
+
+def fill_ranges(known, size, chunk):
+    """Ranges covering ``size`` bytes made of the ``(offset, num_seqs)``
+    ones ``known`` to the server, plus the gaps between them."""
+    ranges = []
+    position = 0
+    for offset, num_seqs in sorted(known):
+        if offset > position:
+            ranges.append((position, offset - position))
+        end = min(size, offset + num_seqs * chunk)
+        ranges.append((offset, end - offset))
+        position = end
+    if position < size:
+        ranges.append((position, size - position))
+    return ranges
+
+
+class FileUploader(Transfer):
+    """Upload the file at ``path`` in chunks, then check its digest.
+
+    Up to ``window`` chunks are kept in flight, the server may lower it.
+    Within it, the congestion window grows while chunks are acknowledged
+    and shrinks on loss, and chunks are sent again after an adaptive
+    timeout that backs off exponentially. ``on_status`` gets the round
+    trip, timeout, window and retransmission figures as a dict.
+
+    With ``streams`` above 1 the file is split into that many byte ranges,
+    uploaded at once over their own sockets, each with its own window.
+    The server keeps what it got of an upload under ``upload_id``, which
+    defaults to one derived from the host, path, size and modification
+    time of the file: uploading it again only sends the missing chunks.
+    Servers that do not support upload IDs get a single stream, from the
+    start.
+
+    Those that do check the file block by block: the client sends the
+    ``digest`` of every block and their Merkle root, and sends the blocks
+    that do not match again.
+
+    Chunks are compressed with the ``compression`` codec at ``level`` when
+    the server agrees to it, unless they do not shrink. The status then
+    also holds the bytes sent on the wire and the CPU time spent
+    compressing. Blocks whose chunks the server could not inflate are
+    sent again, whatever the digest.
+
+    Chunks hold ``chunk_size`` bytes, the server may lower it. With
+    ``'auto'`` it is the largest that fits in a datagram along the path to
+    the server without IP fragmentation, with ``'jumbo'`` the largest any
+    UDP datagram holds, which only loopback carries whole.
+
+    Blocks are hashed on the threads of ``hash_pool`` when given, so that
+    uploaders running at once can share them.
+    """
+
+    def __init__(self, host, port, path, size, bufsize, window=1,
+                 on_progress=None, on_status=None, streams=1,
+                 upload_id=None, digest=merkle.DEFAULT_ALGORITHM,
+                 compression=None, level=None, chunk_size=None,
+                 hash_pool=None):
+        Transfer.__init__(self, host, port, on_progress, size)
+        self.meter.details = self.progress_details
+        self.path = path
+        self.size = size
+        self.bufsize = bufsize
+        self.window = window
+        self.on_status = on_status
+        self.streams = streams
+        self.upload_id = upload_id
+        self.digest = digest
+        self.compression = compression
+        self.level = level
+        self.chunk_size = chunk_size
+        self.hash_pool = hash_pool
+        # Whether the server answered a HELLO at all
+        self.answered = False
+        self.total_chunks = 0
+        self.rtt = congestion.RttEstimator()
+        self.cwnd = None
+        self.retransmits = 0
+        self.timeouts = 0
+        # Chunk datagrams sent and their bytes, retransmissions included
+        self.chunks_sent = 0
+        self.wire_bytes = 0
+        self.compress_time = 0.0
+        self.last_status = 0
+        # Uploaders of the ranges of a multi-stream upload
+        self.parts = []
+        # Bytes acknowledged by each of them, by offset
+        self.sent = {}
+        self.lock = threading.Lock()
+
+    def status(self, force=False):
+        now = time.time()
+        if not force and now - self.last_status < STATUS_INTERVAL:
+            return
+        self.last_status = now
+        parts = self.parts or [self]
+        srtts = [part.rtt for part in parts if part.rtt.srtt is not None]
+        status = {'srtt': None, 'rttvar': None,
+                  'rto': max(part.rtt.rto for part in parts),
+                  'cwnd': sum(part.cwnd.window if part.cwnd else 1
+                              for part in parts),
+                  'retransmits': sum(part.retransmits for part in parts),
+                  'timeouts': sum(part.timeouts for part in parts),
+                  'wire_bytes': sum(part.wire_bytes for part in parts),
+                  'compress_time': sum(part.compress_time
+                                       for part in parts)}
+        if srtts:
+            status['srtt'] = sum(rtt.srtt for rtt in srtts) / len(srtts)
+            status['rttvar'] = sum(rtt.rttvar for rtt in srtts) / len(srtts)
+        if self.on_status is not None:
+            self.on_status(status)
+        return status
+
+    def progress_details(self):
+        """Share of the chunks sent that were retransmissions, for
+        progress reports."""
+        parts = self.parts or [self]
+        sent = sum(part.chunks_sent for part in parts)
+        retransmits = sum(part.retransmits for part in parts)
+        return {'retransmits': retransmits,
+                'loss': retransmits / sent if sent else 0.0}
+
+    def transfer(self):
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.bufsize)
+        log.logger.info("Uploading %s", self.path)
+        chunk = self.pick_chunk_size()
+        result = self.transfer_streams(chunk)
+        if result is not None:
+            return result
+        hash_md5 = hashlib.sha3_256()
+        total_size = self.size // chunk
+        total_size += self.size % chunk != 0
+        filename = osp.basename(self.path)
+        addr = self.addr
+        session = random.getrandbits(32)
+        # Servers acknowledge peers announcing a window, even of 1, with
+        # selective ACKs naming the chunks they got
+        params = {'file': filename, 'total_seq': total_size,
+                  'size': self.size, 'chunk_size': chunk,
+                  'window': self.window}
+        if self.compression is not None:
+            params['compression'] = self.compression
+        if self.answered:
+            reply = self.join(session, HELLO_ATTEMPTS, **params)
+        else:
+            # It did not answer the HELLOs of the upload ID either
+            reply = wire.read_hello(None)
+        fmt = reply['format']
+        window = reply.get('window', 1)
+        # Servers that do not agree on one take the default
+        chunk = reply.get('chunk_size', wire.CHUNK_SIZE)
+        total_size = -(-self.size // chunk)
+        result = {'mode': 'upload', 'format': fmt, 'file': self.path,
+                  'size': self.size, 'chunks': total_size,
+                  'chunk_size': chunk, 'window': window, 'streams': 1,
+                  'upload': None, 'repaired': 0,
+                  'compression': reply.get('compression'), 'digest': None}
+
+        with open(self.path, 'rb') as fp:
+            if 'window' in reply:
+                sent = self.send_window(fp, addr, fmt, session, filename,
+                                        chunk, total_size, window, hash_md5,
+                                        codec=reply.get('compression'))
+            else:
+                sent = self.send_chunks(fp, addr, fmt, session, filename,
+                                        chunk, total_size, hash_md5)
+        if sent is False:
+            return self.finish(result)
+        if 'window' in reply:
+            self.verify(result, session, filename, hash_md5.hexdigest(),
+                        lambda blocks: self.resend_blocks(
+                            blocks, fmt, session, filename, chunk, window,
+                            reply.get('compression')))
+        else:
+            self.check_digest(result, session, filename, hash_md5.hexdigest())
+        return self.finish(result)
+
+    def resend_blocks(self, blocks, fmt, session, filename, chunk, window,
+                      codec):
+        """Send the chunks of ``blocks`` again over the single stream of
+        an upload without ID, whose blocks are the server's default."""
+        block_size = merkle.whole_chunks(merkle.DEFAULT_BLOCK_SIZE, chunk)
+        seqs = set()
+        for index in blocks:
+            start = index * block_size
+            seqs.update(merkle.chunk_range(0, self.size, chunk, start,
+                                           min(self.size,
+                                               start + block_size)))
+        seqs = sorted(seqs)
+        done = self.size - sum(min(chunk, self.size - (seq - 1) * chunk)
+                               for seq in seqs)
+        with open(self.path, 'rb') as fp:
+            return self.send_window(fp, self.addr, fmt, session, filename,
+                                    chunk, -(-self.size // chunk), window,
+                                    None, seqs, done, codec) is not False
+
+    def check_digest(self, result, session, filename, digest, round=0):
+        """Send the ``digest`` of the file and return the answer, either
+        the verdict or a request to repair some blocks."""
+        data = wire.encode_digest(result['format'], session, filename,
+                                  digest, round)
+        received = self.request(data, self.addr)
+        if received is not None and not wire.is_repair(received):
+            result['digest'] = 'OK' if received else 'FAILED'
+            log.logger.info("Digest check: %s", result['digest'])
+        return received
+
+    def send_manifest(self, session, params, leaves, first, total):
+        """Send the digests of ``leaves`` from ``first`` on, of the
+        ``total`` blocks of the file, and return up to where the server
+        acknowledged them."""
+        per = max(1, params['chunk_size'] // merkle.DIGEST_SIZE)
+        while first < len(leaves):
+            piece = leaves[first:first + per]
+            end = first + len(piece)
+            data = wire.encode_blocks(session, first, total, b''.join(piece))
+            if self.request(data, self.addr, lambda reply: (
+                    wire.is_ack(reply) and
+                    wire.decode(reply)['ack'] == end)) is None:
+                break
+            first = end
+        return first
+
+    def check_blocks(self, result, session, params, leaves, sent=0):
+        """Send the digests of the blocks past the ``sent`` first then
+        their Merkle root, and the blocks the server asks for again until
+        it takes the upload.
+
+        The server checks every block once both its chunks and its digest
+        are in. Blocks that differ are only asked for again after the
+        root: the streams cannot take them back while they run.
+        """
+        if self.send_manifest(session, params, leaves, sent,
+                              len(leaves)) < len(leaves):
+            return
+        self.verify(result, session, params['file'],
+                    merkle.root(params['digest'], leaves).hex(),
+                    lambda blocks: self.repair(blocks, params))
+
+    def verify(self, result, session, filename, digest, repair):
+        """Send the ``digest`` of the file, and ``repair`` the blocks the
+        server asks for again until it takes the upload.
+
+        Servers checking a manifest ask for the blocks that differ, those
+        checking a digest of the whole file for the blocks of the chunks
+        they could not write. ``repair`` returns whether it sent them.
+        """
+        round = 0
+        for attempt in range(MAX_REPAIRS + 1):
+            received = self.check_digest(result, session, filename, digest,
+                                         round)
+            if received is None or not wire.is_repair(received):
+                return
+            if attempt == MAX_REPAIRS:
+                break
+            request = wire.decode(received)
+            log.logger.warning("Sending %d blocks again",
+                               len(request['blocks']))
+            result['repaired'] += len(request['blocks'])
+            round = request['round']
+            if not repair(request['blocks']):
+                return
+        result['digest'] = 'FAILED'
+        log.logger.error("Blocks still differ after %d repairs", MAX_REPAIRS)
+
+    def repair(self, blocks, params):
+        """Send the chunks of ``blocks`` again, over the streams that
+        carry them."""
+        chunk = params['chunk_size']
+        block_size = params['block_size']
+        repairers = []
+        for part in self.parts:
+            seqs = set()
+            for index in blocks:
+                start = index * block_size
+                seqs.update(merkle.chunk_range(
+                    part.offset, part.size, chunk, start,
+                    min(self.size, start + block_size)))
+            if seqs:
+                repairers.append((part, StreamUploader(
+                    self, params, part.offset, part.size, sorted(seqs))))
+        with ThreadPoolExecutor(max_workers=len(repairers) or 1) as pool:
+            futures = [pool.submit(repairer.run)
+                       for _, repairer in repairers]
+            results = [future.result() for future in futures]
+        for part, repairer in repairers:
+            part.retransmits += repairer.retransmits
+            part.timeouts += repairer.timeouts
+            part.chunks_sent += repairer.chunks_sent
+            part.wire_bytes += repairer.wire_bytes
+            part.compress_time += repairer.compress_time
+        return all('error' not in part and not part['canceled']
+                   for part in results)
+
+    def finish(self, result):
+        if result['digest'] is None and not self.canceled.is_set():
+            result['error'] = 'timeout'
+            log.logger.error("Server stopped answering")
+        result.update(self.status(force=True))
+        return result
+
+    def pick_chunk_size(self):
+        if self.chunk_size == 'jumbo':
+            return wire.MAX_CHUNK_SIZE
+        if self.chunk_size != 'auto':
+            return self.chunk_size or wire.CHUNK_SIZE
+        payload = pmtu.probe(self.addr)
+        if payload is None:
+            log.logger.info("Path MTU probes unanswered")
+            return wire.CHUNK_SIZE
+        log.logger.info("Path MTU allows %d byte datagrams", payload)
+        return max(wire.MIN_CHUNK_SIZE, payload - wire.HEADER_SIZE)
+
+    def default_upload_id(self):
+        name = '%s:%s:%d:%d' % (socket.gethostname(),
+                                osp.abspath(self.path), self.size,
+                                os.stat(self.path).st_mtime_ns)
+        return hashlib.sha3_256(bytes(name, 'utf-8')).hexdigest()[:16]
+
+    def transfer_streams(self, chunk):
+        """Upload the ranges of the file in parallel, ``None`` when the
+        server does not take uploads by ID.
+
+        The server joins the streams by the upload ID given in their HELLO,
+        the block digests are computed here meanwhile, on a thread per CPU.
+        When it already holds part of the upload, the ranges, chunk size and
+        digest it knows are kept. Servers without block digests get the
+        SHA3 of the whole file instead.
+        """
+        upload = self.upload_id or self.default_upload_id()
+        filename = osp.basename(self.path)
+        session = random.getrandbits(32)
+        params = {'upload': upload, 'file': filename, 'size': self.size,
+                  'chunk_size': chunk, 'digest': self.digest,
+                  'block_size': merkle.DEFAULT_BLOCK_SIZE}
+        if self.compression is not None:
+            params['compression'] = self.compression
+        # Falling back loses what was asked for, rather wait for the server
+        asked = self.upload_id is not None or self.streams > 1
+        reply = self.join(session, MAX_RETRIES + 1 if asked else
+                          HELLO_ATTEMPTS, **params)
+        self.answered = 'session' in reply
+        if reply.get('upload') != upload:
+            if asked:
+                # Servers running several workers refuse them too
+                log.logger.warning("Server does not take uploads by ID, "
+                                   "uploading over a single socket that "
+                                   "cannot be resumed")
+            else:
+                log.logger.info("Server does not take uploads by ID")
+            return None
+        chunk = params['chunk_size'] = reply.get('chunk_size', chunk)
+        params['digest'] = reply.get('digest')
+        params['block_size'] = reply.get('block_size',
+                                         merkle.DEFAULT_BLOCK_SIZE)
+        if reply.get('ranges'):
+            ranges = fill_ranges(reply['ranges'], self.size, chunk)
+        else:
+            ranges = split_ranges(self.size, chunk, self.streams)
+        self.total_chunks = -(-self.size // chunk)
+        self.parts = [StreamUploader(self, params, offset, length)
+                      for offset, length in ranges]
+        result = {'mode': 'upload', 'format': reply['format'],
+                  'file': self.path, 'size': self.size,
+                  'chunks': self.total_chunks, 'chunk_size': chunk,
+                  'window': self.window,
+                  'streams': len(self.parts), 'upload': upload,
+                  'resumed': 0, 'repaired': 0,
+                  'compression': reply.get('compression'),
+                  'digest_algorithm': params['digest'] or 'sha3_256',
+                  'digest': None}
+        hash_md5 = hashlib.sha3_256()
+        with ThreadPoolExecutor(max_workers=len(self.parts)) as pool:
+            futures = [pool.submit(part.run) for part in self.parts]
+            with open(self.path, 'rb') as fp:
+                if params['digest'] is not None:
+                    # The manifest goes along with the chunks, a piece as
+                    # soon as its blocks are hashed, and no more once the
+                    # server did not acknowledge one
+                    total = merkle.num_blocks(self.size,
+                                              params['block_size'])
+                    per = max(1, chunk // merkle.DIGEST_SIZE)
+                    leaves, sent = [], 0
+                    for leaf in merkle.iter_blocks(fp, params['block_size'],
+                                                   params['digest'],
+                                                   canceled=self.canceled,
+                                                   pool=self.hash_pool):
+                        leaves.append(leaf)
+                        if len(leaves) - sent == per:
+                            sent = self.send_manifest(session, params,
+                                                      leaves, sent, total)
+                else:
+                    buf = fp.read(READ_SIZE)
+                    while buf and not self.canceled.is_set():
+                        hash_md5.update(buf)
+                        buf = fp.read(READ_SIZE)
+            results = [future.result() for future in futures]
+        result['resumed'] = sum(part.get('resumed', 0) for part in results)
+        if all('error' not in part and not part['canceled']
+               for part in results):
+            # Idle for the whole upload, the server may have dropped this
+            # peer since
+            self.join(session, MAX_RETRIES + 1, **params)
+            if params['digest'] is not None:
+                self.check_blocks(result, session, params, leaves, sent)
+            else:
+                self.verify(result, session, filename, hash_md5.hexdigest(),
+                            lambda blocks: self.repair(blocks, params))
+        return self.finish(result)
+
+    def join(self, session, attempts, **params):
+        """Send the HELLO of the upload named in ``params`` until the server
+        answers it, at most ``attempts`` times. Late answers to earlier
+        HELLOs of another session do not count."""
+        for _ in range(attempts):
+            reply = wire.negotiate(self.sock, self.addr, session,
+                                   timeout=self.rtt.rto, **params)
+            if reply.get('session') == session:
+                break
+            self.rtt.backoff()
+        return reply
+
+    def stream_progress(self, offset, bytes_snt):
+        with self.lock:
+            self.sent[offset] = bytes_snt
+            self.progress(sum(self.sent.values()))
+
+    def request(self, data, addr, acked=None):
+        """Send ``data`` until a reply other than an ACK comes, backing off
+        after every timeout. ``None`` when none came.
+
+        With ``acked`` the reply is the first ACK it accepts instead. Late
+        answers to a HELLO are skipped either way.
+        """
+        for _ in range(MAX_RETRIES + 1):
+            self.sock.settimeout(self.rtt.rto)
+            self.sock.sendto(data, addr)
+            try:
+                received = self.sock.recv(ACK_BUFSIZE)
+                while not is_reply(received, acked):
+                    received = self.sock.recv(ACK_BUFSIZE)
+                return received
+            except socket.timeout:
+                if self.canceled.is_set():
+                    return None
+                self.retransmits += 1
+                self.timeouts += 1
+                self.rtt.backoff()
+        return None
+
+    def send_chunks(self, fp, addr, fmt, session, filename, chunk,
+                    total_size, hash_md5):
+        """Stop-and-wait transfer, one chunk per round trip.
+
+        Only used with servers that do not negotiate a window: their bare
+        ACKs do not say which chunk they answer, so a late one may be
+        taken for the ACK of the next chunk. Servers whose HELLO answer
+        came too late send selective ACKs, those are checked.
+        """
+        cur_seq = 1
+        bytes_snt = 0
+
+        def acked(reply):
+            if reply == b'ACK':
+                return True
+            reply = wire.decode(reply)
+            return (cur_seq <= reply['ack'] or
+                    cur_seq in wire.sacked(reply['ack'], reply['bitmap']))
+
+        buf = fp.read(chunk)
+        while buf:
+            if self.canceled.is_set():
+                return False
+            hash_md5.update(buf)
+            data = wire.encode_chunk(fmt, session, cur_seq,
+                                     total_size, filename, buf)
+            self.wire_bytes += len(data)
+            sent = time.time()
+            retransmits = self.retransmits
+            if self.request(data, addr, acked) is None:
+                return False
+            if self.retransmits == retransmits:
+                self.rtt.sample(time.time() - sent)
+            self.chunks_sent += 1 + self.retransmits - retransmits
+            bytes_snt += len(buf)
+            self.progress(bytes_snt)
+            self.status()
+            cur_seq += 1
+            buf = fp.read(chunk)
+
+    def send_window(self, fp, addr, fmt, session, filename, chunk,
+                    total_size, window, hash_md5, seqs=None, done=0,
+                    codec=None):
+        """Selective-repeat transfer keeping up to ``window`` chunks in
+        flight.
+
+        The server answers every chunk with a cumulative ACK plus a bitmap
+        of the chunks it holds past it, so only the missing ones are sent
+        again: either when a later chunk has been acknowledged before them
+        or when their retransmission timeout expires. ``fp`` must be at the
+        start of chunk 1, chunks are added to ``hash_md5`` unless it is
+        ``None``.
+
+        Resumed and repaired uploads only send the ascending ``seqs``, the
+        server already has the other chunks, ``done`` bytes of them. Chunks
+        are compressed with ``codec`` when one was agreed on.
+        """
+        # seq -> [datagram, last send time, payload length, sends]
+        in_flight = {}
+        pending = iter(range(1, total_size + 1) if seqs is None else seqs)
+        next_seq = next(pending, total_size + 1)
+        # Chunk the position of fp is at
+        position = 1
+        bytes_snt = done
+        paused_until = 0
+        packer = None
+        if codec is not None:
+            packer = compression.Compressor(codec, self.level)
+        compress_time = self.compress_time
+        self.cwnd = congestion.AimdWindow(window)
+        batcher = sender.BatchSender(self.sock, addr)
+        self.sock.settimeout(ACK_POLL_INTERVAL)
+        while next_seq <= total_size or in_flight:
+            if self.canceled.is_set():
+                return False
+            now = time.time()
+            batch = []
+            while (len(in_flight) < self.cwnd.window and
+                   next_seq <= total_size and now >= paused_until):
+                if next_seq != position:
+                    fp.seek((next_seq - position) * chunk, os.SEEK_CUR)
+                buf = fp.read(chunk)
+                position = next_seq + 1
+                if hash_md5 is not None:
+                    hash_md5.update(buf)
+                payload, flags = buf, 0
+                if packer is not None:
+                    payload, packed = packer.pack(buf)
+                    flags = wire.FLAG_COMPRESSED if packed else 0
+                    self.compress_time = compress_time + packer.cpu_time
+                data = wire.encode_chunk(fmt, session, next_seq,
+                                         total_size, filename, payload,
+                                         flags)
+                batch.append(data)
+                in_flight[next_seq] = [data, now, len(buf), 1]
+                next_seq = next(pending, total_size + 1)
+            batcher.send(batch)
+            self.chunks_sent += len(batch)
+            self.wire_bytes += sum(len(data) for data in batch)
+
+            highest = 0
+            try:
+                reply = wire.decode(self.sock.recv(ACK_BUFSIZE))
+            except socket.timeout:
+                reply = None
+            now = time.time()
+            if reply is not None and reply['type'] == 'ACK':
+                if reply['flags'] & wire.FLAG_BUSY:
+                    # The server's disk stage is behind, hold new chunks
+                    paused_until = now + BUSY_BACKOFF
+                acked = [seq for seq in in_flight if seq <= reply['ack']]
+                acked.extend(wire.sacked(reply['ack'], reply['bitmap']))
+                newest = None
+                for seq in acked:
+                    entry = in_flight.pop(seq, None)
+                    if entry is not None:
+                        bytes_snt += entry[2]
+                        self.cwnd.on_ack(1)
+                        if entry[3] == 1 and (newest is None or
+                                              entry[1] > newest):
+                            newest = entry[1]
+                    highest = max(highest, seq)
+                if newest is not None:
+                    # Karn's rule, chunks sent once only
+                    self.rtt.sample(now - newest)
+                self.progress(bytes_snt)
+
+            batch = []
+            timed_out = False
+            # A hole is sent again at most once per round trip
+            hole_wait = max(ACK_POLL_INTERVAL, self.rtt.srtt or 0)
+            for seq, entry in in_flight.items():
+                hole = seq < highest and now - entry[1] > hole_wait
+                expired = now - entry[1] > self.rtt.rto
+                if not (hole or expired):
+                    continue
+                if entry[3] > MAX_RETRIES:
+                    return False
+                log.packets("Retransmitting chunk %d", seq)
+                batch.append(entry[0])
+                entry[1] = now
+                entry[3] += 1
+                if seq < self.cwnd.recover:
+                    # Part of a loss event already accounted
+                    continue
+                if expired:
+                    timed_out = True
+                else:
+                    self.cwnd.on_loss(seq, next_seq)
+            if timed_out:
+                self.timeouts += 1
+                self.rtt.backoff()
+                self.cwnd.on_timeout(next_seq)
+            self.retransmits += len(batch)
+            batcher.send(batch)
+            self.chunks_sent += len(batch)
+            self.wire_bytes += sum(len(data) for data in batch)
+            self.status()
+
+
+class StreamUploader(FileUploader):
+    """Upload ``length`` bytes from ``offset`` on, one range of the
+    multi-stream upload run by ``parent``.
+
+    ``params`` names the upload on the server. Progress and status go to
+    the parent, which also sends the digest. Repairs only send the chunks
+    ``seqs`` of the range.
+    """
+
+    def __init__(self, parent, params, offset, length, seqs=None):
+        FileUploader.__init__(self, parent.host, parent.port, parent.path,
+                              length, parent.bufsize, parent.window,
+                              on_status=self.range_status,
+                              level=parent.level)
+        self.parent = parent
+        self.params = params
+        self.offset = offset
+        self.seqs = seqs
+        self.canceled = parent.canceled
+
+    def progress(self, done):
+        self.parent.stream_progress(self.offset, done)
+
+    def range_status(self, status):
+        self.parent.status()
+
+    def transfer(self):
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.bufsize)
+        chunk = self.params['chunk_size']
+        total_size = -(-self.size // chunk)
+        session = random.getrandbits(32)
+        reply = self.join(session, MAX_RETRIES + 1, offset=self.offset,
+                          total_seq=total_size, window=self.window,
+                          **self.params)
+        result = {'offset': self.offset, 'size': self.size,
+                  'chunks': total_size}
+        if reply.get('upload') != self.params['upload']:
+            result['error'] = 'refused'
+            return result
+        # Chunks the server already holds, from an earlier attempt
+        ack = reply.get('ack', 0)
+        held = set(wire.sacked(ack, base64.b64decode(reply.get('held', ''))))
+        seqs = [seq for seq in self.seqs or range(ack + 1, total_size + 1)
+                if seq > ack and seq not in held]
+        done = self.size - sum(min(chunk, self.size - (seq - 1) * chunk)
+                               for seq in seqs)
+        result['resumed'] = done if self.seqs is None else 0
+        with open(self.path, 'rb') as fp:
+            fp.seek(self.offset)
+            sent = self.send_window(fp, self.addr, reply['format'], session,
+                                    self.params['file'], chunk, total_size,
+                                    reply.get('window', 1), None, seqs,
+                                    done, reply.get('compression'))
+        if sent is False and not self.canceled.is_set():
+            result['error'] = 'timeout'
+        return result
@@ -0,0 +1,326 @@
+# -*- coding: utf-8 -*-
+
+"""Datagram framing shared by the UDP client and server.
+
+Two wire formats are understood:
+
+* ``json``: the original format, one JSON object per datagram with file
+  chunks base64-encoded. It is kept for peers that predate the binary one.
+* ``binary``: a fixed-size struct header followed by the raw payload.
+
+JSON datagrams always start with ``{`` while binary datagrams start with
+``MAGIC``, so the server can tell them apart on a per-datagram basis. The
+format used by a client is negotiated with a ``HELLO`` exchange, which is
+always JSON encoded.
+"""
+
+import json
+import time
+import base64
+import socket
+import struct
+import datetime
+
+MAGIC = b'UL'
+VERSION = 1
+
+FORMAT_JSON = 'json'
+FORMAT_BINARY = 'binary'
+FORMATS = [FORMAT_BINARY, FORMAT_JSON]
+
+MSG, FILE, MD5, ACK, BLOCKS, REPAIR = 1, 2, 3, 4, 5, 6
+TYPE_CODES = {'MSG': MSG, 'FILE': FILE, 'MD5': MD5, 'ACK': ACK,
+              'BLOCKS': BLOCKS, 'REPAIR': REPAIR}
+TYPE_NAMES = {code: name for name, code in TYPE_CODES.items()}
+
+# Set on a SACK when the server cannot take more chunks for now
+FLAG_BUSY = 1
+# Set on a FILE datagram whose payload is compressed with the codec of
+# its session
+FLAG_COMPRESSED = 2
+
+# magic, version, type, flags, session, sequence, total, timestamp (ns)
+HEADER = struct.Struct('!2sBBHIIIQ')
+HEADER_SIZE = HEADER.size
+# Where the sequence number and the timestamp sit in a header, for
+# senders patching them into a prebuilt datagram
+SEQ_OFFSET = struct.calcsize('!2sBBHI')
+TIMESTAMP_OFFSET = struct.calcsize('!2sBBHIII')
+
+# Payload bytes per file chunk, peers that do not negotiate one use this
+CHUNK_SIZE = 2048
+MIN_CHUNK_SIZE = 256
+# Largest UDP payload over IPv4
+MAX_DATAGRAM = 65507
+MAX_CHUNK_SIZE = MAX_DATAGRAM - HEADER_SIZE
+# Room left for the other fields of a JSON chunk, the payload is base64
+JSON_CHUNK_OVERHEAD = 1024
+
+JSON_START = ord('{')
+MIN_INT, MAX_INT = -(1 << 63), (1 << 63) - 1
+# Fields JSON datagrams of each type must carry, with their types
+JSON_FIELDS = {'MSG': {'sequence_num': int, 'total_messages': int,
+                       'timestamp': (int, str)},
+               'FILE': {'seq_num': int, 'total_seq': int, 'payload': str},
+               'MD5': {'payload': str},
+               'HELLO': {}}
+# Types of the optional fields, checked when present
+JSON_OPTIONAL = {'session': int, 'version': int, 'formats': list,
+                 'flags': int, 'round': int, 'file': str, 'upload': str,
+                 'size': int, 'offset': int, 'total_seq': int,
+                 'chunk_size': int, 'window': int, 'block_size': int,
+                 # None asks for the SHA3 of the whole file
+                 'digest': (str, type(None))}
+HELLO_TIMEOUT = 1.0
+HELLO_BUFSIZE = 65535
+
+
+def ns_to_isoformat(timestamp):
+    return datetime.datetime.fromtimestamp(timestamp / 1e9).isoformat()
+
+
+def timestamp_ns(value):
+    """Epoch nanoseconds of a timestamp sent either as an integer or, by
+    older peers, as a local ISO 8601 string."""
+    if isinstance(value, int):
+        return value
+    value = datetime.datetime.fromisoformat(value)
+    seconds = int(value.replace(microsecond=0).timestamp())
+    return seconds * 1000000000 + value.microsecond * 1000
+
+
+def encode_message(fmt, session, seq, total, timestamp, message):
+    """Build a MSG datagram, ``timestamp`` is given in epoch nanoseconds."""
+    if fmt == FORMAT_BINARY:
+        return HEADER.pack(MAGIC, VERSION, MSG, 0, session, seq, total,
+                           timestamp) + message
+    data = {'type': 'MSG', 'sequence_num': seq,
+            'timestamp': ns_to_isoformat(timestamp),
+            'message': str(message, 'utf-8'), 'total_messages': total}
+    return bytes(json.dumps(data), 'utf-8')
+
+
+def encode_chunk(fmt, session, seq, total, filename, payload, flags=0):
+    if fmt == FORMAT_BINARY:
+        return HEADER.pack(MAGIC, VERSION, FILE, flags, session, seq, total,
+                           time.time_ns()) + payload
+    data = {'seq_num': seq, 'file': filename, 'total_seq': total,
+            'payload': str(base64.b64encode(payload), 'utf-8'),
+            'type': 'FILE'}
+    if flags:
+        data['flags'] = flags
+    return bytes(json.dumps(data), 'utf-8')
+
+
+def encode_digest(fmt, session, filename, digest, round=0):
+    """Build the digest of an upload, sent again as ``round`` after each
+    repair of its blocks."""
+    if fmt == FORMAT_BINARY:
+        return HEADER.pack(MAGIC, VERSION, MD5, 0, session, round, 0,
+                           time.time_ns()) + bytes(digest, 'ascii')
+    data = {'type': 'MD5', 'file': filename, 'payload': digest,
+            'round': round}
+    return bytes(json.dumps(data), 'utf-8')
+
+
+def encode_blocks(session, first, total, digests):
+    """Build a piece of a block manifest, the concatenated ``digests``
+    of blocks ``first`` on out of ``total``."""
+    return HEADER.pack(MAGIC, VERSION, BLOCKS, 0, session, first, total,
+                       time.time_ns()) + digests
+
+
+def encode_repair(session, round, blocks):
+    """Build the answer to digest ``round`` asking for ``blocks`` again."""
+    return HEADER.pack(MAGIC, VERSION, REPAIR, 0, session, round,
+                       len(blocks), time.time_ns()) + struct.pack(
+                           '!%dI' % len(blocks), *blocks)
+
+
+def encode_sack(session, ack, total, bitmap, flags=0):
+    """Build a selective ACK: ``ack`` is the cumulative acknowledgement."""
+    return HEADER.pack(MAGIC, VERSION, ACK, flags, session, ack, total,
+                       time.time_ns()) + bitmap
+
+
+def sack_bitmap(ack, received, window):
+    """Encode which of the ``window`` sequences after ``ack`` arrived.
+
+    Bit ``i`` (least significant bit first) of the bitmap is set when
+    sequence ``ack + 1 + i`` is in ``received``.
+    """
+    bitmap = bytearray((window + 7) // 8)
+    for seq in received:
+        offset = seq - ack - 1
+        if 0 <= offset < window:
+            bitmap[offset >> 3] |= 1 << (offset & 7)
+    return bytes(bitmap)
+
+
+def sacked(ack, bitmap):
+    """Yield the sequence numbers a SACK bitmap acknowledges."""
+    for index, byte in enumerate(bitmap):
+        bit = 0
+        while byte:
+            if byte & 1:
+                yield ack + 1 + (index << 3) + bit
+            byte >>= 1
+            bit += 1
+
+
+def is_ack(data):
+    return (len(data) >= HEADER_SIZE and data[0] == MAGIC[0] and
+            data[1] == MAGIC[1] and data[3] == ACK)
+
+
+def is_repair(data):
+    return (len(data) >= HEADER_SIZE and data[0] == MAGIC[0] and
+            data[1] == MAGIC[1] and data[3] == REPAIR)
+
+
+def decode(data):
+    """Parse a received datagram into a message dict.
+
+    Binary payloads are returned as memoryviews over ``data``, so no copy
+    of the received buffer is made. Malformed datagrams raise ValueError,
+    KeyError or struct.error.
+    """
+    if not len(data):
+        raise ValueError('Empty datagram')
+    if data[0] == JSON_START:
+        return decode_json(data)
+    return decode_binary(data)
+
+
+def valid_field(value, kind):
+    if isinstance(value, bool) or not isinstance(value, kind):
+        return False
+    # Integers end up in int64 NumPy columns and C structs
+    return not isinstance(value, int) or MIN_INT <= value <= MAX_INT
+
+
+def decode_json(data):
+    if isinstance(data, memoryview):
+        data = data.tobytes()
+    data = json.loads(data)
+    if (not isinstance(data, dict) or
+            not isinstance(data.get('type'), str) or
+            data['type'] not in JSON_FIELDS):
+        raise ValueError('Not a known JSON datagram')
+    for name, kind in JSON_FIELDS[data['type']].items():
+        if not valid_field(data.get(name), kind):
+            raise ValueError('Missing or invalid %s' % name)
+    for name, kind in JSON_OPTIONAL.items():
+        if name in data and not valid_field(data[name], kind):
+            raise ValueError('Invalid %s' % name)
+    data['format'] = FORMAT_JSON
+    if data['type'] == 'MSG':
+        data['timestamp'] = timestamp_ns(data['timestamp'])
+    elif data['type'] == 'FILE':
+        data['payload'] = base64.b64decode(data['payload'])
+    return data
+
+
+def decode_binary(data):
+    (magic, version, kind, flags, session,
+     seq, total, timestamp) = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError('Not a framed datagram')
+    if version > VERSION:
+        raise ValueError('Unsupported wire version %d' % version)
+    if timestamp > MAX_INT:
+        raise ValueError('Timestamp out of range')
+    payload = memoryview(data)[HEADER_SIZE:]
+    kind = TYPE_NAMES[kind]
+    if kind == 'MSG':
+        return {'type': kind, 'format': FORMAT_BINARY, 'flags': flags,
+                'session': session, 'sequence_num': seq,
+                'total_messages': total, 'timestamp': timestamp,
+                'message': payload}
+    elif kind == 'FILE':
+        return {'type': kind, 'format': FORMAT_BINARY, 'flags': flags,
+                'session': session, 'seq_num': seq, 'total_seq': total,
+                'timestamp': timestamp, 'payload': payload}
+    elif kind == 'ACK':
+        return {'type': kind, 'format': FORMAT_BINARY, 'flags': flags,
+                'session': session, 'ack': seq, 'total_seq': total,
+                'timestamp': timestamp, 'bitmap': payload}
+    elif kind == 'BLOCKS':
+        return {'type': kind, 'format': FORMAT_BINARY, 'flags': flags,
+                'session': session, 'first': seq, 'total_blocks': total,
+                'timestamp': timestamp, 'payload': payload}
+    elif kind == 'REPAIR':
+        return {'type': kind, 'format': FORMAT_BINARY, 'flags': flags,
+                'session': session, 'round': seq, 'timestamp': timestamp,
+                'blocks': list(struct.unpack_from('!%dI' % total, payload))}
+    return {'type': kind, 'format': FORMAT_BINARY, 'flags': flags,
+            'session': session, 'round': seq, 'timestamp': timestamp,
+            'payload': str(payload, 'ascii')}
+
+
+def encode_hello(session, formats=FORMATS, **params):
+    data = {'type': 'HELLO', 'version': VERSION, 'session': session,
+            'formats': list(formats)}
+    data.update(params)
+    return bytes(json.dumps(data), 'utf-8')
+
+
+def pick_format(offer, formats=FORMATS):
+    """First format of ``offer`` the server speaks."""
+    if offer.get('version', 0) > VERSION:
+        return FORMAT_JSON
+    for fmt in offer.get('formats', [FORMAT_JSON]):
+        if fmt in formats:
+            return fmt
+    return FORMAT_JSON
+
+
+def max_chunk_size(fmt):
+    """Largest chunk whose datagram in ``fmt`` fits in a UDP payload."""
+    if fmt == FORMAT_BINARY:
+        return MAX_CHUNK_SIZE
+    return (MAX_DATAGRAM - JSON_CHUNK_OVERHEAD) * 3 // 4
+
+
+def answer_hello(offer, formats=FORMATS, **params):
+    """Pick the first format of ``offer`` the server speaks.
+
+    Extra ``params`` are the session parameters the server agreed to.
+    """
+    data = {'type': 'HELLO', 'version': VERSION,
+            'session': offer.get('session', 0),
+            'format': pick_format(offer, formats)}
+    data.update(params)
+    return bytes(json.dumps(data), 'utf-8')
+
+
+def negotiate(sock, addr, session, formats=FORMATS, timeout=HELLO_TIMEOUT,
+              **params):
+    """Agree on a wire format with the server listening on ``addr``.
+
+    Returns the server reply, whose ``format`` entry holds the chosen wire
+    format. Servers that do not answer the HELLO are assumed to only speak
+    JSON and to support none of the optional session parameters.
+    """
+    previous = sock.gettimeout()
+    sock.settimeout(timeout)
+    try:
+        sock.sendto(encode_hello(session, formats, **params), addr)
+        data = sock.recv(HELLO_BUFSIZE)
+    except (socket.timeout, ConnectionError):
+        data = None
+    finally:
+        sock.settimeout(previous)
+    return read_hello(data, formats)
+
+
+def read_hello(data, formats=FORMATS):
+    """Server reply to a HELLO from its datagram, ``None`` when it did not
+    answer."""
+    try:
+        reply = json.loads(data)
+    except (TypeError, ValueError):
+        reply = {'type': 'HELLO', 'version': 0, 'format': FORMAT_JSON}
+    if reply.get('format') not in formats:
+        reply['format'] = FORMAT_JSON
+    return reply
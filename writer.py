@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+
+"""Disk stage of the server, run away from the asyncio event loop."""
+
+import threading
+import traceback
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_WORKERS = 4
+DEFAULT_QUEUE_SIZE = 4096
+
+
+class WriterPool:
+    """Run blocking file writes, hashing and reports on a thread pool.
+
+    Jobs sharing a key (one per client session) run one at a time in the
+    order they were submitted, while jobs of different sessions run in
+    parallel. ``full`` tells the event loop when ``max_pending`` jobs are
+    waiting, so it can push back on clients instead of queueing more.
+    """
+
+    def __init__(self, workers=DEFAULT_WORKERS,
+                 max_pending=DEFAULT_QUEUE_SIZE):
+        self.executor = ThreadPoolExecutor(max_workers=workers,
+                                           thread_name_prefix='writer')
+        self.max_pending = max_pending
+        self.lock = threading.Lock()
+        self.queues = {}
+        self.pending = 0
+
+    @property
+    def depth(self):
+        """Number of jobs submitted but not finished yet."""
+        return self.pending
+
+    @property
+    def full(self):
+        return self.pending >= self.max_pending
+
+    def submit(self, key, fn, *args):
+        with self.lock:
+            self.pending += 1
+            queue = self.queues.get(key)
+            if queue is not None:
+                queue.append((fn, args))
+                return
+            self.queues[key] = deque([(fn, args)])
+        self.executor.submit(self.drain, key)
+
+    def drain(self, key):
+        while True:
+            with self.lock:
+                queue = self.queues[key]
+                if not queue:
+                    del self.queues[key]
+                    return
+                fn, args = queue.popleft()
+            try:
+                fn(*args)
+            except Exception:
+                traceback.print_exc()
+            finally:
+                with self.lock:
+                    self.pending -= 1
+
+    def close(self):
+        """Wait for every submitted job and stop the worker threads."""
+        self.executor.shutdown(wait=True)